@@ -25,11 +25,19 @@ import thread
 import socket
 import sys
 import time
+import collections
 #import pickle
-import traceback
 
-from peet.shared import cerealizer
 from peet.shared import network
+from peet.shared import schemas
+from peet.shared import log
+
+logger = log.getLogger('client.net')
+
+resume_timeout = 30
+""" How long the communicator keeps trying to resume a session after losing
+the connection, in seconds, before it gives up and reports the disconnect
+(e.g. because the server has exited) """
 
 class Communicator:
 
@@ -45,6 +53,27 @@ class Communicator:
         self.postEvent = postEvent
         self.sock = None
 
+        # Set when the server sends its message schemas
+        self.schemas = None
+
+        # The token of the session the server started after login, and the
+        # number of the last sequenced message received in it (see
+        # servernet.Session).  If the connection drops, the communicator
+        # reconnects and resumes the session by itself.
+        self.token = None
+        self.lastSeq = 0
+        self.resuming = False
+        self.resumeDeadline = None  # When to stop trying to resume
+
+        # The sequenced messages sent in the session, numbered like the
+        # server numbers those it sends, and those of them the server hasn't
+        # acknowledged yet, as (number, message), for resending after a
+        # resume.  While resuming, new ones are only kept.  sendLock keeps
+        # the numbering and sending in step with the resending.
+        self.sentSeq = 0
+        self.unacknowledged = collections.deque()
+        self.sendLock = thread.allocate_lock()
+
     def connectToServer(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
@@ -55,11 +84,15 @@ class Communicator:
                     self.sock.connect((self.address, self.port))
                     connected = True
                 except:
-                    print "Couldn't connect, retrying in 1 second - "\
-                            + str(sys.exc_info()[1])
+                    if self.resuming and time.time() > self.resumeDeadline:
+                        self.abandonResume()
+                        return
+                    logger.warning("Couldn't connect, retrying in 1 second - "
+                            "%s", sys.exc_info()[1])
                     time.sleep(1)
 
-            self.postEvent({'type': 'connect'})
+            if not self.resuming:
+                self.postEvent({'type': 'connect'})
             self.senderThread = network.SenderThread(self.sock, True)
             self.senderThread.Start()
             self.listenerThread = ListenerThread(self)
@@ -68,7 +101,110 @@ class Communicator:
         thread.start_new_thread(run, ())
 
     def send(self, message):
-        self.senderThread.send(message)
+        self.sendLock.acquire()
+        try:
+            if self.token != None and \
+                    message['type'] in network.sequenced_types:
+                self.sentSeq += 1
+                self.unacknowledged.append((self.sentSeq, message))
+                if self.resuming:
+                    # Sent once the session is resumed (see onResumed())
+                    return
+            self.senderThread.send(message)
+        finally:
+            self.sendLock.release()
+
+    def startSession(self, token):
+        """ Begin numbering messages for a new session. """
+        self.sendLock.acquire()
+        self.token = token
+        self.lastSeq = 0
+        self.senderThread.ack = 0
+        self.sentSeq = 0
+        self.unacknowledged.clear()
+        self.sendLock.release()
+
+    def acknowledged(self, seq):
+        """ Forget the messages the server has received, up to number seq. """
+        self.sendLock.acquire()
+        while self.unacknowledged and self.unacknowledged[0][0] <= seq:
+            self.unacknowledged.popleft()
+        self.sendLock.release()
+
+    def onResumed(self, message):
+        """ Pick up the session on the new connection: everything the server
+        sent after message['seq'] follows, and the messages the server didn't
+        receive (after message['received']) are sent again. """
+        self.sendLock.acquire()
+        try:
+            self.lastSeq = message['seq']
+            received = message.get('received')
+            if received != None:
+                while self.unacknowledged and \
+                        self.unacknowledged[0][0] <= received:
+                    self.unacknowledged.popleft()
+                for n, m in self.unacknowledged:
+                    self.senderThread.send(m)
+            self.resuming = False
+        finally:
+            self.sendLock.release()
+
+    def endSession(self):
+        """ Forget the session, e.g. when it can't be resumed. """
+        self.sendLock.acquire()
+        self.token = None
+        self.resuming = False
+        self.unacknowledged.clear()
+        self.sendLock.release()
+
+    def onMessage(self, message):
+        """ Count a sequenced message received in the session, and acknowledge
+        it if it's time to. """
+        self.lastSeq += 1
+        self.senderThread.ack = self.lastSeq
+        if self.lastSeq % network.ack_interval == 0:
+            self.send({'type': 'ack', 'seq': self.lastSeq})
+
+    def resume(self):
+        """ Reconnect after losing the connection, and resume the session once
+        the new connection is set up (see ListenerThread).  Gives up once
+        it's been trying for resume_timeout seconds. """
+        self.senderThread.Stop()
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        if not self.resuming:
+            self.resumeDeadline = time.time() + resume_timeout
+        elif time.time() > self.resumeDeadline:
+            # E.g. the server accepts connections but closes them.
+            self.abandonResume()
+            return
+        else:
+            # The last attempt's connection was lost too.
+            time.sleep(1)
+        logger.warning("Connection lost; reconnecting to resume session")
+        self.resuming = True
+        self.connectToServer()
+
+    def abandonResume(self):
+        logger.warning("Couldn't resume session; giving up")
+        self.endSession()
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        self.postEvent({'type': 'disconnect'})
+
+    def disconnect(self):
+        """ Close the connection for good, without resuming the session.  A
+        'disconnect' event is posted once the listener thread stops. """
+        self.token = None
+        self.senderThread.Stop()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
 
 class ListenerThread:
 
@@ -89,26 +225,72 @@ class ListenerThread:
         self.keepListening = False
 
     def Run(self):
+        lost = False  # Set if the connection is lost, rather than closed
         try:
-            leftovers = ''
+            reader = network.MessageReader(self.communicator.sock)
             while self.keepListening:
-                data, leftovers = network.recvmessage(self.communicator.sock,
-                        leftovers)
+                data = reader.read()
                 if data == None:
-                    print "ListenerThread: connection closed; terminating"
+                    logger.info(
+                            "ListenerThread: connection closed; terminating")
                     self.keepListening = False
+                    lost = True
                     break
-                message = cerealizer.loads(data)
+                message = network.decode(data, self.communicator.schemas)
                 if message['type'] == 'sync':
                     # Server sent a sync message; send back a reply immediately
                     # with our wall-clock time
-                    self.communicator.send({'type': 'sync', 'ct': time.time()})
+                    reply = {'type': 'sync', 'ct': time.time()}
+                    if message.has_key('seq'):
+                        reply['seq'] = message['seq']
+                    self.communicator.send(reply)
+                elif message['type'] == 'framing':
+                    network.negotiateFraming(message, reader,
+                            self.communicator.senderThread)
+                    if message.has_key('mode') and self.communicator.resuming:
+                        # The server has switched framing, so the connection
+                        # is ready.
+                        self.communicator.send({'type': 'resume',
+                            'token': self.communicator.token,
+                            'seq': self.communicator.lastSeq})
+                elif message['type'] == 'session':
+                    self.communicator.startSession(message['token'])
+                elif message['type'] == 'resumed':
+                    logger.info("Session resumed")
+                    self.communicator.onResumed(message)
+                elif message['type'] == 'resumeFailed':
+                    logger.warning("Couldn't resume session")
+                    self.communicator.endSession()
+                    break
+                elif message['type'] == 'ack':
+                    self.communicator.acknowledged(message['seq'])
+                elif message['type'] in ('reloginPrompt', 'error') and \
+                        self.communicator.resuming:
+                    # The server prompts every client that connects during
+                    # the game (or turns it away, if it hasn't noticed the old
+                    # connection drop yet); this one is resuming instead.
+                    logger.info("Ignored while resuming: %s", message)
+                elif message['type'] == 'schemas':
+                    # Game messages that match these may now arrive packed
+                    self.communicator.schemas = \
+                            schemas.SchemaRegistry.fromDescription(
+                                    message['schemas'])
                 else:
+                    if self.communicator.token != None and \
+                            message['type'] in network.sequenced_types:
+                        self.communicator.onMessage(message)
                     self.communicator.postEvent(message)
 
         except:
-            print "ListenerThread.Run(): caught exception:"
-            traceback.print_exc(file=sys.stdout)
+            logger.exception("ListenerThread.Run(): caught exception")
+            lost = True
 
         # Thread is terminating.
-        self.communicator.postEvent({'type': 'disconnect'})
+        if lost and self.communicator.token != None:
+            self.communicator.resume()
+        else:
+            try:
+                self.communicator.sock.close()
+            except socket.error:
+                pass
+            self.communicator.postEvent({'type': 'disconnect'})
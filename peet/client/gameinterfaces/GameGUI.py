@@ -21,6 +21,9 @@ import wx
 
 from peet.client import clientnet
 from peet.shared.constants import roundingOptions
+from peet.shared import log
+
+logger = log.getLogger('client.gui')
 
 NetworkEvent, EVT_NETWORK = wx.lib.newevent.NewEvent()
 DestroyEvent, EVT_DESTROY = wx.lib.newevent.NewEvent()
@@ -97,7 +100,7 @@ class GameGUI(wx.Frame):
             self.chatBox.AppendText(self.makeChatString(mes, mes['id']))
 
         elif mes['type'] == 'disconnect':
-            print 'GameGUI received disconnect message'
+            logger.info('GameGUI received disconnect message')
 
             text = "The network connection has been lost."
             dlg = wx.MessageDialog(self, text,
@@ -167,14 +170,14 @@ class GameGUI(wx.Frame):
 
     def onMessageReceived(self, mes):
         """ Override this method to handle server messages. """
-        print "server said: " + str(mes)
+        logger.debug('server said: %s', mes)
 
     def sendReadyMessage(self):
         """ Inform the server that the GUI is ready for the game to begin.
         Called by the login window for convenience; it's the one that creates
         the GameGUI. """
         self.communicator.send({'type': 'ready'})
-        print 'sendReadyMessage(): done'
+        logger.debug('sendReadyMessage(): done')
 
     def makeChatString(self, mes, id):
         return '\nPlayer ' + str(id) + ': ' + mes['message']
@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import math
+import time
 from decimal import Decimal
 import wx
 from wx.lib.scrolledpanel import ScrolledPanel
@@ -24,6 +25,9 @@ from peet.client import clientnet
 import GameGUI
 from peet.shared.widgets import FloatSpin
 from peet.client.widgets import BorderedPanel
+from peet.shared import log
+
+logger = log.getLogger('client.gui.island')
 
 # Fonts and colors
 lightBlue = '#bfbfff' # GIMP: blue, then 25% saturation
@@ -111,16 +115,30 @@ class IslandGUI(GameGUI.GameGUI):
         self.mktPanel = MarketPanel(self.panel)
         mktSizer.AddF(self.mktPanel, f)
 
+        # The best few bids and asks standing in the order book, if the market
+        # has one
+        self.bookLabel = wx.StaticText(self.panel, wx.ID_STATIC, ' ')
+        self.bookLabel.Hide()
+        mktSizer.AddF(self.bookLabel, f)
+
         # Bid/Ask spinner and button
         spinSizer = wx.BoxSizer(wx.HORIZONTAL)
+        # (The server takes amounts up to IslandControl.max_amount.)
         self.spinner = FloatSpin.FloatSpin(self.panel, min_val = 0.1,
-                value = 0.1, digits = 2, increment = 0.1,
+                max_val = 100000, value = 0.1, digits = 2, increment = 0.1,
                 extrastyle = FloatSpin.FS_RIGHT)
         spinSizer.Add(self.spinner)
         self.submitButton = wx.Button(self.panel, wx.ID_ANY, 'Submit')
         self.submitButton.Disable()
         self.Bind(wx.EVT_BUTTON, self.onSubmitClicked, self.submitButton)
         spinSizer.Add(self.submitButton, flag=wx.LEFT, border=padding)
+        # Withdraws the player's standing bid or ask, if the market has an
+        # order book
+        self.cancelButton = wx.Button(self.panel, wx.ID_ANY, 'Cancel')
+        self.cancelButton.Disable()
+        self.cancelButton.Hide()
+        self.Bind(wx.EVT_BUTTON, self.onCancelClicked, self.cancelButton)
+        spinSizer.Add(self.cancelButton, flag=wx.LEFT, border=padding)
         mktSizer.AddF(spinSizer, f)
 
         bottomSizer.Add(mktSizer)
@@ -184,7 +202,7 @@ class IslandGUI(GameGUI.GameGUI):
 
         # Process reinitialization parameters.
         if initParams['type'] == 'reinit':
-            print 'Re-initializing'
+            logger.info('Re-initializing')
             self.doReinit(initParams)
 
     def doReinit(self, rp):
@@ -194,67 +212,63 @@ class IslandGUI(GameGUI.GameGUI):
             'round': rp['round'],
             'doNotPrintEvent': True})
             # Don't print the match and round in the market panel - we take care
-            # of that in the loop below
+            # of that below
         self.onMessageReceived(rp['matchInitMessage'])
         self.onMessageReceived({'type': 'gm', 'subtype': 'acctUpdate',
-            'acct': rp['acct']})
+            'acct': rp['acct'], 'v': rp.get('acctVersion', 0), 'full': True})
         
-        # Restore the marketpanel from 'events' and 'mktHist'
-        # -- go thru all matches and rounds up thru current, but check
-        # whether they exist in 'events and 'mktHist'
-        # 2009-06-12 Too slow when there are many events. Only do current round.
-        for m in range(rp['match'], rp['match']+1):
-            for r in range(rp['round'], rp['round']+1):
-                self.mktPanel.addEvent({'type': 'gm',
-                    'subtype': 'matchAndRound', 'match': m, 'round': r})
-                
-                # True if this is the current round
-                thisRound = (m == rp['match'] and
-                        r == rp['round'])
-
-                for color in ('blue', 'red'):
-                    e = rp['events'][m][r]
-                    print e
-                    
-                    # production shock
-                    if color == self.color and e.get('prodShock') == 1:
-                        self.mktPanel.addEvent({'subtype': 'prodShock'})
-
-                    # production choice (but not if it hasn't been made yet)
-                    if not thisRound\
-                            or color in rp['productionChoicesMade']:
-                        self.mktPanel.addEvent(
-                            {'subtype': 'productionChoice',
-                            'color': color,
-                            'green': e.get('productionChoice_green'),
-                            color: e.get('productionChoice_' + color)})
-                    
-                    # money shock
-                    if e.get('moneyShock_'+color+'Mkt') == 1:
-                        self.mktPanel.addEvent({'subtype': 'moneyShock',
-                            'amount': e.get('moneyShockAmountRealized_' +
-                                color + 'Mkt')})
-                    
-                    # market activity
-                    mkt = rp['mktHist'][m][r][color]
-                    # If any market events for this match, round, and color,
-                    if len(mkt) > 0:
-                        # Set up the market panel
-                        self.mktPanel.setMarketColor(color)
-                    for e in mkt:
-                        if e['Action'] == 'bid':
-                            self.mktPanel.addEvent({'subtype': 'bid',
-                                'id': e['Buyer'], 'amount': e['Bid']})
-                        elif e['Action'] == 'ask':
-                            self.mktPanel.addEvent({'subtype': 'ask',
-                                'id': e['Seller'], 'amount': e['Ask']})
-                        elif e['Action'] == 'accept':
-                            self.mktPanel.addEvent(
-                                    {'subtype': 'transaction',
-                                    'buyerID': e['Buyer'],
-                                    'sellerID': e['Seller'],
-                                    'amount': e['Accept']})
-
+        # Restore the marketpanel from 'events' and 'mktHist', which cover
+        # only the current round.  (The whole history is too slow to replay
+        # when there are many events.)
+        self.mktPanel.addEvent({'type': 'gm', 'subtype': 'matchAndRound',
+            'match': rp['match'], 'round': rp['round']})
+
+        e = rp['events']
+        for color in ('blue', 'red'):
+            # production shock
+            if color == self.color and e.get('prodShock') == 1:
+                self.mktPanel.addEvent({'subtype': 'prodShock'})
+
+            # production choice (but not if it hasn't been made yet)
+            if color in rp['productionChoicesMade']:
+                self.mktPanel.addEvent(
+                    {'subtype': 'productionChoice',
+                    'color': color,
+                    'green': e.get('productionChoice_green'),
+                    color: e.get('productionChoice_' + color)})
+
+            # money shock
+            if e.get('moneyShock_'+color+'Mkt') == 1:
+                self.mktPanel.addEvent({'subtype': 'moneyShock',
+                    'amount': e.get('moneyShockAmountRealized_' +
+                        color + 'Mkt')})
+
+            # market activity
+            mkt = rp['mktHist'][color]
+            # If any market events for this round and color,
+            if len(mkt) > 0:
+                # Set up the market panel
+                self.mktPanel.setMarketColor(color)
+            for event in mkt:
+                if event['Action'] == 'bid':
+                    self.mktPanel.addEvent({'subtype': 'bid',
+                        'id': event['Buyer'], 'amount': event['Bid']})
+                elif event['Action'] == 'ask':
+                    self.mktPanel.addEvent({'subtype': 'ask',
+                        'id': event['Seller'], 'amount': event['Ask']})
+                elif event['Action'] == 'accept':
+                    self.mktPanel.addEvent(
+                            {'subtype': 'transaction',
+                            'buyerID': event['Buyer'],
+                            'sellerID': event['Seller'],
+                            'amount': event['Accept']})
+                elif event['Action'] == 'cancel':
+                    if event.has_key('Buyer'):
+                        self.mktPanel.addEvent({'subtype': 'cancel',
+                            'id': event['Buyer'], 'side': 'bid'})
+                    else:
+                        self.mktPanel.addEvent({'subtype': 'cancel',
+                            'id': event['Seller'], 'side': 'ask'})
 
         # If the server is waiting for a reply for some message, process
         # that message, too.
@@ -271,6 +285,7 @@ class IslandGUI(GameGUI.GameGUI):
         if m['type'] == 'pause':
             self.timer.Stop()
             self.submitButton.Disable()
+            self.cancelButton.Disable()
 
         elif m['type'] == 'gm':
 
@@ -294,7 +309,8 @@ class IslandGUI(GameGUI.GameGUI):
                     self.mktPanel.addEvent(m)
 
             elif m['subtype'] == 'acctUpdate':
-                self.acctPanel.update(m['acct'])
+                self.acctPanel.update(m['acct'], m.get('v'),
+                        m.get('full', False))
                 # Account panel may have grown to accommodate new digits.
                 self.SetClientSize(self.panel.GetBestSize())
 
@@ -380,6 +396,12 @@ class IslandGUI(GameGUI.GameGUI):
                 self.submitButton.SetLabel(
                         'Ask' if self.color == self.mktColor else 'Bid')
                 self.submitButton.Enable()
+                orderBook = m.get('market') == 'ORDER_BOOK'
+                self.cancelButton.Show(orderBook)
+                self.cancelButton.Enable(orderBook)
+                self.bookLabel.SetLabel(' ')
+                self.bookLabel.Show(orderBook)
+                self.mktSizer.Layout()
 
             elif m['subtype'] == 'error':
                 self.closeMessageDialogs()
@@ -395,12 +417,18 @@ class IslandGUI(GameGUI.GameGUI):
                 dlg.ShowModal()
                 dlg.Destroy()
 
-            elif m['subtype'] in ('bid', 'ask', 'transaction'):
+            elif m['subtype'] in ('bid', 'ask', 'transaction', 'cancel'):
                 self.mktPanel.addEvent(m)
 
+            elif m['subtype'] == 'book':
+                self.bookLabel.SetLabel('Bids: %s\nAsks: %s' % (
+                    self.formatBook(m['bids']), self.formatBook(m['asks'])))
+                self.mktSizer.Layout()
+
             elif m['subtype'] == 'timeup':
                 self.closeMessageDialogs()
                 self.submitButton.Enable(False)
+                self.cancelButton.Enable(False)
                 self.timer.Stop()
                 self.setTimeLeft(0)
 
@@ -423,11 +451,24 @@ class IslandGUI(GameGUI.GameGUI):
             action = 'bid'
 
         amount = Decimal(self.spinner.GetTextCtrl().GetValue())
-        m = {'type': 'gm', 'subtype': action, 'amount': amount}
+        # Stamped with the time sent, so that the server can tell how long it
+        # took to get there
+        m = {'type': 'gm', 'subtype': action, 'amount': amount,
+                'ct': time.time()}
         self.communicator.send(m)
 
+    def onCancelClicked(self, event):
+        self.communicator.send({'type': 'gm', 'subtype': 'cancel'})
+
+    def formatBook(self, levels):
+        """ Format price levels of the order book, e.g. "5.0 (2), 4.5 (1)" for
+        two orders at 5.0 and one at 4.5. """
+        if not levels:
+            return '-'
+        return ', '.join(['%s (%d)' % (price, n) for price, n in levels])
+
     def closeMessageDialogs(self):
-        print 'closeMessageDialogs'
+        logger.debug('closeMessageDialogs')
         dlgs = []
         for dlgID in self.openMessageDialogs:
             dlgs.append(wx.FindWindowById(dlgID))
@@ -633,6 +674,25 @@ class MarketPanel(wx.Panel):
             sizer.AddF(wx.StaticText(panel, wx.ID_STATIC, str(m['amount'])), f)
             sizer.AddF(wx.StaticText(panel, wx.ID_STATIC, str(m['id']+1)), f)
 
+        elif m['subtype'] == 'cancel':
+            panel.SetBackgroundColour(self.lightColor)
+            sizer = wx.GridSizer(1, 5)
+            panel.SetSizer(sizer)
+            if m['side'] == 'bid':
+                sizer.AddF(wx.StaticText(panel, wx.ID_STATIC,
+                    str(m['id']+1)), f)
+                sizer.AddF(wx.StaticText(panel, wx.ID_STATIC, 'cancel'), f)
+                sizer.AddF(wx.StaticText(panel, wx.ID_STATIC, ' '), f)
+                sizer.AddF(wx.StaticText(panel, wx.ID_STATIC, ' '), f)
+                sizer.AddF(wx.StaticText(panel, wx.ID_STATIC, ' '), f)
+            else:
+                sizer.AddF(wx.StaticText(panel, wx.ID_STATIC, ' '), f)
+                sizer.AddF(wx.StaticText(panel, wx.ID_STATIC, ' '), f)
+                sizer.AddF(wx.StaticText(panel, wx.ID_STATIC, ' '), f)
+                sizer.AddF(wx.StaticText(panel, wx.ID_STATIC, 'cancel'), f)
+                sizer.AddF(wx.StaticText(panel, wx.ID_STATIC,
+                    str(m['id']+1)), f)
+
         elif m['subtype'] == 'transaction':
             panel.SetBackgroundColour(self.lightColor)
             sizer = wx.GridSizer(1, 5)
@@ -734,13 +794,28 @@ class AccountPanel(wx.Panel):
         self.matchScoreLabel = wx.StaticText(self, wx.ID_STATIC, '0')
         sizer.Add(self.matchScoreLabel, flag=wx.ALIGN_RIGHT)
 
-    def update(self, acct):
-        self.dollarsLabel.SetLabel(str(acct['dollars']))
-        self.blueLabel.SetLabel(str(acct['blue']))
-        self.redLabel.SetLabel(str(acct['red']))
-        self.greenLabel.SetLabel(str(acct['green']))
-        self.roundScoreLabel.SetLabel(str(acct['roundScore']))
-        self.matchScoreLabel.SetLabel(str(acct['matchScore']))
+        self.labels = {'dollars': self.dollarsLabel, 'blue': self.blueLabel,
+                'red': self.redLabel, 'green': self.greenLabel,
+                'roundScore': self.roundScoreLabel,
+                'matchScore': self.matchScoreLabel}
+        self.acct = {}  # The account, as of the last update applied
+        self.version = 0  # Version of the last update applied
+
+    def update(self, acct, version=None, full=True):
+        """ Apply an account update from the server: the whole account, or
+        (if not full) a patch of the fields that changed.  Patches no newer
+        than the last update applied are ignored (see
+        GameControl.sendState()).
+        @param version: the version of the update, or None to apply it
+            regardless """
+        if version != None:
+            if version < self.version or \
+                    (version == self.version and not full):
+                return
+            self.version = version
+        for name, value in acct.iteritems():
+            self.acct[name] = value
+            self.labels[name].SetLabel(str(value))
 
         # Panel may need to grow to accommodate extra digits.
         self.SetSize(self.GetBestSize())
@@ -788,14 +863,14 @@ class MessageDialog(wx.Dialog):
     #    self.EndModal(1)
 
     def EndModal(self, retCode):
-        print 'EndModal'
+        logger.debug('EndModal')
         # Remove this dialog from the main frame's list of open message dialogs.
         # This dialog may already have been Ended, so check the list first.
         if self.GetId() in self.GetParent().openMessageDialogs:
             self.GetParent().openMessageDialogs.remove(self.GetId())
             wx.Dialog.EndModal(self, retCode)
         else:
-            print ' - Dialog already closed'
+            logger.debug('EndModal: dialog already closed')
 
 class ProductionDialog(wx.Dialog):
     def __init__(self, parent, color, pf, timeLimit):
@@ -929,7 +1004,7 @@ class ProductionPanel(wx.Panel):
         maxcoord = max(self.maxx, self.maxy)
         minphysical = min(self.w, self.h)
         self.scale = float(minphysical - 2 * self.margin) / float(maxcoord)
-        print 'scale = ', self.scale
+        logger.debug('scale = %s', self.scale)
 
         self.Bind(wx.EVT_PAINT, self.OnPaint)
         self.Bind(wx.EVT_ENTER_WINDOW, self.onEnterWindow)
@@ -0,0 +1,466 @@
+# Copyright 2009 University of Alaska Anchorage Experimental Economics
+# Laboratory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A headless client that connects many simulated participants (bots) to a
+# server, for load testing without a person at each PC.  Each bot logs in like
+# the client GUI, makes its Island production choices, and submits bids and
+# asks during auctions following a strategy (see strategies).  Bots can be
+# spread over several processes.  Run loadgen.py from the top of the source
+# tree; see usage().
+
+import sys
+import time
+import random
+import getopt
+import thread
+import ConfigParser
+import multiprocessing
+from decimal import Decimal
+
+from peet.client import clientnet
+from peet.server import servernet
+from peet.shared import log
+
+logger = log.getLogger('client.loadgen')
+
+class Strategy:
+
+    """
+    Decides when a bot submits orders during an auction, and what they are.
+    A strategy may be shared by many bots, so it keeps no state of its own;
+    each bot has its own random number generator (bot.random).  This base
+    class makes a random production choice and never trades; subclasses
+    override nextDelay and makeOrder.
+    """
+
+    delay = 1.0
+    """ Seconds between a bot's turns. """
+
+    def chooseProduction(self, bot, pf):
+        """ Return the index of the production choice to make, given the
+        production function pf (a list of (green, color) pairs). """
+        return bot.random.randrange(len(pf))
+
+    def nextDelay(self, bot):
+        """ Return the number of seconds until the bot's next order. """
+        return self.delay
+
+    def makeOrder(self, bot):
+        """ Return the bot's next order as a (subtype, amount) pair, with
+        amount a Decimal (or None for a cancellation), or None to skip this
+        turn. """
+        return None
+
+class ZeroIntelligence(Strategy):
+
+    """
+    Budget-constrained zero-intelligence trading: orders come at random
+    (exponentially distributed) intervals, each at a price drawn uniformly
+    between low and high dollars, but never a bid of more dollars than the bot
+    has or an ask without a chip to sell.  In an order book market, a fraction
+    cancel of the orders are cancellations instead.
+    """
+
+    def __init__(self, low=0.1, high=10.0, delay=1.0, cancel=0.1):
+        self.low = low
+        self.high = high
+        self.delay = delay
+        self.cancel = cancel
+
+    def nextDelay(self, bot):
+        return bot.random.expovariate(1.0 / self.delay)
+
+    def makeOrder(self, bot):
+        if bot.market == 'ORDER_BOOK' and bot.random.random() < self.cancel:
+            return ('cancel', None)
+        high = self.high
+        if bot.side == 'bid':
+            high = min(high, float(bot.acct.get('dollars', 0)))
+        elif bot.acct.get(bot.mktColor, 0) < 1:
+            return None
+        if high < self.low:
+            return None
+        return (bot.side, dimes(bot.random.uniform(self.low, high)))
+
+class FixedRate(Strategy):
+
+    """
+    Orders at a steady rate (per second), at a price drawn uniformly within
+    spread dollars of price.  Affordability isn't checked, so some orders are
+    turned down, which is load as well.
+    """
+
+    def __init__(self, rate=1.0, price=5.0, spread=1.0):
+        self.rate = rate
+        self.price = price
+        self.spread = spread
+
+    def nextDelay(self, bot):
+        return 1.0 / self.rate
+
+    def makeOrder(self, bot):
+        price = bot.random.uniform(self.price - self.spread,
+                self.price + self.spread)
+        return (bot.side, dimes(max(0.1, price)))
+
+strategies = {'zi': ZeroIntelligence, 'fixed': FixedRate}
+""" Strategy classes by the name given on the command line """
+
+def dimes(dollars):
+    """ Round a float amount of dollars to a Decimal multiple of $0.10, as the
+    server does with bids and asks (e.g. 2.46 -> Decimal('2.50')). """
+    return Decimal('%.1f' % dollars) * Decimal('1.0')
+
+def parseStrategy(spec):
+    """ Make a Strategy from a command line spec: a name from strategies,
+    optionally followed by a colon and comma-separated settings of the
+    class's keyword arguments, e.g. 'zi:high=5,delay=0.5'. """
+    name, sep, settings = spec.partition(':')
+    kwargs = {}
+    for setting in settings.split(','):
+        if setting:
+            key, sep, value = setting.partition('=')
+            kwargs[key] = float(value)
+    return strategies[name](**kwargs)
+
+class Bot:
+
+    """
+    One simulated participant.  Messages from the server arrive in the
+    communicator's listener thread (see onMessage()), and orders are submitted
+    from the scheduler's thread, so neither should block.
+    """
+
+    def __init__(self, name, strategy, scheduler, seed=None):
+        self.name = name
+        self.strategy = strategy
+        self.scheduler = scheduler
+        self.random = random.Random(seed)
+        self.communicator = None
+
+        self.id = None
+        self.game = None  # The GUI class the server asked for
+        self.color = None
+        self.acct = {}
+        self.acctVersion = 0
+        self.market = None
+
+        # The auction in progress, if trading
+        self.trading = False
+        self.mktColor = None
+        self.side = None  # 'bid' or 'ask'
+        self.call = None  # The ScheduledCall of the next order
+
+        # Orders not yet answered, as (amount, time sent), oldest first; and
+        # how long orders took to come back from the server, accepted or not
+        self.pending = []
+        self.responseStats = servernet.LatencyStats()
+
+        self.counts = dict.fromkeys(('orders', 'accepted', 'rejected',
+            'trades', 'events'), 0)
+
+        # Released when the bot is finished with the server
+        self.finished = thread.allocate_lock()
+        self.finished.acquire()
+        self.connected = False
+
+    def connect(self, host, port):
+        self.communicator = clientnet.Communicator(host, port, self.onMessage)
+        self.communicator.connectToServer()
+
+    def send(self, message):
+        self.communicator.send(message)
+
+    def onMessage(self, m):
+        t = m['type']
+        if t == 'connect':
+            self.connected = True
+        elif t == 'loginPrompt':
+            self.send({'type': 'login', 'name': self.name})
+        elif t == 'init' or t == 'reinit':
+            self.id = m['id']
+            self.game = m['GUIclass']
+            if t == 'reinit' and m.has_key('acct'):
+                self.updateAccount(m['acct'], m.get('acctVersion'), True)
+            self.send({'type': 'ready'})
+        elif t == 'gm':
+            if self.game == 'IslandGUI':
+                self.onIslandMessage(m)
+            else:
+                # Echo, as NetworkTesterGUI does
+                self.send(m)
+        elif t == 'pause':
+            self.stopTrading()
+        elif t == 'error':
+            logger.warning('%s: %s', self.name, m.get('errorString'))
+        elif t == 'endOfExperiment':
+            self.stopTrading()
+            self.communicator.disconnect()
+        elif t == 'disconnect':
+            self.stopTrading()
+            if self.finished.locked():
+                self.finished.release()
+
+    def onIslandMessage(self, m):
+        t = m['subtype']
+        if t == 'initmatch':
+            self.color = m['color']
+        elif t == 'acctUpdate':
+            self.updateAccount(m['acct'], m.get('v'), m.get('full', False))
+        elif t == 'production':
+            choice = None
+            if m['color'] == self.color:
+                choice = self.strategy.chooseProduction(self, m['pf'])
+            self.send({'type': 'gm', 'choice': choice})
+        elif t == 'auction':
+            self.startTrading(m['color'], m.get('market', 'SIMPLE'))
+        elif t == 'timeup':
+            self.stopTrading()
+        elif t in ('bid', 'ask'):
+            self.counts['events'] += 1
+            if m['id'] == self.id:
+                self.answered(m['amount'])
+                self.counts['accepted'] += 1
+        elif t in ('transaction', 'cancel'):
+            self.counts['events'] += 1
+            if t == 'transaction' and self.id in (m['buyerID'],
+                    m['sellerID']):
+                self.counts['trades'] += 1
+        elif t == 'error':
+            self.answered(None)
+            self.counts['rejected'] += 1
+
+    def updateAccount(self, acct, version, full):
+        """ Apply an account update, as the client's AccountPanel does. """
+        if version != None:
+            if version < self.acctVersion or \
+                    (version == self.acctVersion and not full):
+                return
+            self.acctVersion = version
+        self.acct.update(acct)
+
+    def startTrading(self, color, market):
+        self.mktColor = color
+        self.market = market
+        self.side = self.color == color and 'ask' or 'bid'
+        self.pending = []
+        self.trading = True
+        self.schedule()
+
+    def stopTrading(self):
+        self.trading = False
+        if self.call != None:
+            self.call.cancel()
+            self.call = None
+
+    def schedule(self):
+        self.call = self.scheduler.callLater(self.strategy.nextDelay(self),
+                self.submit)
+
+    def submit(self):
+        if not self.trading:
+            return
+        order = self.strategy.makeOrder(self)
+        if order != None:
+            subtype, amount = order
+            m = {'type': 'gm', 'subtype': subtype, 'ct': time.time()}
+            if amount != None:
+                m['amount'] = amount
+                self.pending.append((amount, m['ct']))
+            self.send(m)
+            self.counts['orders'] += 1
+        self.schedule()
+
+    def answered(self, amount):
+        """ Note the server's answer to one of our orders: the announcement of
+        an order of the given amount, or an error (amount None).  Orders sent
+        before the one answered got no answer (the server drops some). """
+        for i, (sentAmount, sentTime) in enumerate(self.pending):
+            if amount == None or sentAmount == amount:
+                self.responseStats.record(time.time() - sentTime)
+                del self.pending[:i + 1]
+                return
+
+def runBots(host, port, specs, count, prefix='bot', seed=None, ramp=0.05,
+        timeout=None):
+    """ Connect count bots to the server and wait until they're finished (or
+    for up to timeout seconds), then return their summary (see
+    summarize()).
+    @param specs: strategy specs (see parseStrategy()), given to the bots in
+    turn
+    @param prefix: bot names are the prefix followed by a number
+    @param seed: if given, bot i's random numbers are seeded with seed + i
+    @param ramp: seconds between connecting one bot and the next """
+    scheduler = servernet.Scheduler()
+    strategyList = [parseStrategy(spec) for spec in specs]
+    bots = []
+    for i in range(count):
+        bot = Bot('%s%d' % (prefix, i + 1), strategyList[i % len(strategyList)],
+                scheduler, None if seed == None else seed + i)
+        bots.append(bot)
+        bot.connect(host, port)
+        time.sleep(ramp)
+    logger.info('%d bots connecting to %s:%d', count, host, port)
+
+    end = None if timeout == None else time.time() + timeout
+    for bot in bots:
+        while not bot.finished.acquire(False):
+            if end != None and time.time() > end:
+                logger.warning('Timed out waiting for %s', bot.name)
+                break
+            time.sleep(0.1)
+    for bot in bots:
+        bot.stopTrading()
+    return summarize(bots)
+
+def summarize(bots):
+    """ Return a summary of what a number of bots did, as a dict: the totals of
+    their counts, 'bots', and the number, total and maximum of the response
+    times, and a sample of recent ones ('responses', 'responseTotal',
+    'responseMax' and 'responseSample'). """
+    summary = {'bots': len(bots), 'responses': 0, 'responseTotal': 0.0,
+            'responseMax': 0.0, 'responseSample': []}
+    for bot in bots:
+        for key, n in bot.counts.iteritems():
+            summary[key] = summary.get(key, 0) + n
+        stats = bot.responseStats
+        summary['responses'] += stats.count
+        summary['responseTotal'] += stats.total
+        summary['responseMax'] = max(summary['responseMax'], stats.max)
+        summary['responseSample'].extend(stats.recent)
+    return summary
+
+def merge(summaries):
+    """ Combine the summaries of several processes' bots. """
+    total = {}
+    for summary in summaries:
+        for key, value in summary.iteritems():
+            if key == 'responseMax':
+                total[key] = max(total.get(key, 0.0), value)
+            elif key == 'responseSample':
+                total[key] = total.get(key, []) + value
+            else:
+                total[key] = total.get(key, 0) + value
+    return total
+
+def report(summary):
+    """ Return a summary as a few lines of text. """
+    sample = sorted(summary['responseSample'])
+    mean = p95 = 0.0
+    if summary['responses']:
+        mean = summary['responseTotal'] / summary['responses']
+    if sample:
+        p95 = sample[min(len(sample) - 1, int(len(sample) * 0.95))]
+    return '%d bots sent %d orders: %d accepted, %d rejected; %d trades, ' \
+            '%d market events received\nResponse time: mean %.2f ms, ' \
+            '95%% %.2f ms, max %.2f ms' % (summary['bots'], summary['orders'],
+                    summary['accepted'], summary['rejected'],
+                    summary['trades'], summary['events'], mean * 1000,
+                    p95 * 1000, summary['responseMax'] * 1000)
+
+def runSlice(args):
+    """ Run one process's share of the bots (in a multiprocessing worker). """
+    log.restart()
+    try:
+        return runBots(*args)
+    finally:
+        log.flush()
+
+def usage():
+    print """
+        Command line options:
+            --host, -H <host>       Server to connect to (default from
+                                    peet/client/config)
+            --port, -p <port>
+            --bots, -n <number>     Number of bots (default 10)
+            --strategy, -s <spec>   Trading strategy: "zi" (zero intelligence;
+                                    settings low, high, delay, cancel) or
+                                    "fixed" (settings rate, price, spread),
+                                    with any settings after a colon, e.g.
+                                    zi:high=5,delay=0.5.  Give more than one
+                                    to mix them.
+            --processes, -j <n>     Spread the bots over n processes
+            --prefix <name>         Bot names start with this (default "bot")
+            --seed <n>              Seed the bots' random numbers
+            --ramp <seconds>        Time between connecting bots (default 0.05)
+            --timeout, -t <seconds> Give up waiting for the session to end
+            --verbose, -v           Log debugging detail
+    """
+
+def main(argv):
+    config = ConfigParser.SafeConfigParser()
+    config.read([
+        'peet/client/config/client-default.ini',
+        'peet/client/config/client.ini'
+        ])
+    host = config.get('Server', 'Host')
+    port = int(config.get('Server', 'Port'))
+    count = 10
+    specs = []
+    processes = 1
+    prefix = 'bot'
+    seed = None
+    ramp = 0.05
+    timeout = None
+
+    try:
+        opts, args = getopt.getopt(argv, "H:p:n:s:j:t:v",
+                ["host=", "port=", "bots=", "strategy=", "processes=",
+                    "prefix=", "seed=", "ramp=", "timeout=", "verbose"])
+        for o, a in opts:
+            if o in ('-H', '--host'):
+                host = a
+            elif o in ('-p', '--port'):
+                port = int(a)
+            elif o in ('-n', '--bots'):
+                count = int(a)
+            elif o in ('-s', '--strategy'):
+                parseStrategy(a)  # Check it now
+                specs.append(a)
+            elif o in ('-j', '--processes'):
+                processes = int(a)
+            elif o == '--prefix':
+                prefix = a
+            elif o == '--seed':
+                seed = int(a)
+            elif o == '--ramp':
+                ramp = float(a)
+            elif o in ('-t', '--timeout'):
+                timeout = float(a)
+            elif o in ('-v', '--verbose'):
+                log.setLevel(log.DEBUG)
+    except (getopt.GetoptError, ValueError, KeyError, TypeError), err:
+        print str(err)
+        usage()
+        sys.exit(2)
+    if not specs:
+        specs = ['zi']
+
+    if processes <= 1:
+        summary = runBots(host, port, specs, count, prefix, seed, ramp,
+                timeout)
+    else:
+        # Each process gets an equal share of the bots, with names (and seeds)
+        # of its own.
+        slices = []
+        for i in range(processes):
+            n = count / processes + (i < count % processes and 1 or 0)
+            slices.append((host, port, specs, n, '%s%d-' % (prefix, i + 1),
+                None if seed == None else seed + i * count, ramp, timeout))
+        pool = multiprocessing.Pool(processes)
+        summary = merge(pool.map(runSlice, slices))
+        pool.close()
+    print report(summary)
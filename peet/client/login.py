@@ -24,6 +24,9 @@ import wx.lib.newevent
 
 from peet.client import clientnet
 from peet.client.gameinterfaces import GameGUI
+from peet.shared import log
+
+logger = log.getLogger('client.login')
 
 reconnectNote = "Note: You do not need to enter your name to reconnect."
 
@@ -41,8 +44,7 @@ class LoginWindow(wx.Frame):
             ])
         self.host = config.get('Server', 'Host')
         self.port = int(config.get('Server', 'Port'))
-        print 'Host = ' + self.host
-        print 'Port = ' + str(self.port)
+        logger.info('Host = %s, Port = %d', self.host, self.port)
 
         self.panel = wx.Panel(self)
 
@@ -134,7 +136,7 @@ class LoginWindow(wx.Frame):
 
     def onNetworkEvent(self, event):
         message = event.message
-        print "server said: " + str(message)
+        logger.debug('server said: %s', message)
 
         if message['type'] == 'init' or message['type'] == 'reinit':
             self.startGUI(message)
@@ -156,7 +158,7 @@ class LoginWindow(wx.Frame):
             if dlg.ShowModal() == wx.ID_OK:
                 selection = dlg.GetSelection()
                 selectedID = disconnectedClients[selection][0]
-                print 'selected id ' + str(selectedID)
+                logger.info('selected id %s', selectedID)
                 self.communicator.send({'type': 'relogin', 'id': selectedID})
             else:
                 # FIXME  User pressed Cancel.  What does that mean?
@@ -0,0 +1,150 @@
+# Copyright 2009 University of Alaska Anchorage Experimental Economics
+# Laboratory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests for the load generator's bots (peet.client.loadgen), against the
+# Island controller's screening of bids and asks.  Run from the top of the
+# source tree:
+#   PYTHONPATH=. python peet/client/test/loadgentest.py
+
+import unittest
+from decimal import Decimal
+
+from peet.client import loadgen
+from peet.server.gamecontrollers.test.islandstub import Controller
+from peet.server import servernet
+
+class Communicator:
+    """ Keeps the messages sent instead of sending them. """
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+class Call:
+    def cancel(self):
+        pass
+
+class Scheduler:
+    """ Keeps the calls scheduled; run() makes the next one. """
+    def __init__(self):
+        self.calls = []
+
+    def callLater(self, delay, function, *args):
+        self.calls.append((function, args))
+        return Call()
+
+    def run(self):
+        function, args = self.calls.pop(0)
+        function(*args)
+
+class LoadGenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.control = Controller()
+
+    def makeBot(self, id, spec):
+        bot = loadgen.Bot('bot%d' % id, loadgen.parseStrategy(spec),
+                Scheduler(), seed=id)
+        bot.communicator = Communicator()
+        for m in ({'type': 'loginPrompt'},
+                {'type': 'init', 'GUIclass': 'IslandGUI', 'id': id,
+                    'name': bot.name},
+                {'type': 'gm', 'subtype': 'initmatch',
+                    'color': self.control.clients[id].color},
+                {'type': 'gm', 'subtype': 'acctUpdate', 'v': 1, 'full': True,
+                    'acct': {'dollars': Decimal('3.00'), 'blue': 1, 'red': 0}},
+                {'type': 'gm', 'subtype': 'auction', 'color': 'blue',
+                    'auctionTime': 60}):
+            bot.onMessage(m)
+        assert bot.communicator.sent == [{'type': 'login', 'name': bot.name},
+                {'type': 'ready'}]
+        return bot
+
+    def orders(self, bot, n):
+        """ Have the bot submit n orders, and return them. """
+        sent = bot.communicator.sent
+        del sent[:]
+        for i in range(n):
+            bot.scheduler.run()
+        return sent
+
+    def test_orders_valid(self):
+        """ Orders pass the server's screening, and bids stay within the
+        bot's dollars. """
+        seller = self.makeBot(0, 'zi:high=10')
+        buyer = self.makeBot(1, 'zi:high=10')
+        fixed = self.makeBot(1, 'fixed:price=2,spread=5')
+        for bot in (seller, buyer, fixed):
+            clientConn = servernet.ClientConnection(bot.id, None, None)
+            orders = self.orders(bot, 50)
+            assert len(orders) == 50
+            for m in orders:
+                assert m['subtype'] == bot.side
+                assert self.control.validateMessage(clientConn, m) == None, m
+                assert m['amount'] == m['amount'].quantize(Decimal('.1'))
+                if bot is buyer:
+                    assert m['amount'] <= 3
+
+    def test_no_chips(self):
+        seller = self.makeBot(0, 'zi')
+        seller.onMessage({'type': 'gm', 'subtype': 'acctUpdate', 'v': 2,
+            'acct': {'blue': 0}})
+        assert self.orders(seller, 10) == []
+
+    def test_stale_account_update(self):
+        bot = self.makeBot(1, 'zi')
+        bot.onMessage({'type': 'gm', 'subtype': 'acctUpdate', 'v': 3,
+            'acct': {'dollars': Decimal('5.00')}})
+        bot.onMessage({'type': 'gm', 'subtype': 'acctUpdate', 'v': 2,
+            'full': True, 'acct': {'dollars': Decimal('1.00')}})
+        assert bot.acct['dollars'] == 5
+
+    def test_responses(self):
+        bot = self.makeBot(1, 'fixed')
+        first, second, third = self.orders(bot, 3)
+        # The first went unanswered; the second is announced.
+        bot.onMessage({'type': 'gm', 'subtype': 'bid', 'id': 1,
+            'amount': second['amount']})
+        assert bot.responseStats.count == 1 and len(bot.pending) == 1
+        bot.onMessage({'type': 'gm', 'subtype': 'error', 'error': 'bidTooLow'})
+        assert bot.responseStats.count == 2 and bot.pending == []
+        assert bot.counts['accepted'] == 1 and bot.counts['rejected'] == 1
+
+    def test_timeup(self):
+        bot = self.makeBot(1, 'zi')
+        bot.onMessage({'type': 'gm', 'subtype': 'timeup'})
+        assert self.orders(bot, 1) == []
+        assert not bot.trading
+
+    def test_base_strategy(self):
+        """ The base Strategy keeps the bot's turns coming but never trades. """
+        bot = self.makeBot(1, 'zi')
+        bot.strategy = loadgen.Strategy()
+        assert bot.strategy.nextDelay(bot) == 1.0
+        assert self.orders(bot, 5) == []
+        assert len(bot.scheduler.calls) == 1
+
+    def test_parse_strategy(self):
+        s = loadgen.parseStrategy('zi:high=5,delay=0.5')
+        assert isinstance(s, loadgen.ZeroIntelligence)
+        assert (s.low, s.high, s.delay) == (0.1, 5, 0.5)
+        assert loadgen.dimes(2.46) == Decimal('2.50')
+        self.assertRaises(KeyError, loadgen.parseStrategy, 'smart')
+        self.assertRaises(TypeError, loadgen.parseStrategy, 'zi:rate=2')
+
+if __name__ == '__main__':
+    unittest.main()
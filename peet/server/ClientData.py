@@ -15,8 +15,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import decimal
+
+from peet.shared import log
 #from peet.shared.util import stepround
 
+logger = log.getLogger('server.game')
+
 D = decimal.Decimal
 
 class ClientData:
@@ -43,6 +47,10 @@ class ClientData:
         self.group = None
         self.replyReceived = None  # Set by GameControl.askAllPlayers()
         self.unansweredMessage = None  # Set by GameControl.askAllPlayers()
+        self.session = None  # servernet.Session, for resuming after a drop
+        # GameControl.SyncedState by message subtype, kept by
+        # GameControl.sendState()
+        self.syncedStates = {}
 
     def setRounding(self, rounding):
         """ Given a string which is one of the keys in
@@ -59,7 +67,7 @@ class ClientData:
         elif rounding == 'DOLLAR_UP':
             self.roundingFunction = roundDollarUp
         else:
-            print "Error in ClientData.setRounding(): unknown rounding option"
+            logger.error('ClientData.setRounding(): unknown rounding option')
             self.roundingFunction = lambda(x): x
 
     def getRoundedEarnings(self):
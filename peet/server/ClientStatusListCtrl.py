@@ -39,7 +39,11 @@ class ClientStatusListCtrl (wx.ListCtrl, ColumnSorterMixin):
         # integers 0 to n.
         self.itemDataMap = {}
 
-        self.numCols = 8  # number of columns
+        self.numCols = 10  # number of columns
+        self.queueCol = 8  # column showing the depth of the send queue
+        # column showing the number of game messages dropped (see
+        # servernet.Communicator.receiveGameMessage())
+        self.droppedCol = 9
     
         # Hard way to create columns, because we need images (sort arrows)
         info = wx.ListItem()
@@ -64,6 +68,10 @@ class ClientStatusListCtrl (wx.ListCtrl, ColumnSorterMixin):
         self.InsertColumnInfo(6, info)
         info.m_text = 'Total Earnings ($)'
         self.InsertColumnInfo(7, info)
+        info.m_text = 'Send Queue'
+        self.InsertColumnInfo(8, info)
+        info.m_text = 'Dropped'
+        self.InsertColumnInfo(9, info)
 
         # This is the widest each column has ever been after an automatic
         # resize.  They will never be auto-resized smaller than this.
@@ -128,7 +136,9 @@ class ClientStatusListCtrl (wx.ListCtrl, ColumnSorterMixin):
                            Decimal('0.00'),
                            Decimal('0.00'),
                            Decimal('0.00'),
-                           Decimal('0.00')]
+                           Decimal('0.00'),
+                           0,
+                           0]
 
         items = self.itemDataMap.items()
         for key, data in items:
@@ -168,12 +178,46 @@ class ClientStatusListCtrl (wx.ListCtrl, ColumnSorterMixin):
         itemPos = self.FindItemData(-1, id)
 
         # Update the representation in the ListCtrl
-        for col in range(self.numCols):
+        for col in range(self.queueCol):
             self.SetStringItem(itemPos, col, str(self.itemDataMap[id][col]))
+        self.updateQueueDepth(client, itemPos)
 
         if self.columnsNeedResize:
             self.resizeColumns()
 
+    def updateQueueDepth(self, client, itemPos=None):
+        """ Show the number of messages waiting to be sent to the client, and
+        highlight the row if the client has fallen behind (see
+        network.SendQueue).  Also show the number of game messages from the
+        client that were dropped. """
+        depth = 0
+        slow = False
+        dropped = 0
+        if client.connection != None:
+            dropped = client.connection.getDropCount()
+            if client.connection.senderThread != None:
+                sender = client.connection.senderThread
+                depth = sender.getQueueDepth()
+                slow = sender.slow
+        self.itemDataMap[client.id][self.queueCol] = depth
+        self.itemDataMap[client.id][self.droppedCol] = dropped
+        if itemPos == None:
+            itemPos = self.FindItemData(-1, client.id)
+        self.SetStringItem(itemPos, self.droppedCol, str(dropped))
+        if slow:
+            self.SetStringItem(itemPos, self.queueCol, '%d (slow)' % depth)
+            self.SetItemTextColour(itemPos, wx.RED)
+        else:
+            self.SetStringItem(itemPos, self.queueCol, str(depth))
+            self.SetItemTextColour(itemPos, wx.BLACK)
+
+    def updateQueueDepths(self, clients):
+        """ Refresh only the Send Queue and Dropped columns.  Called
+        periodically. """
+        for client in clients:
+            if client != None:
+                self.updateQueueDepth(client)
+
     def updateClients(self, clients):
         self.columnsNeedResize = False
         for id, client in enumerate(clients):
@@ -268,7 +312,6 @@ class ClientStatusListCtrl (wx.ListCtrl, ColumnSorterMixin):
             menu.Destroy()
 
     def onDropClicked(self, event):
-        print 'onDropClicked'
         wx.PostEvent(self, ClientListEvent(command='drop',
             id=self.idClicked))
 
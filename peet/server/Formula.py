@@ -0,0 +1,111 @@
+# Copyright 2009 University of Alaska Anchorage Experimental Economics
+# Laboratory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Arithmetic formulas given as parameters (e.g. a scoring formula), checked
+# and compiled once so they can be evaluated cheaply and safely many times.
+
+import ast
+
+class FormulaError(StandardError):
+    pass
+
+# The kinds of syntax a formula may use: arithmetic, comparisons, and/or/not,
+# conditional expressions, and calls to the functions it's given.  No
+# attributes, subscripts, lambdas, comprehensions, strings, etc.
+allowed_nodes = (
+        ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare,
+        ast.IfExp, ast.Call, ast.Name, ast.Num, ast.Tuple, ast.Load,
+        ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+        ast.UAdd, ast.USub, ast.Not, ast.And, ast.Or,
+        ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+        )
+
+class Formula:
+
+    """
+    A formula in terms of some variables, e.g. "d + 10 * min(b, r, g)" in
+    terms of d, b, r and g.  Call it with the values of the variables, in
+    order, to evaluate it, or use evaluateAll() to evaluate it for many sets
+    of values at once.
+    """
+
+    def __init__(self, source, names, functions):
+        """ Check the formula and compile it.  Raise FormulaError if it isn't
+        a valid expression using only allowed syntax (see allowed_nodes), the
+        given variable names, and the given functions.
+        @param source: the formula, a Python expression
+        @param names: the names of the variables, in the order they're passed
+        @param functions: a dictionary of the functions the formula may call,
+            by name """
+        self.source = source
+        self.names = tuple(names)
+        try:
+            tree = ast.parse(source.strip(), '<formula>', 'eval')
+        except SyntaxError, e:
+            raise FormulaError('invalid formula %r: %s' % (source, e.msg))
+
+        for node in ast.walk(tree):
+            if not isinstance(node, allowed_nodes):
+                raise FormulaError('%s not allowed in formula %r' %
+                        (node.__class__.__name__, source))
+            if isinstance(node, ast.Name) and not (node.id in self.names or
+                    node.id in functions):
+                raise FormulaError('unknown name %r in formula %r' %
+                        (node.id, source))
+            if isinstance(node, ast.Call) and not (
+                    isinstance(node.func, ast.Name) and
+                    node.func.id in functions and not node.keywords and
+                    node.starargs == None and node.kwargs == None):
+                raise FormulaError('only plain calls to %s allowed in '
+                        'formula %r' % (', '.join(sorted(functions)), source))
+
+        # The formula is safe to evaluate with nothing but the functions in
+        # scope, as
+        #   lambda <names>: <formula>
+        # and, for evaluateAll(),
+        #   lambda rows: [<formula> for <names> in rows]
+        namespace = {'__builtins__': {}}
+        namespace.update(functions)
+        params = ast.arguments(
+                args=[ast.Name(id=name, ctx=ast.Param()) for name in self.names],
+                vararg=None, kwarg=None, defaults=[])
+        self.evaluate = self.compileLambda(params, tree.body, namespace)
+
+        target = ast.Tuple(
+                elts=[ast.Name(id=name, ctx=ast.Store()) for name in self.names],
+                ctx=ast.Store())
+        rows = ast.Name(id='rows', ctx=ast.Load())
+        listComp = ast.ListComp(elt=tree.body, generators=[
+            ast.comprehension(target=target, iter=rows, ifs=[])])
+        params = ast.arguments(args=[ast.Name(id='rows', ctx=ast.Param())],
+                vararg=None, kwarg=None, defaults=[])
+        self.evaluateAll = self.compileLambda(params, listComp, namespace)
+
+    def compileLambda(self, params, body, namespace):
+        """ Return the function given by a lambda with the given arguments and
+        body, evaluated in namespace. """
+        expression = ast.Expression(body=ast.Lambda(args=params, body=body))
+        ast.fix_missing_locations(expression)
+        # dont_inherit, so that this module's __future__ imports (if any) don't
+        # change the meaning of the formula.
+        return eval(compile(expression, '<formula>', 'eval', 0, True),
+                namespace)
+
+    def __call__(self, *values):
+        return self.evaluate(*values)
+
+    def __str__(self):
+        return self.source
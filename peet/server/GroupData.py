@@ -16,6 +16,10 @@
 
 import random
 
+from peet.shared import log
+
+logger = log.getLogger('server.game')
+
 def makeGroups(num):
     """ Return a list of newly created groups.  Each group's id attribute is set
     to its index in the list.  The game controller class should use this.  Does
@@ -58,11 +62,10 @@ def groupClients_simple(clients, groupSize=None, numGroups=None):
         group.assignClients(groupClients)
 
     # Check group assignments
-    print 'groupClients_simple: '
-    for group in groups:
-        print "group ", group.id
-        for client in group.clients:
-            print 'client ', client.id
+    if logger.isEnabledFor(log.DEBUG):
+        for group in groups:
+            logger.debug('groupClients_simple: group %d: clients %s', group.id,
+                    [client.id for client in group.clients])
     
     return groups
 
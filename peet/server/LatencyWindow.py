@@ -0,0 +1,151 @@
+# Copyright 2009 University of Alaska Anchorage Experimental Economics
+# Laboratory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A window showing live histograms of the game's timings (see
+# GameControl.getLatencyStats()), and each client's timings, so that slow
+# stations stand out.
+
+import wx
+
+histogram_edges = (0, .001, .002, .005, .01, .02, .05, .1, .2, .5, 1)
+""" The lower edges of the histogram bins, in seconds """
+
+refresh_interval = 1000
+""" How often the window is brought up to date, in milliseconds """
+
+class HistogramPanel(wx.Panel):
+
+    """ Draws a histogram of the recent values of one LatencyStats. """
+
+    def __init__(self, parent, name, stats):
+        wx.Panel.__init__(self, parent, wx.ID_ANY, size=(440, 120))
+        self.name = name
+        self.stats = stats
+        self.counts = [0] * len(histogram_edges)
+        self.Bind(wx.EVT_PAINT, self.onPaint)
+
+    def refresh(self):
+        self.counts = self.stats.getHistogram(histogram_edges)
+        self.Refresh()
+
+    def onPaint(self, event):
+        dc = wx.PaintDC(self)
+        width, height = self.GetClientSize()
+        dc.SetFont(wx.Font(8, wx.FONTFAMILY_SWISS, wx.FONTSTYLE_NORMAL,
+            wx.FONTWEIGHT_NORMAL))
+        dc.DrawText('%s: mean %.2f ms, 95%% %.2f ms, max %.2f ms' % (self.name,
+            self.stats.getMean() * 1000, self.stats.getPercentile(95) * 1000,
+            self.stats.max * 1000), 0, 0)
+
+        # Bars from the top text down to the labels of the bins
+        top = 16
+        bottom = height - 14
+        barWidth = width / len(self.counts)
+        highest = max(self.counts) or 1
+        dc.SetBrush(wx.Brush('steel blue'))
+        for i, count in enumerate(self.counts):
+            x = i * barWidth
+            barHeight = (bottom - top) * count / highest
+            if barHeight > 0:
+                dc.DrawRectangle(x + 1, bottom - barHeight, barWidth - 2,
+                        barHeight)
+            edge = histogram_edges[i] * 1000
+            dc.DrawText(edge < 1 and '%g' % edge or '%d' % edge, x + 1,
+                    bottom + 1)
+
+class LatencyWindow(wx.Frame):
+
+    """
+    Shows the timings the game controller keeps.  Opened from the server
+    window's Latency button.
+    """
+
+    def __init__(self, parent, gameController, clients):
+        """
+        @param gameController: the GameControl of the session
+        @param clients: the list of ClientData (or None, for clients not yet
+        connected) the server keeps
+        """
+        wx.Frame.__init__(self, parent, wx.ID_ANY, 'Latency (ms)',
+                size=(480, 700))
+        self.gameController = gameController
+        self.clients = clients
+
+        self.panel = wx.ScrolledWindow(self)
+        self.panel.SetScrollRate(0, 10)
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        self.histograms = []
+        for name, stats in gameController.getLatencyStats():
+            histogram = HistogramPanel(self.panel, name, stats)
+            self.histograms.append(histogram)
+            sizer.Add(histogram, 0, wx.EXPAND|wx.ALL, 4)
+
+        # Each client's timings: mean and 95th percentile of each
+        self.listCtrl = wx.ListCtrl(self.panel, wx.ID_ANY, size=(-1, 200),
+                style=wx.LC_REPORT)
+        sizer.Add(self.listCtrl, 1, wx.EXPAND|wx.ALL, 4)
+        self.columnNames = None
+
+        self.panel.SetSizer(sizer)
+
+        self.timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.onTimer, self.timer)
+        self.Bind(wx.EVT_CLOSE, self.onClose)
+        self.refresh()
+        self.timer.Start(refresh_interval)
+
+    def onTimer(self, event):
+        self.refresh()
+
+    def onClose(self, event):
+        self.timer.Stop()
+        self.Destroy()
+
+    def refresh(self):
+        for histogram in self.histograms:
+            histogram.refresh()
+
+        rows = []
+        for client in self.clients:
+            if client == None:
+                continue
+            stats = self.gameController.getClientLatencyStats(client)
+            if not stats:
+                continue
+            if self.columnNames == None:
+                self.setColumns([name for name, s in stats])
+            row = [str(client.id + 1), client.name or '']
+            for name, s in stats:
+                row.append('%.2f' % (s.getMean() * 1000))
+                row.append('%.2f' % (s.getPercentile(95) * 1000))
+            rows.append(row)
+
+        for i, row in enumerate(rows):
+            if i >= self.listCtrl.GetItemCount():
+                self.listCtrl.InsertStringItem(i, row[0])
+            for col, text in enumerate(row):
+                self.listCtrl.SetStringItem(i, col, text)
+
+    def setColumns(self, names):
+        self.columnNames = names
+        self.listCtrl.InsertColumn(0, 'ID')
+        self.listCtrl.InsertColumn(1, 'Name')
+        for name in names:
+            col = self.listCtrl.GetColumnCount()
+            self.listCtrl.InsertColumn(col, name + ' mean',
+                    wx.LIST_FORMAT_RIGHT)
+            self.listCtrl.InsertColumn(col + 1, name + ' 95%',
+                    wx.LIST_FORMAT_RIGHT)
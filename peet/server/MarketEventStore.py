@@ -0,0 +1,177 @@
+# Copyright 2009 University of Alaska Anchorage Experimental Economics
+# Laboratory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A compact store of market events (bids, asks, transactions, cancellations)
+# for the whole session.
+
+import array
+from decimal import Decimal
+
+actions = ('bid', 'ask', 'accept', 'cancel')
+""" The kinds of market event, in the order they're numbered in the store """
+
+timings = ('Latency', 'QueueWait', 'Processing', 'FanOut')
+""" The timing columns of the market history output file, in milliseconds:
+how long the message that caused the event took to reach the server from the
+client, waited in the server's queue and took to handle, and how long it took
+to send the event to every client in the group (see IslandControl) """
+
+# Where an event has no buyer, seller or price
+none = -1
+
+max_price = Decimal('21474836.47')
+""" The highest price the store can hold (prices are kept in cents, as 32-bit
+integers) """
+
+class MarketEventStore:
+
+    """
+    The market events of a session (e.g. for one group), as parallel arrays of
+    action number, buyer ID, seller ID, price in cents and time, and of the
+    event's timings (in seconds; NaN where unknown).  The events
+    of each match, round and market are found by the ranges of the arrays
+    they occupy, so a round's events can be got without searching.
+
+    Events come out in the form IslandControl has always kept them in: a dict
+    with 'Action', and 'Buyer', 'Bid', 'Accept', 'Ask', 'Seller' and 'Time' as
+    they apply.
+    """
+
+    def __init__(self):
+        self.action = array.array('B')
+        self.buyer = array.array('i')
+        self.seller = array.array('i')
+        self.price = array.array('i')
+        self.time = array.array('d')
+        self.timings = dict([(name, array.array('f')) for name in timings])
+
+        # Lists of [start, end) ranges of the arrays, by (match, round,
+        # market).  Normally a market's events in a round are all together, in
+        # one range.
+        self.ranges = {}
+        self.lastKey = None  # Key of the range appended to last
+        self.rounds = []  # (match, round) of each round, in order
+
+    def startRound(self, match, round):
+        """ Note the start of a round, so that it's part of the history (see
+        getHistory()) even if it has no events. """
+        self.rounds.append((match, round))
+
+    def append(self, match, round, market, action, buyer=None, seller=None,
+            price=None, time=None, timing=None):
+        """ Add an event, and return its number.
+        @param action: one of actions
+        @param buyer, seller: client IDs
+        @param price: a Decimal amount of dollars
+        @param time: the market time of the event, in seconds
+        @param timing: (latency, queue wait, processing time) in seconds, any
+        of them None if unknown; the fan out time is set later, with
+        setFanOut() """
+        # Work out every column before appending to any, so that an event
+        # that can't be stored leaves the arrays in step.
+        if price != None and not 0 <= price <= max_price:
+            raise ValueError('price out of range: %s' % price)
+        if timing == None:
+            timing = (None, None, None)
+        row = (actions.index(action), none if buyer == None else buyer,
+                none if seller == None else seller,
+                none if price == None else int(price * 100),
+                float('nan') if time == None else time)
+        row += tuple([float('nan') if value == None else value
+            for value in timing + (None,)])
+
+        key = (match, round, market)
+        n = len(self.action)
+        columns = [self.action, self.buyer, self.seller, self.price,
+                self.time] + [self.timings[name] for name in timings]
+        for column, value in zip(columns, row):
+            column.append(value)
+        if key == self.lastKey:
+            self.ranges[key][-1][1] = n + 1
+        else:
+            self.ranges.setdefault(key, []).append([n, n + 1])
+            self.lastKey = key
+        return n
+
+    def setFanOut(self, i, seconds):
+        """ Set how long event number i took to send to every client. """
+        self.timings['FanOut'][i] = seconds
+
+    def getEvent(self, i):
+        """ Return event number i as a dict. """
+        action = actions[self.action[i]]
+        event = {'Action': action}
+        if self.buyer[i] != none:
+            event['Buyer'] = self.buyer[i]
+        if self.seller[i] != none:
+            event['Seller'] = self.seller[i]
+        if self.price[i] != none:
+            # Cents back to dollars, e.g. 520 -> Decimal('5.20')
+            price = Decimal(self.price[i]).scaleb(-2)
+            if action == 'bid':
+                event['Bid'] = price
+            elif action == 'ask':
+                event['Ask'] = price
+            else:
+                event['Accept'] = price
+        if self.time[i] == self.time[i]:  # (not NaN)
+            event['Time'] = self.time[i]
+        return event
+
+    def getIndexes(self, match, round, market):
+        """ Return the event numbers of a market in a round, in order. """
+        indexes = []
+        for start, end in self.ranges.get((match, round, market), ()):
+            indexes.extend(xrange(start, end))
+        return indexes
+
+    def getEvents(self, match, round, market):
+        """ Return a list of the events of a market in a round. """
+        return [self.getEvent(i)
+                for i in self.getIndexes(match, round, market)]
+
+    def getRound(self, match, round):
+        """ Return the events of a round by market, as in the reinit
+        message. """
+        return {'blue': self.getEvents(match, round, 'blue'),
+                'red': self.getEvents(match, round, 'red')}
+
+    def getHistory(self):
+        """ Return every round's events, as history[match][round]{market}. """
+        history = []
+        for match, round in self.rounds:
+            while len(history) <= match:
+                history.append([])
+            history[match].append(self.getRound(match, round))
+        return history
+
+    def iterRows(self, match, round, market, fields):
+        """ Generate rows of the market history output file for a market in a
+        round: the events, with client IDs counting from 1 and the given
+        fields (e.g. 'Match' and 'Round') added, and the timings in
+        milliseconds. """
+        for i in self.getIndexes(match, round, market):
+            row = self.getEvent(i)
+            row.update(fields)
+            row['Buyer'] = row['Buyer'] + 1 if row.has_key('Buyer') else ''
+            row['Seller'] = row['Seller'] + 1 if row.has_key('Seller') else ''
+            for name in timings:
+                value = self.timings[name][i]
+                row[name] = '%.3f' % (value * 1000) if value == value else ''
+            yield row
+
+    def __len__(self):
+        return len(self.action)
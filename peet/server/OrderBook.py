@@ -0,0 +1,151 @@
+# Copyright 2009 University of Alaska Anchorage Experimental Economics
+# Laboratory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A limit order book for a continuous double auction, with price-time priority.
+
+import heapq
+import itertools
+
+class Order:
+
+    """
+    A standing order for one unit, at a limit price.  side is 'bid' or 'ask';
+    trader is whoever placed it (e.g. a ClientData).
+    """
+
+    def __init__(self, seq, trader, side, price, time):
+        self.seq = seq  # Orders placed earlier have lower numbers
+        self.trader = trader
+        self.side = side
+        self.price = price
+        self.time = time
+        self.active = True  # False once the order trades or is cancelled
+
+class OrderBook:
+
+    """
+    The standing bids and asks in a market.  Bids and asks are kept in heaps,
+    best price first and earliest first among equal prices, so placing an
+    order and matching it are O(log n).  Each trader has at most one order on
+    each side; placing another replaces it.
+
+    Orders that trade or are cancelled are left in the heap, marked inactive,
+    and dropped when they reach the top (or when the heap is rebuilt because
+    too many of them have piled up).
+    """
+
+    def __init__(self):
+        self.bids = []  # Heap of (-price, seq, order)
+        self.asks = []  # Heap of (price, seq, order)
+        self.heaps = {'bid': self.bids, 'ask': self.asks}
+        self.inactive = {'bid': 0, 'ask': 0}  # Inactive orders in the heaps
+        self.orders = {}  # Active order by (trader, side)
+        self.seq = itertools.count()
+
+    def place(self, trader, side, price, time=None):
+        """ Place an order, replacing the trader's standing order on the same
+        side, if any.  If it crosses the best order on the other side, the two
+        trade at the standing order's price.
+        @param side: 'bid' or 'ask'
+        @return: (order, trade), where trade is None or a tuple
+            (buyer, seller, price) """
+        self.cancel(trader, side)
+        order = Order(self.seq.next(), trader, side, price, time)
+
+        if side == 'bid':
+            best = self.getBest('ask')
+            if best != None and best.price <= price:
+                self.remove(best)
+                order.active = False
+                return order, (trader, best.trader, best.price)
+            heapq.heappush(self.bids, (-price, order.seq, order))
+        else:
+            best = self.getBest('bid')
+            if best != None and best.price >= price:
+                self.remove(best)
+                order.active = False
+                return order, (best.trader, trader, best.price)
+            heapq.heappush(self.asks, (price, order.seq, order))
+
+        self.orders[(trader, side)] = order
+        return order, None
+
+    def cancel(self, trader, side=None):
+        """ Cancel the trader's standing order on the given side, or on both
+        sides if side is None.  Return the list of orders cancelled. """
+        cancelled = []
+        for s in side and (side,) or ('bid', 'ask'):
+            order = self.orders.get((trader, s))
+            if order != None:
+                self.remove(order)
+                cancelled.append(order)
+        return cancelled
+
+    def remove(self, order):
+        """ Take an active order off the book. """
+        order.active = False
+        del self.orders[(order.trader, order.side)]
+        self.inactive[order.side] += 1
+        heap = self.heaps[order.side]
+        if self.inactive[order.side] > len(heap) / 2:
+            # Mostly dead weight; rebuild the heap from the active orders.
+            heap[:] = [entry for entry in heap if entry[2].active]
+            heapq.heapify(heap)
+            self.inactive[order.side] = 0
+
+    def getBest(self, side):
+        """ Return the best active order on the given side, or None. """
+        heap = self.heaps[side]
+        while heap and not heap[0][2].active:
+            heapq.heappop(heap)
+            self.inactive[side] -= 1
+        if heap:
+            return heap[0][2]
+        return None
+
+    def getOrder(self, trader, side):
+        """ Return the trader's standing order on the given side, or None. """
+        return self.orders.get((trader, side))
+
+    def getDepth(self, side, levels):
+        """ Return the best few price levels on the given side, best first, as
+        a list of (price, number of orders) tuples.
+        @param levels: the most price levels to return """
+        heap = self.heaps[side]
+        depth = []
+        # The orders at the best few price levels are among the best
+        # (levels * orders per level) entries, so widen the search until
+        # enough levels are complete or the heap is exhausted.
+        n = levels
+        while True:
+            entries = heapq.nsmallest(n, heap)
+            depth = []
+            for entry in entries:
+                order = entry[2]
+                if not order.active:
+                    continue
+                if depth and depth[-1][0] == order.price:
+                    depth[-1] = (order.price, depth[-1][1] + 1)
+                elif len(depth) < levels:
+                    depth.append((order.price, 1))
+                else:
+                    return depth
+            if n >= len(heap):
+                return depth
+            n *= 2
+
+    def __len__(self):
+        return len(self.orders)
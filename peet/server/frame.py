@@ -27,7 +27,6 @@ import csv
 from decimal import Decimal
 import re
 import json
-import threading
 import wx
 import wx.lib.newevent
 
@@ -38,12 +37,17 @@ import peet.server.gamecontrollers
 from peet.server.ClientData import ClientData
 from peet.server import ClientStatusListCtrl
 from peet.server import survey
+from peet.server.LatencyWindow import LatencyWindow
+from peet.shared import log
+
+logger = log.getLogger('server.frame')
 
 # Custom wx events for network events (client connects, messages, etc.)
 NetworkEvent, EVT_NETWORK = wx.lib.newevent.NewEvent()
 
 # Constants
 loginTimeout = 5
+outputTimeout = 30  # seconds to wait on closing for output files to be written
 
 class Frame(wx.Frame):
     def __init__(self,parent,id,title):
@@ -55,7 +59,11 @@ class Frame(wx.Frame):
         self.paramsModified = False
         self.paramsReadOnly = False
         self.outputDir = None
+        self.gameController = None
         self.clients = []
+        # Timers for connections made during the game, given until
+        # loginTimeout to resume (see onReconnectTimeout())
+        self.reconnectTimers = {}
         self.roundNum = 0
 
         self.chatEnabled = False
@@ -142,12 +150,15 @@ class Frame(wx.Frame):
         #msgButton = wx.Button(self.panel, label="Send message")
         self.nextRoundButton = wx.Button(self.panel, label="Next Round")
         self.pauseButton = wx.Button(self.panel, wx.ID_ANY, "Pause")
+        self.latencyButton = wx.Button(self.panel, wx.ID_ANY, "Latency")
+        self.latencyButton.Enable(False)
         hbox = wx.BoxSizer(wx.HORIZONTAL)
         hbox.Add(self.connectButton)
         #hbox.Add(msgButton)
         hbox.Add(self.startButton)
         hbox.Add(self.nextRoundButton)
         hbox.Add(self.pauseButton)
+        hbox.Add(self.latencyButton)
         #hbox.Add(self.writeButton)
         self.nextRoundButton.Enable(False)
         bsizer.Add(hbox)
@@ -162,6 +173,7 @@ class Frame(wx.Frame):
         self.Bind(wx.EVT_BUTTON, self.onStartClicked, self.startButton)
         self.Bind(wx.EVT_BUTTON, self.onNextRoundClicked, self.nextRoundButton)
         self.Bind(wx.EVT_BUTTON, self.onPauseClicked, self.pauseButton)
+        self.Bind(wx.EVT_BUTTON, self.onLatencyClicked, self.latencyButton)
         #self.Bind(wx.EVT_BUTTON, self.onWriteClicked, self.writeButton)
 
         # Status box
@@ -171,6 +183,8 @@ class Frame(wx.Frame):
         self.roundLabel = wx.StaticText(self.panel, wx.ID_STATIC,
                                             "Round -")
         bsizer.Add(self.roundLabel)
+        self.routedLabel = wx.StaticText(self.panel, wx.ID_STATIC, " ")
+        bsizer.Add(self.routedLabel)
         self.listCtrl = ClientStatusListCtrl.ClientStatusListCtrl(self.panel,
                 wx.ID_ANY, style=wx.LC_REPORT)
         bsizer.Add(self.listCtrl, 1, wx.EXPAND)
@@ -188,22 +202,52 @@ class Frame(wx.Frame):
         bsizer.Add(self.messageBox, 1, wx.EXPAND)
         mainSizer.Add(bsizer, 1, flag=wx.EXPAND|wx.ALL, border=borderSize)
 
-        # Set up networking
-        self.communicator = servernet.Communicator(
-                port = 9123,
-                postEvent = self.postNetworkEvent)
-        self.Bind(EVT_NETWORK, self.onNetworkEvent)
-
         # Get command line options
         self.autostart = False
         try:
-            opts, args = getopt.getopt(sys.argv[1:], "g:p:o:a",
-                    ["game=", "paramfile=", "outdir=", "autostart"])
+            opts, args = getopt.getopt(sys.argv[1:], "g:p:o:aes:v",
+                    ["game=", "paramfile=", "outdir=", "autostart",
+                        "eventloop", "slowpolicy=", "verbose"])
         except getopt.GetoptError, err:
             # print help information and exit:
             print str(err)
             self.usage()
             sys.exit(2)
+
+        for o, a in opts:
+            if o in ('-v', '--verbose'):
+                log.setLevel(log.DEBUG)
+
+        # Set up networking.  The transport has to be chosen before the
+        # remaining options are processed, because --autostart connects.
+        communicatorClass = servernet.Communicator
+        for o, a in opts:
+            if o in ('-e', '--eventloop'):
+                communicatorClass = servernet.EventLoopCommunicator
+        self.communicator = communicatorClass(
+                port = 9123,
+                postEvent = self.postNetworkEvent)
+        for o, a in opts:
+            if o in ('-s', '--slowpolicy'):
+                if a not in servernet.slow_policies:
+                    self.usage()
+                    sys.exit(2)
+                self.communicator.slowClientPolicy = a
+        self.Bind(EVT_NETWORK, self.onNetworkEvent)
+        # Chat is relayed in the network threads, without a trip through the
+        # GUI thread.
+        self.communicator.router.route('chat', self.relayChat)
+
+        # True while the session is paused because a client fell behind (with
+        # the SLOW_PAUSE policy)
+        self.slowPaused = False
+
+        # Refresh the Send Queue column of the client list, and the count of
+        # messages handled without the GUI, every second.
+        self.queueTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.onQueueTimer, self.queueTimer)
+        self.queueTimer.Start(1000)
+
         for o, a in opts:
             if o in ('-g', '--game'):
                 className = a + 'Control'
@@ -241,15 +285,36 @@ class Frame(wx.Frame):
                 --paramfile, -p <filename>
                 --outdir, -o <directory name>
                 --autostart, -a  Automatically connect and start game
+                --eventloop, -e  Serve all clients from a single event-loop
+                                 thread instead of two threads per client
+                --slowpolicy, -s <policy>  What to do when a client falls
+                                 behind: "collapse" (default) drops outdated
+                                 messages queued for it, "pause" pauses the
+                                 session until it catches up
+                --verbose, -v    Log debugging detail (e.g. every message
+                                 received) to the console
         """
 
     def onClose(self, event):
-        print 'onClose'
+        logger.debug('onClose')
         dlg = wx.MessageDialog(self, 'Are you sure you want to quit?',\
                 'Confirm Quit', wx.YES_NO|wx.ICON_QUESTION)
         if dlg.ShowModal() == wx.ID_YES:
             event.Skip()
-        dlg.Destroy()
+            dlg.Destroy()
+            if self.gameController != None:
+                busy = wx.BusyCursor()
+                finished = self.gameController.stopOutput(outputTimeout)
+                del busy
+                if not finished:
+                    dlg = wx.MessageDialog(self, 'The output files are still '
+                            'being written, and may be incomplete.',
+                            'Error: Output not finished',
+                            wx.OK | wx.ICON_ERROR)
+                    dlg.ShowModal()
+                    dlg.Destroy()
+        else:
+            dlg.Destroy()
 
     def postNetworkEvent(self, clientConn, message):
         """ called by the Communicator when something happens """
@@ -257,11 +322,15 @@ class Frame(wx.Frame):
         wx.PostEvent(self, event)
 
     def onClientListEvent(self, event):
-        print 'onClientListEvent: command = %s, id = %d' % (event.command,
-                event.id)
+        logger.debug('onClientListEvent: command = %s, id = %d',
+                event.command, event.id)
 
         if event.command == 'drop':
             if self.clients[event.id] != None:
+                if self.clients[event.id].session != None:
+                    # Don't let it resume.
+                    self.communicator.endSession(self.clients[event.id].session)
+                    self.clients[event.id].session = None
                 if self.clients[event.id].connection != None:
                     self.clients[event.id].connection.close()
                 if not self.gameController.running:
@@ -278,9 +347,10 @@ class Frame(wx.Frame):
         #print "onNetworkEvent"
         clientConn = event.clientConn
         message = event.message
-        if clientConn != None and message.get('type') != 'ping':
+        if clientConn != None and message.get('type') != 'ping' and \
+                logger.isEnabledFor(log.DEBUG):
             clientId = clientConn.id+1 if clientConn.id != None else "(no ID)"
-            print 'client ', clientId, ': ', message
+            logger.debug('client %s: %s', clientId, message)
         t = message.get('type')
 
         if t == 'connect':
@@ -292,11 +362,7 @@ class Frame(wx.Frame):
                     # No open slots - close the connection.
                     m = {'type': 'error',
                             'errorString': "There are no more available slots."}
-                    self.communicator.send(clientConn, m)
-                    # Make sure the error message is sent before disconnecting
-                    # FIXME: must be a better way.
-                    time.sleep(1)
-                    clientConn.close()
+                    clientConn.closeWhenSent(m)
                 else:
                     # Create the ClientData and assign it to the first open
                     # slot.
@@ -314,27 +380,22 @@ class Frame(wx.Frame):
 
                     # Set a timer that will run while waiting for the expected
                     # login message.
-                    client.loginTimer = threading.Timer(loginTimeout,
-                            self.onLoginTimeout, [client])
-                    client.loginTimer.start()
+                    client.loginTimer = self.communicator.scheduler.callLater(
+                            loginTimeout, wx.CallAfter, self.onLoginTimeout,
+                            client)
             else:
                 # The game is in progress, so treat this as a reconnect.
-                clientsDisconnected = False
-                for c in self.clients:
-                    if c.connection == None:
-                        clientsDisconnected = True
-                if not clientsDisconnected:
-                    # No disconnected clients - close the connection.
-                    m = {'type': 'error',
-                            'errorString': 'There are no disconnected clients.'}
-                    self.communicator.send(clientConn, m)
-                    # Make sure the error message is sent before disconnecting
-                    # FIXME: must be a better way.
-                    time.sleep(1)
-                    clientConn.close()
-                else:
+                if self.anyClientDisconnected():
                     # Send the relogin prompt
                     self.promptRelogin(clientConn)
+                else:
+                    # It may be a client resuming before we've noticed its
+                    # old connection drop, so give it until loginTimeout to
+                    # resume before turning it away.
+                    self.reconnectTimers[clientConn] = \
+                            self.communicator.scheduler.callLater(loginTimeout,
+                                    wx.CallAfter, self.onReconnectTimeout,
+                                    clientConn)
 
         elif t == 'login':
 
@@ -361,12 +422,7 @@ class Frame(wx.Frame):
                 # the client and drop the client.
 
                 m = {'type': 'error', 'errorString': errorString}
-                self.communicator.send(clientConn, m)
-
-                # Make sure the error message is sent before disconnecting
-                # FIXME: must be a better way.
-                time.sleep(1)
-                clientConn.close()
+                clientConn.closeWhenSent(m)
 
                 # If the game has not started yet, delete the client entirely.
                 # (Otherwise, the connection has no id and is not associated
@@ -384,9 +440,10 @@ class Frame(wx.Frame):
                 client.loginTimer.cancel()
                 client.loginTimer = None
                 client.name = message.get('name')
+                client.session = self.communicator.startSession(clientConn)
                 self.listCtrl.updateClient(client)
                 if self.allClientsLoggedIn():
-                    print 'All clients logged in.'
+                    logger.info('All clients logged in.')
                     self.postMessage("All clients logged in.")
                     self.startButton.Enable(True)
                     if self.autostart:
@@ -398,7 +455,7 @@ class Frame(wx.Frame):
 
             if not self.gameController.running:
                 # This is an initial ready message
-                print 'initial ready message'
+                logger.debug('initial ready message')
                 self.gameController.clientReady(clientConn)
 
             else:
@@ -414,27 +471,28 @@ class Frame(wx.Frame):
                 if not clientsStillDisconnected:
                     self.pauseButton.Enable()
 
-        elif t == 'chat':
-            if self.chatEnabled:
-                self.forwardChatMessage(clientConn, message)
-
-                # Append to chat history for chat output file
+        elif t == 'history':
+            # The client wants the history that its reinit message left out.
+            if self.gameController.running and clientConn.id != None:
                 client = self.clients[clientConn.id]
-                if client.group == None:
-                    groupID = ''
-                else:
-                    groupID = str(client.group.id + 1)
-                row = [self.sessionID, self.experimentID,\
-                        self.roundNum+1, clientConn.id+1, groupID,
-                        message['message']]
-                self.chatHistory.append(row)
+                if client != None and client.connection is clientConn:
+                    self.communicator.send(clientConn,
+                            self.gameController.getHistory(client))
 
         elif t == 'disconnect':
 
+            if clientConn.senderThread != None:
+                logger.info('Sent to client %s: %s', clientConn.id,
+                        clientConn.senderThread.stats)
+
             if not self.gameController.running:
                 # Client has disconnected before game has started, so delete the
-                # client
-                if clientConn.id != None:
+                # client.  (A client turned away at login has had its slot
+                # freed already, and the slot may have gone to a new client
+                # since.)
+                if clientConn.id != None and \
+                        self.clients[clientConn.id] != None and \
+                        self.clients[clientConn.id].connection is clientConn:
                     self.clients[clientConn.id] = None
                 clientConn.close()
                 self.listCtrl.updateClients(self.clients)
@@ -443,11 +501,17 @@ class Frame(wx.Frame):
                 # Game is in progress
 
                 clientConn.close()
+                self.cancelReconnectTimer(clientConn)
 
                 if clientConn.id == None:
                     # The disconnected client has no id, which probably means it
                     # disconnected before sending the relogin message.
-                    print "A client with no ID has disconnected."
+                    logger.info('A client with no ID has disconnected.')
+
+                elif self.clients[clientConn.id].connection is not clientConn:
+                    # The client has already resumed on a new connection.
+                    logger.info('Old connection of client %d closed',
+                            clientConn.id+1)
 
                 else:
                     # Pause and don't allow unpausing until client has
@@ -467,6 +531,74 @@ class Frame(wx.Frame):
                     dlg.ShowModal()
                     dlg.Destroy()
             
+        elif t == 'resume':
+            # A client that lost its connection has reconnected and wants to
+            # pick up where it left off (see servernet.Session).
+            session = self.communicator.getSession(message.get('token'))
+            client = None
+            if session != None and self.gameController.running:
+                for c in self.clients:
+                    if c != None and c.session is session:
+                        client = c
+            if client != None and self.communicator.resumeSession(clientConn,
+                    session, message.get('seq')):
+                oldConn = client.connection
+                self.cancelReconnectTimer(clientConn)
+                clientConn.id = client.id
+                client.connection = clientConn
+                client.status = 'Connected'
+                self.listCtrl.updateClient(client)
+                self.postMessage("Client " + str(client.id+1) + " resumed")
+                if oldConn != None:
+                    # The server hadn't noticed the old connection drop yet.
+                    oldConn.close()
+                if self.communicator.paused:
+                    # It missed the pause message.
+                    self.communicator.send(clientConn, {'type': 'pause'})
+                    clientsStillDisconnected = False
+                    for c in self.clients:
+                        if c.status == 'Disconnected':
+                            clientsStillDisconnected = True
+                            break
+                    if not clientsStillDisconnected:
+                        self.pauseButton.Enable()
+            else:
+                # The client will reconnect the old way.
+                self.communicator.send(clientConn, {'type': 'resumeFailed'})
+
+        elif t == 'slow':
+            # The client's send queue has grown past its limit, or drained
+            # again.
+            if clientConn.id != None:
+                client = self.clients[clientConn.id]
+                if client != None and client.connection is clientConn:
+                    self.listCtrl.updateQueueDepth(client)
+                clientName = "Client " + str(clientConn.id+1)
+            else:
+                clientName = "A client with no ID"
+            if message['slow']:
+                self.postMessage("%s is falling behind (%d messages queued)"
+                        % (clientName, message['depth']))
+                if self.communicator.slowClientPolicy == servernet.SLOW_PAUSE\
+                        and self.gameController.running\
+                        and not self.communicator.paused:
+                    self.slowPaused = True
+                    self.communicator.pause()
+                    self.gameController.onPause()
+                    self.pauseClients()
+                    self.pauseButton.SetLabel("Unpause")
+            else:
+                self.postMessage("%s has caught up" % clientName)
+                # Resume if the pause was ours, nobody else is behind, and
+                # nothing else (like a disconnect) is holding the pause.
+                if self.slowPaused and self.communicator.paused\
+                        and self.pauseButton.IsEnabled()\
+                        and not self.anyClientSlow():
+                    self.slowPaused = False
+                    self.communicator.unpause()
+                    self.gameController.onUnpause()
+                    self.pauseButton.SetLabel("Pause")
+
         elif t == 'relogin':
             # Reconnecting client's response to 'whoareyou'.
             # Check for valid selection
@@ -481,10 +613,12 @@ class Frame(wx.Frame):
                         and clientID >= 0 and clientID < len(self.clients)\
                         and self.clients[clientID].status == 'Disconnected':
                     # OK, reconnect client with selected ID
+                    self.cancelReconnectTimer(clientConn)
                     clientConn.id = clientID
                     client = self.clients[clientID]
                     client.connection = clientConn
                     client.status = 'Connected'
+                    client.session = self.communicator.startSession(clientConn)
                     self.listCtrl.updateClient(client)
                     self.gameController.reinitClient(client)
                 else:
@@ -492,6 +626,23 @@ class Frame(wx.Frame):
                     # so ask 'whoareyou' again.
                     self.promptRelogin(clientConn)
 
+    def anyClientSlow(self):
+        """ @return True if any connected client's send queue is over its limit.
+        """
+        for c in self.clients:
+            if c != None and c.connection != None\
+                    and c.connection.senderThread != None\
+                    and c.connection.senderThread.slow:
+                return True
+        return False
+
+    def onQueueTimer(self, event):
+        self.listCtrl.updateQueueDepths(self.clients)
+        total, rate = self.communicator.router.sample()
+        self.routedLabel.SetLabel(
+                "Handled without the GUI: %d messages (%.1f/s)"
+                % (total, rate))
+
     def allClientsLoggedIn(self):
         """ @return True if all clients have logged in, else False. """
         for c in self.clients:
@@ -511,6 +662,25 @@ class Frame(wx.Frame):
         self.chatEnabled = enable
         self.chatFilter = chatFilter
 
+    def relayChat(self, clientConn, message):
+        """ Forward a chat message, and add it to the chat history.  Called by
+        the communicator's router in the network thread that received the
+        message, not the GUI thread. """
+        if not self.chatEnabled or clientConn.id == None:
+            return
+        self.forwardChatMessage(clientConn, message)
+
+        # Append to chat history for chat output file
+        client = self.clients[clientConn.id]
+        if client.group == None:
+            groupID = ''
+        else:
+            groupID = str(client.group.id + 1)
+        row = [self.sessionID, self.experimentID,\
+                self.roundNum+1, clientConn.id+1, groupID,
+                message['message']]
+        self.chatHistory.append(row)
+
     def forwardChatMessage(self, clientConn, message):
         message['id'] = clientConn.id
         client = self.clients[clientConn.id]
@@ -522,27 +692,54 @@ class Frame(wx.Frame):
         else:
             clients = self.clients
 
-        for c in clients:
-            if c.id != client.id and (self.chatFilter == None or
-                    self.chatFilter(client, c)):
-                self.communicator.send(c.connection, message)
+        # Encoded once for all recipients
+        self.communicator.broadcast([c.connection for c in clients
+            if c.id != client.id and c.connection != None
+            and (self.chatFilter == None or self.chatFilter(client, c))],
+            message)
 
     def onLoginTimeout(self, client):
         """ Called by client.loginTimer when it times out waiting for the client
         to send an expected login message after connecting.  This might happen
         if the subject clicks 'reconnect' before the game starts. """
-        print 'onLoginTimeout'
+        if client.loginTimer == None:
+            # The login arrived while this call was on its way to the GUI
+            # thread.
+            return
+        logger.debug('onLoginTimeout')
         client.loginTimer = None
         m = {'type': 'error',
                 'errorString': 'Please enter your name and click "Log In".'}
-        self.communicator.send(client.connection, m)
-        # Make sure the error message is sent before disconnecting
-        # FIXME: must be a better way.
-        time.sleep(1)
-        client.connection.close()
+        client.connection.closeWhenSent(m)
         self.clients[client.id] = None
         self.listCtrl.updateClients(self.clients)
 
+    def onReconnectTimeout(self, clientConn):
+        """ Called loginTimeout seconds after a client connects during the
+        game when no client was disconnected. """
+        if self.reconnectTimers.pop(clientConn, None) == None:
+            # It has resumed, logged in again, or gone away.
+            return
+        if self.anyClientDisconnected():
+            # The old connection has dropped since.
+            self.promptRelogin(clientConn)
+        else:
+            m = {'type': 'error',
+                    'errorString': 'There are no disconnected clients.'}
+            clientConn.closeWhenSent(m)
+
+    def cancelReconnectTimer(self, clientConn):
+        timer = self.reconnectTimers.pop(clientConn, None)
+        if timer != None:
+            timer.cancel()
+
+    def anyClientDisconnected(self):
+        """ @return True if any client has lost its connection. """
+        for c in self.clients:
+            if c.connection == None:
+                return True
+        return False
+
     def promptRelogin(self, clientConn):
         # Called when a disconnected client reconnects.
         # Send the client a list of disconnected clients in the form of a
@@ -715,7 +912,7 @@ class Frame(wx.Frame):
             outfile.close()
 
         except:
-            print str(sys.exc_info()[1])
+            logger.exception('Failed to write to the output folder')
             errorstring = "The selected output folder is not writable.  " +\
                     "Please select a different folder."
             dlg = wx.MessageDialog(self, errorstring,
@@ -725,7 +922,15 @@ class Frame(wx.Frame):
 
             return
 
+        # Keep a log of the session in the output folder too
+        try:
+            log.addFile(os.path.join(self.outputDir,
+                self.sessionID + '-server.log'))
+        except IOError:
+            logger.exception('Failed to create the log file')
+
         self.startButton.Enable(False)
+        self.latencyButton.Enable(True)
         self.gameController.start(self.clients, self.sessionID)
         self.roundLabel.SetLabel("Round 0")
 
@@ -817,14 +1022,13 @@ class Frame(wx.Frame):
         try:
             os.remove(statusFilename + '.backup')
         except:
-            print "Couldn't remove old backup status file"
+            logger.debug("Couldn't remove old backup status file")
 
         try:
             os.rename(statusFilename, statusFilename + '.backup')
         except:
-            print "Couldn't back up status file."
-            print "  (maybe just because it doesn't exist yet)"
-            print sys.exc_info()[0]
+            logger.debug("Couldn't back up status file (maybe just because "
+                    "it doesn't exist yet)", exc_info=True)
 
         # Write client status file
         try:
@@ -847,14 +1051,12 @@ class Frame(wx.Frame):
                         str(roundedEarnings),\
                         str(self.showUpPayment),\
                         str(totalEarnings)]
-                print "writing row to status file"
                 csvwriter.writerow(row)
 
             statusFile.close()
                 
         except:
-            print 'Failed to write status file'
-            print sys.exc_info()
+            logger.exception('Failed to write status file')
 
         # Write chat history
         # FIXME back up first
@@ -862,12 +1064,14 @@ class Frame(wx.Frame):
             fname = self.sessionID + '-chat.csv'
             file = open(os.path.join(self.outputDir, fname), 'ab')
             csvwriter = csv.writer(file)
-            csvwriter.writerows(self.chatHistory[self.chatRowsWritten:])
-            self.chatRowsWritten = len(self.chatHistory)
+            # Chat is relayed on the network threads, so lines may be added
+            # while this runs; take them once, and count only those.
+            rows = self.chatHistory[self.chatRowsWritten:]
+            csvwriter.writerows(rows)
+            self.chatRowsWritten += len(rows)
             file.close()
         except:
-            print 'Failed to write chat file'
-            print sys.exc_info()[0]
+            logger.exception('Failed to write chat file')
 
         # Start survey (starts in new thread)
         if gameFinished and self.surveyFile != None:
@@ -894,6 +1098,7 @@ class Frame(wx.Frame):
         self.gameController.nextRound()
 
     def onPauseClicked(self, event):
+        self.slowPaused = False
         if self.communicator.paused:
             self.communicator.unpause()
             self.gameController.onUnpause()
@@ -904,6 +1109,10 @@ class Frame(wx.Frame):
             self.pauseClients()
             self.pauseButton.SetLabel("Unpause")
     
+    def onLatencyClicked(self, event):
+        """ Open a window of live histograms of the game's timings. """
+        LatencyWindow(self, self.gameController, self.clients).Show()
+
     def pauseClients(self):
         """ Send a pause message to the clients.  It's up to the particular
         GameGUI what to do with the message. """
@@ -18,12 +18,18 @@ import thread
 import time
 import Queue
 import re
-import sys
-import traceback
 from decimal import Decimal
 
 from peet.server import servernet
+from peet.server import output
 from peet.server.ClientData import ClientData
+from peet.shared import log
+
+logger = log.getLogger('server.game')
+
+state_snapshot_interval = 20
+""" sendState() sends a client the whole of a state at least once in this many
+updates, and only what changed in between """
 
 class GameControl:
 
@@ -32,6 +38,15 @@ class GameControl:
     name = "Game controller base class"
     description = "Base class for all game controllers; not useful on its own."
 
+    # Shapes of frequent game messages, which are sent in a compact binary
+    # form to clients that support it.  See peet.shared.schemas.
+    messageSchemas = []
+
+    # The most game messages other than replies a client may send, as
+    # (messages per second, burst); any more are dropped.  See
+    # servernet.Communicator.setRateLimit().
+    messageRateLimit = None
+
     def __init__(self, server):
         """ Note: clients and sessionID are not available in __init__, but they
         become available by the time initClients() is called. """
@@ -40,6 +55,8 @@ class GameControl:
         self.params = server.getParams()
         self.communicator = server.getCommunicator()
         self.outputDir = server.getOutputDir()
+        # Writes output files in the background (see output.OutputWriter)
+        self.output = output.OutputWriter(self.outputFailed)
 
         self.roundNum = 0
         self.waitQ = Queue.Queue()  # for waiting after each round
@@ -86,6 +103,52 @@ class GameControl:
         files (which should have the sessionID prepended to their names). """
         pass
 
+    def getSupersedeKey(self, message):
+        """ Return a key identifying what an outgoing message is about, if a
+        newer message with the same key to the same client makes it obsolete
+        (e.g. a full account update), or None if every such message has to be
+        delivered.  While a client is falling behind, the communicator may drop
+        queued messages that have been superseded.  See
+        servernet.Communicator.setSupersedeKey().
+
+        By default, whole-state messages from sendState() supersede each other,
+        by subtype.  An override should do the same. """
+        if message.get('full'):
+            return message.get('subtype')
+        return None
+
+    def validateMessage(self, clientConn, message):
+        """ Return None if a game message from a client may be passed on to
+        the controller, or a short string saying why it should be dropped
+        instead (e.g. 'invalid amount').  This is called in the network threads
+        as messages arrive, possibly several at once, so it should only check
+        what it can without locking: the message itself, and game state that
+        doesn't change while such messages are expected.  The controller still
+        has to check anything that may have changed by the time it receives
+        the message.  See servernet.Communicator.setValidator(). """
+        return None
+
+    def getShardKey(self, clientConn):
+        """ Return a key identifying the part of the game (e.g. the group) that
+        a client's messages belong to, if each part's messages can be handled
+        independently of the others', or None.  The communicator measures
+        latency per shard, and can queue each shard's messages separately.  See
+        servernet.Communicator.setShardKey(). """
+        return None
+
+    def getLatencyStats(self):
+        """ Return a list of (name, servernet.LatencyStats) pairs to show in
+        the server's latency window: by default, how long game messages wait in
+        the communicator's queue.  Override this to add the game's own timings
+        (e.g. of market events). """
+        return [('Queue wait', self.communicator.getLatencyStats())]
+
+    def getClientLatencyStats(self, client):
+        """ Return a list of (name, servernet.LatencyStats) pairs of timings for
+        one client (a ClientData), for finding the slow stations.  None by
+        default. """
+        return []
+
     def runRound(self):
         """ Called at the beginning of each round to do anything that happens
         during a round.  Override this method to process each round.  This
@@ -148,8 +211,9 @@ class GameControl:
             # Here, 'messages' is actually just one message
             for client in self.clients:
                 client.unansweredMessage = messages
-                self.communicator.send(client.connection, messages)
                 replies.append(None)
+            self.communicator.broadcast(
+                    [client.connection for client in self.clients], messages)
 
         repliesReceived = 0
         while repliesReceived < len(self.clients):
@@ -173,8 +237,69 @@ class GameControl:
                 self.communicator.send(client.connection, messages[i])
         else:
             # Here, 'messages' is actually just one message
-            for client in self.clients:
-                self.communicator.send(client.connection, messages)
+            self.communicator.broadcast(
+                    [client.connection for client in self.clients], messages)
+
+    def sendState(self, client, subtype, key, state):
+        """ Bring the client's copy of some state (a dict, e.g. its account) up
+        to date with a {'type': 'gm', 'subtype': subtype, key: <entries>,
+        'v': <version>} message, if the state has changed since it was last
+        sent.  Usually only the entries that changed are sent (a patch).  The
+        whole state is sent, with 'full': True, the first time, at least every
+        state_snapshot_interval updates, and while the client is falling
+        behind, so that queued whole states can supersede each other (see
+        getSupersedeKey()).  Entries must never be removed from the state.
+
+        The version counts up with each update.  The client merges each update
+        into its copy, but ignores a patch no newer than what it has: a whole
+        state that superseded a queued one is sent in the older one's place,
+        ahead of patches queued after that.
+
+        Messages to a client arrive in order, and within its session are resent
+        after a dropped connection (see servernet.Session), so the state last
+        sent is what the client will have once it has acknowledged everything.
+        A client that starts over gets the whole state in its reinit message,
+        along with getStateVersion(). """
+        synced = client.syncedStates.get(subtype)
+        if synced == None:
+            synced = client.syncedStates[subtype] = SyncedState()
+        elif synced.sent == state:
+            return
+
+        # The server clears the connection when the client disconnects, on
+        # another thread.
+        connection = client.connection
+        if connection == None:
+            # The client won't get this update, so the next one has to be
+            # whole.
+            synced.sent = None
+            return
+
+        message = {'type': 'gm', 'subtype': subtype}
+        if synced.sent == None or connection.senderThread.slow or \
+                synced.patches >= state_snapshot_interval - 1:
+            message[key] = dict(state)
+            message['full'] = True
+            synced.patches = 0
+        else:
+            sent = synced.sent
+            message[key] = dict([(name, value)
+                for name, value in state.iteritems()
+                if not sent.has_key(name) or sent[name] != value])
+            synced.patches += 1
+        synced.version += 1
+        message['v'] = synced.version
+        synced.sent = dict(state)
+        self.communicator.send(connection, message)
+
+    def getStateVersion(self, client, subtype):
+        """ Return the version of the last update sendState() sent the client
+        with the given subtype (0 for none), to go with the state in a reinit
+        message. """
+        synced = client.syncedStates.get(subtype)
+        if synced == None:
+            return 0
+        return synced.version
 
 
 #-------------------------------------------------------------------------------
@@ -216,10 +341,16 @@ class GameControl:
         try:
             self.run()
         except:
-            traceback.print_exc(file=sys.stdout)
+            logger.exception('Game controller terminated by exception')
 
     def run(self):
 
+        self.communicator.setMessageSchemas(self.messageSchemas)
+        self.communicator.setSupersedeKey(self.getSupersedeKey)
+        self.communicator.setShardKey(self.getShardKey)
+        self.communicator.setValidator(self.validateMessage)
+        self.communicator.setRateLimit(self.messageRateLimit)
+
         # Send initialization parameters to clients.
         self.initParams = []
         GUIclassName = re.sub('Control$', 'GUI', self.__class__.__name__)
@@ -237,12 +368,13 @@ class GameControl:
             conn = self.readyQ.get()
             # FIXME: assuming that no client sends a 'ready' message more than
             # once
-            print 'Client ' + str(conn.id) + ' is ready.'
+            logger.info('Client %d is ready.', conn.id)
             clientsReady += 1
         # All clients should be ready now.
 
         self.running = True
         
+        self.output.Start()
         self.initClients()
 
         gameFinished = False
@@ -285,6 +417,13 @@ class GameControl:
                 mes['survey'] = True
             self.communicator.send(client.connection, mes)
 
+        # The output files are complete once the writer has caught up
+        self.output.Stop()
+        self.output.waitUntilStopped()
+        if self.output.failures:
+            self.server.postMessage('%d output requests failed; the output '
+                    'files are incomplete (see the log).'
+                    % self.output.failures)
         self.running = False
 
     def nextRound(self):
@@ -292,12 +431,23 @@ class GameControl:
         round. """
         self.waitQ.put(1)
 
+    def outputFailed(self, text):
+        """ Called on the output writer's thread when writing an output file
+        fails. """
+        self.server.postMessage('Output error: ' + text)
+
+    def stopOutput(self, timeout=None):
+        """ Called by the server when it's closing, to finish writing the
+        output files.  Return True if they're finished. """
+        self.output.Stop()
+        return self.output.waitUntilStopped(timeout)
+
     def reinitClient(self, client):
         """ Called by server to send re-initialization message to reconnected
         client, and wait for that client to be ready before continuing
         @type{client} ClientData.  Don't override this method. """
         self.communicator.send(client.connection, self.getReinitParams(client))
-        print 'reinitClient(): reinit params sent.'
+        logger.info('reinitClient(): reinit params sent.')
         # FIXME: somehow, have to wait for client to be ready before allowing
         # the game to be unpaused.  waitForClientReady() doesn't work if you
         # just call it here; it locks up the GUI (because it's called from the
@@ -313,3 +463,20 @@ class GameControl:
 
         return reinitParams
 
+    def getHistory(self, client):
+        """ Override this function to return the client's full game history,
+        for games whose reinit message only carries the current round.  Sent
+        to clients that ask for it with a 'history' message.  (The game GUIs
+        only show the current round, so they don't; the fetch is for other
+        clients, such as tools that watch a session.) """
+        return {'type': 'history'}
+
+
+class SyncedState:
+    """ What a client has been sent of one kind of state (see
+    GameControl.sendState()). """
+
+    def __init__(self):
+        self.version = 0  # Version of the last update sent
+        self.sent = None  # Copy of the state as of that update
+        self.patches = 0  # Number of patches sent since the whole state
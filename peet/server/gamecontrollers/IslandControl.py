@@ -16,26 +16,33 @@
 
 import math
 from decimal import Decimal
-import csv
-import copy
 import os
 import time
+import thread
+import Queue
 
 from peet.server import servernet
 import GameControl
 from peet.server import GroupData
+from peet.server import OrderBook
+from peet.server import Formula
+from peet.server.MarketEventStore import MarketEventStore, timings
 from peet.shared import util
+from peet.shared import log
+
+logger = log.getLogger('server.game.island')
+
+max_amount = Decimal('100000.00')
+""" The highest bid or ask accepted, in dollars """
 
 class IslandControl(GameControl.GameControl):
 
     name = "The Island Experiment (Paul Johnson)"
     description = ""
 
-    # dictionary of safe things to be passed as eval()'s "locals" argument when
-    # evaluating the scoring_formula, so the expression can call no other
-    # functions and access no other variables.  The d,b,r, and g will be added
-    # later.
-    safe_for_eval = {
+    # The functions the scoring_formula may call.  It can use no other
+    # functions or variables besides d, b, r and g (see Formula).
+    scoring_functions = {
             'abs': abs,
             'float': float,
             'int': int,
@@ -45,6 +52,45 @@ class IslandControl(GameControl.GameControl):
             'round': round
             }
 
+    messageSchemas = [
+            ('bid', [('id', 'int'), ('amount', 'decimal')]),
+            ('ask', [('id', 'int'), ('amount', 'decimal')]),
+            ('transaction', [('buyerID', 'int'), ('sellerID', 'int'),
+                ('amount', 'decimal')]),
+            # acctUpdate carries the whole account, or only the fields that
+            # changed (see GameControl.sendState()): usually those changed by a
+            # trade, by production, or at the end of a round.
+            ('acctUpdate', [('acct', [('dollars', 'decimal'),
+                ('blue', 'int'), ('red', 'int'), ('green', 'int'),
+                ('roundScore', 'int'), ('matchScore', 'int')]),
+                ('v', 'int'), ('full', 'bool')]),
+            ('acctUpdate', [('acct', [('dollars', 'decimal'),
+                ('blue', 'int'), ('roundScore', 'int')]), ('v', 'int')]),
+            ('acctUpdate', [('acct', [('dollars', 'decimal'),
+                ('red', 'int'), ('roundScore', 'int')]), ('v', 'int')]),
+            ('acctUpdate', [('acct', [('dollars', 'decimal'),
+                ('blue', 'int')]), ('v', 'int')]),
+            ('acctUpdate', [('acct', [('dollars', 'decimal'),
+                ('red', 'int')]), ('v', 'int')]),
+            ('acctUpdate', [('acct', [('green', 'int'), ('blue', 'int'),
+                ('roundScore', 'int')]), ('v', 'int')]),
+            ('acctUpdate', [('acct', [('green', 'int'), ('red', 'int'),
+                ('roundScore', 'int')]), ('v', 'int')]),
+            ('acctUpdate', [('acct', [('matchScore', 'int')]), ('v', 'int')]),
+            # productionChoice carries the amounts produced only if the client
+            # produced, and the second color depends on the client.
+            ('productionChoice', [('color', 'str')]),
+            ('productionChoice', [('color', 'str'), ('green', 'int'),
+                ('red', 'int')]),
+            ('productionChoice', [('color', 'str'), ('green', 'int'),
+                ('blue', 'int')]),
+            ('error', [('error', 'str')]),
+            ('cancel', [('id', 'int'), ('side', 'str')]),
+            ]
+
+    # Enough for anyone bidding by hand
+    messageRateLimit = (20, 40)
+
     def __init__(self, server,):
         GameControl.GameControl.__init__(self, server)
         
@@ -60,9 +106,71 @@ class IslandControl(GameControl.GameControl):
         self.matchNum = 0
         self.matchRoundNum = 0
 
+        # The market being auctioned, if any (see validateMessage())
+        self.color = None
+        self.auctionInProgress = False
+
+        # Timings of market events, for the whole session, by the name of the
+        # market history column they go in (see MarketEventStore.timings).
+        # Recorded from the group threads of parallel auctions and from the
+        # send queues, so they're only updated under the lock (see
+        # recordTiming()).
+        self.marketStats = dict([(name, servernet.LatencyStats())
+            for name in timings])
+        self.marketStatsLock = thread.allocate_lock()
+
     def getNumPlayers(self):
         return self.params['numPlayers']
     
+    def validateMessage(self, clientConn, message):
+        # Weed out bids and asks that could never be valid, before they're
+        # queued.  The auction handlers check again, because the auction may
+        # be over by the time they get them.
+        t = message.get('subtype')
+        if t == None:
+            # A reply, e.g. a production choice
+            return None
+        if t not in ('bid', 'ask', 'cancel'):
+            return 'unknown subtype'
+        if not self.auctionInProgress:
+            return 'no auction'
+        if t == 'cancel':
+            if self.market != 'ORDER_BOOK':
+                return 'no order book'
+            return None
+        # A seller can only ask, and a buyer can only bid
+        c = self.clients[clientConn.id]
+        if t != (c.color == self.color and 'ask' or 'bid'):
+            return 'wrong role'
+        if not self.isValidAmount(message.get('amount')):
+            return 'invalid amount'
+        if message.has_key('ct') and type(message['ct']) != float:
+            return 'invalid timestamp'
+        return None
+
+    def isValidAmount(self, amount):
+        """ Return True if amount is a bid or ask the market takes: a Decimal
+        greater than zero and no more than max_amount. """
+        return type(amount) == Decimal and amount.is_finite() and \
+                0 < amount <= max_amount
+
+    def getShardKey(self, clientConn):
+        # Groups' markets are independent.
+        if clientConn.id == None:
+            return None
+        return self.clients[clientConn.id].group
+
+    def getLatencyStats(self):
+        return GameControl.GameControl.getLatencyStats(self) + \
+                [(name, self.marketStats[name]) for name in timings]
+
+    def getClientLatencyStats(self, client):
+        if not hasattr(client, 'latencyStats'):
+            # initClients() hasn't been called yet
+            return []
+        return [('Latency', client.latencyStats),
+                ('Delivery', client.deliveryStats)]
+
     def initClients(self):
 
         # initialize client data
@@ -84,9 +192,23 @@ class IslandControl(GameControl.GameControl):
                 # moneyShockAmount_redMkt
                 # moneyShockAmountRealized_redMkt
             c.events = []
+            #
+            # How long the client's bids and asks took to reach the server,
+            # and market events took to be sent to the client
+            c.latencyStats = servernet.LatencyStats()
+            c.deliveryStats = servernet.LatencyStats()
 
         # Group clients (once per game)
         self.numGroups = int(self.params['numGroups'])
+        # Groups never interact during an auction, so each can have a thread
+        # of its own (see doAuction()).
+        self.parallelAuctions = self.params.get('parallelAuctions', False)
+        # 'SIMPLE' keeps only the high bid and low ask, and clears them after
+        # every transaction; 'ORDER_BOOK' keeps every trader's standing bid or
+        # ask in an OrderBook, which clients see the top orderBookDepth price
+        # levels of.
+        self.market = self.params.get('market', 'SIMPLE')
+        self.orderBookDepth = self.params.get('orderBookDepth', 5)
         self.groups = GroupData.groupClients_random(
                 self.clients, numGroups=self.numGroups)
 
@@ -104,24 +226,23 @@ class IslandControl(GameControl.GameControl):
                     g.clients[i].color = 'red'
 
         # Keep market history and other event history separate.  That way
-        # mktHist is easier to analyze, and it can be sent without filtering to
-        # any client that needs it upon re-connect.
+        # mktHist is easier to analyze, and the current round of it can be
+        # sent without filtering to any client that needs it upon re-connect.
         #
-        # group.mktHist[match][round]{market} is a list of market events
+        # group.mktHist holds the group's market events for the session (see
+        # MarketEventStore)
         for g in self.groups:
-            g.mktHist = []
+            g.mktHist = MarketEventStore()
 
         ## Output files
 
         # Market history
         self.mktHistFilename = os.path.join(self.outputDir,
                 self.sessionID + '-market-history.csv')
-        file = open(self.mktHistFilename, 'wb')
-        csvwriter = csv.writer(file)
         self.mktHistHeaders = ['Match', 'Round', 'Group', 'Market', 'Action',
-                'Buyer', 'Bid', 'Accept', 'Ask', 'Seller', 'Time']
-        csvwriter.writerow(self.mktHistHeaders)
-        file.close()
+                'Buyer', 'Bid', 'Accept', 'Ask', 'Seller', 'Time'] + \
+                list(timings)
+        self.output.open(self.mktHistFilename, self.mktHistHeaders)
 
         # Round output
         self.roundOutputFilename = os.path.join(self.outputDir,
@@ -143,13 +264,7 @@ class IslandControl(GameControl.GameControl):
                 'moneyShock_redMkt',
                 'moneyShockAmount_redMkt',
                 'moneyShockAmountRealized_redMkt']
-        file = open(self.roundOutputFilename, 'wb')
-        csvwriter = csv.DictWriter(file, self.roundOutputHeaders)
-        rowdict = {}
-        for header in self.roundOutputHeaders:
-            rowdict[header] = header
-        csvwriter.writerow(rowdict)
-        file.close()
+        self.output.open(self.roundOutputFilename, self.roundOutputHeaders)
 
     def initMatch(self):
 
@@ -186,7 +301,10 @@ class IslandControl(GameControl.GameControl):
         self.resetBalances = mp['resetBalances']
         self.startingDollars =\
                 Decimal(str(mp['startingDollars'])).quantize(Decimal('0.01'))
-        self.scoring_formula = mp['scoring_formula']
+        # Checked and compiled once for the match, rather than evaluated from
+        # source on every account change
+        self.scoring_formula = Formula.Formula(mp['scoring_formula'],
+                ('d', 'b', 'r', 'g'), IslandControl.scoring_functions)
 
         # dictionaries indexed by color of market
         self.moneyShocks = {}
@@ -229,9 +347,10 @@ class IslandControl(GameControl.GameControl):
             c.acct['blue'] = 0
             c.acct['red'] = 0
             c.acct['green'] = 0
-            self.updateRoundScore(c)
             c.acct['matchScore'] = 0
+        self.updateRoundScores(self.clients)
 
+        for c in self.clients:
             c.events.append([]) # append new empty match to event history
 
             c.matchInitMessage = {'type': 'gm',
@@ -239,9 +358,6 @@ class IslandControl(GameControl.GameControl):
                 'blueIDs': c.group.blueIDs}
             self.communicator.send(c.connection, c.matchInitMessage)
 
-        for g in self.groups:
-            g.mktHist.append([]) # append new empty match to market history
-
     def runRound(self):
 
         # If this is the first round of a new match, initialize the match.
@@ -255,16 +371,16 @@ class IslandControl(GameControl.GameControl):
         self.productionChoicesMade = []
         self.auctionInProgress = False
 
-        # Append new empty round to current match of market history
+        # Start a new round of market history
         for g in self.groups:
-            g.mktHist[-1].append({'blue': [], 'red': []})
+            g.mktHist.startRound(self.matchNum, self.matchRoundNum)
 
         if self.resetBalances:
             for c in self.clients:
                 c.acct['blue'] = 0
                 c.acct['red'] = 0
                 c.acct['green'] = 0
-                self.updateRoundScore(c)
+            self.updateRoundScores(self.clients)
 
         for c in self.clients:
             c.events[self.matchNum].append({})
@@ -300,36 +416,28 @@ class IslandControl(GameControl.GameControl):
         for i, c in enumerate(self.clients):
             c.earnings += c.acct['matchScore']
 
-        # Append round data to output files
+        # Append round data to output files (written in the background; the
+        # round's events don't change after this, but accounts do, so they are
+        # copied)
         #
         # Market history to its own file
-        file = open(self.mktHistFilename, 'ab')
-        csvwriter = csv.DictWriter(file, self.mktHistHeaders)
         for g in self.groups:
             for color in ('blue', 'red'):
-                for event in g.mktHist[self.matchNum][self.matchRoundNum][color]:
-                    row = copy.copy(event)
-                    row['Match'] = self.matchNum + 1
-                    row['Round'] = self.matchRoundNum + 1
-                    row['Group'] = g.id + 1
-                    row['Market'] = color
-                    row['Buyer'] = row['Buyer'] + 1 if row.has_key('Buyer')\
-                            else ''
-                    row['Seller'] = row['Seller'] + 1 if row.has_key('Seller')\
-                            else ''
-                    csvwriter.writerow(row)
-        file.close()
+                where = {'Match': self.matchNum + 1,
+                        'Round': self.matchRoundNum + 1, 'Group': g.id + 1,
+                        'Market': color}
+                self.output.writeRows(self.mktHistFilename,
+                        g.mktHist.iterRows(self.matchNum, self.matchRoundNum,
+                            color, where))
         #
         # Account and events to round output file
-        file = open(self.roundOutputFilename, 'ab')
-        csvwriter = csv.DictWriter(file, self.roundOutputHeaders)
         for c in self.clients:
             row = {'Match': self.matchNum+1, 'Round': self.matchRoundNum+1,
                     'Group': c.group.id+1, 'Subject': c.id+1, 'color': c.color}
-            row.update(c.acct)
-            row.update(c.events[self.matchNum][self.matchRoundNum])
-            csvwriter.writerow(row)
-        file.close()
+            self.output.writeRow(self.roundOutputFilename, row, dict(c.acct),
+                    c.events[self.matchNum][self.matchRoundNum])
+        self.output.sync()
+        logger.info('Output: %s', self.output)
 
         self.matchRoundNum += 1
 
@@ -467,151 +575,313 @@ class IslandControl(GameControl.GameControl):
         for g in self.groups:
             self.resetMarket(g)
 
+        if self.parallelAuctions:
+            # Each group's bids and asks go to a queue of its own, handled by
+            # a thread of its own (see runGroupAuction()).
+            self.communicator.openShardQueues(self.groups)
+
         self.tellAllPlayers({'type': 'gm', 'subtype': 'auction',
-            'color': color, 'auctionTime': self.auctionTime})
+            'color': color, 'auctionTime': self.auctionTime,
+            'market': self.market})
         self.communicator.startTimer(self.auctionTime)
 
+        if self.parallelAuctions:
+            finished = Queue.Queue()
+            for g in self.groups:
+                thread.start_new_thread(self.runGroupAuction,
+                        (g, color, finished))
+            for g in self.groups:
+                finished.get()
+            self.communicator.closeShardQueues()
+            self.endAuction()
+            return
+
         while True:
             # Receive and process a message
 
             conn, m = self.communicator.recv()
-            t = m.get('subtype')
-
-            # Calculate the timestamp to give this market event (to help with
-            # analysis of output data), as the starting timestamp of this
-            # auction plus the amount of time into the auction.
-            # To account for the fact that a pause cancels the communicator's
-            # timer, we get time elapsed by subtracting the time LEFT from the
-            # auctionTime.
-            timeElapsed = self.auctionTime - self.communicator.getTimeLeft()
-            print 'baseTime =', self.baseTime, 'timeElapsed =', timeElapsed
-            msgTime = self.baseTime + timeElapsed
-
-            if t == 'timeup':
-                # Auction is over
-                self.baseTime += self.auctionTime
-                self.tellAllPlayers(m)
-                self.server.postMessage('Auction over')
+            msgTime = self.getMessageTime()
+
+            if m.get('subtype') == 'timeup':
+                self.endAuction()
                 return
 
-            c = self.clients[conn.id]
-            g = c.group
+            self.handleAuctionMessage(conn, m, color, msgTime)
+
+    def runGroupAuction(self, group, color, finished):
+        """ Handle one group's bids and asks in order of arrival until the
+        auction is over, then put the group on the finished queue. """
+        try:
+            while True:
+                conn, m = self.communicator.recvShard(group)
+                msgTime = self.getMessageTime()
+                if m.get('subtype') == 'timeup':
+                    return
+                self.handleAuctionMessage(conn, m, color, msgTime)
+        except:
+            logger.exception('Auction of group %d failed', group.id + 1)
+        finally:
+            finished.put(group)
+
+    def getMessageTime(self):
+        # Calculate the timestamp to give a market event (to help with
+        # analysis of output data), as the starting timestamp of this
+        # auction plus the amount of time into the auction.
+        # To account for the fact that a pause cancels the communicator's
+        # timer, we get time elapsed by subtracting the time LEFT from the
+        # auctionTime.
+        timeElapsed = self.auctionTime - self.communicator.getTimeLeft()
+        logger.debug('baseTime = %s timeElapsed = %s', self.baseTime,
+                timeElapsed)
+        return self.baseTime + timeElapsed
+
+    def endAuction(self):
+        # Auction is over
+        self.baseTime += self.auctionTime
+        self.tellAllPlayers({'type': 'gm', 'subtype': 'timeup'})
+        self.server.postMessage('Auction over')
+        for g in self.groups:
+            logger.info('Group %d bid/ask latency: %s', g.id + 1,
+                    self.communicator.getLatencyStats(g))
 
-            # Message should be a bid or ask.  Check for valid amount, ignoring
-            # message if not valid
-            if not (type(m.get('amount')) == Decimal and m['amount'] > 0):
-                print 1
-                continue
-
-            # Convert amount so that it's a multiple of .10, with the zero
-            amount = m['amount'].quantize(Decimal('.1')) * Decimal('1.0')
-
-            if t == 'bid':
-
-                # Check for valid bid, sending error message or ignoring
-                # entirely, depending...
-                if c.color == color:
-                    # c is a seller, doesn't make sense to bid
-                    print 2
-                    continue
-                if amount <= g.highBid:
-                    self.communicator.send(c.connection, {'type': 'gm',
-                        'subtype': 'error', 'error': 'bidTooLow'})
-                    print 3
-                    continue
-                if amount > c.acct['dollars']:
-                    self.communicator.send(c.connection, {'type': 'gm',
-                        'subtype': 'error', 'error': 'notEnoughDollars'})
-                    print 4
-                    continue
-
-                # Valid bid - tell everyone in group
-                g.highBidder = c
-                g.highBid = amount
-                for c2 in g.clients:
-                    self.communicator.send(c2.connection, {'type': 'gm',
-                        'subtype': 'bid', 'id': c.id, 'amount': amount})
-                # and append to market history
-                g.mktHist[-1][-1][color].append({'Action': 'bid',
-                    'Buyer': c.id, 'Bid': amount, 'Time': msgTime })
-
-            elif t == 'ask':
-                if c.color != color:
-                    # c is a buyer, doesn't make sense to ask
-                    print 5
-                    continue
-                if amount >= g.lowAsk:
-                    self.communicator.send(c.connection, {'type': 'gm',
-                        'subtype': 'error', 'error': 'askTooHigh'})
-                    print 6
-                    continue
-                if c.acct[color] < 1:
-                    self.communicator.send(c.connection, {'type': 'gm',
-                        'subtype': 'error', 'error': 'notEnoughChips'})
-                    print 7
-                    continue
-
-                # Valid ask - tell everyone in group
-                g.lowSeller = c
-                g.lowAsk = amount
-                for c2 in g.clients:
-                    self.communicator.send(c2.connection, {'type': 'gm',
-                        'subtype': 'ask', 'id': c.id, 'amount': amount})
-                # and append to market history
-                g.mktHist[-1][-1][color].append({'Action': 'ask',
-                    'Ask': amount, 'Seller': c.id, 'Time': msgTime})
+    def handleAuctionMessage(self, conn, m, color, msgTime):
+        """ Process a bid or ask from a client. """
+        c = self.clients[conn.id]
+        if m.has_key('latency'):
+            c.latencyStats.record(m['latency'])
+            self.recordTiming('Latency', m['latency'])
+        if m.has_key('dequeuedTime'):
+            self.recordTiming('QueueWait',
+                    m['dequeuedTime'] - m['receivedTime'])
 
-            else:
-                # Invalid message (not a bid or ask) - ignore it
-                print 8
-                continue
-
-            # If the high bid and low sell have met or crossed, make the
-            # transaction, tell everyone in the group, and reset the market for
-            # the group.
-            if g.highBid >= g.lowAsk:
-                g.highBidder.acct[color] += 1
-                g.highBidder.acct['dollars'] -= amount
-                g.lowSeller.acct[color] -= 1
-                g.lowSeller.acct['dollars'] += amount
-                self.updateRoundScore(g.highBidder)
-                self.updateRoundScore(g.lowSeller)
-                for c2 in g.clients:
-                    self.communicator.send(c2.connection, {'type': 'gm',
-                        'subtype': 'transaction', 'buyerID': g.highBidder.id,
-                        'sellerID': g.lowSeller.id, 'amount': amount})
-                self.sendAccountUpdate(g.highBidder)
-                self.sendAccountUpdate(g.lowSeller)
-                # and append to market history
-                g.mktHist[-1][-1][color].append({'Action': 'accept',
-                    'Buyer': g.highBidder.id, 'Accept': amount,
-                    'Seller': g.lowSeller.id, 'Time': msgTime})
-                self.resetMarket(g)
+        if self.market == 'ORDER_BOOK':
+            self.handleOrderBookMessage(conn, m, color, msgTime)
+            return
+
+        t = m.get('subtype')
+
+        g = c.group
+
+        # Message should be a bid or ask.  Check for valid amount, ignoring
+        # message if not valid
+        if not self.isValidAmount(m.get('amount')):
+            logger.debug('Ignored %s from client %d: invalid amount', t,
+                    c.id)
+            return
+
+        # Convert amount so that it's a multiple of .10, with the zero
+        amount = m['amount'].quantize(Decimal('.1')) * Decimal('1.0')
+
+        if t == 'bid':
+
+            # Check for valid bid, sending error message or ignoring
+            # entirely, depending...
+            if c.color == color:
+                # c is a seller, doesn't make sense to bid
+                logger.debug('Ignored bid from seller %d', c.id)
+                return
+            if amount <= g.highBid:
+                self.communicator.send(c.connection, {'type': 'gm',
+                    'subtype': 'error', 'error': 'bidTooLow'})
+                logger.debug('Bid from client %d too low', c.id)
+                return
+            if amount > c.acct['dollars']:
+                self.communicator.send(c.connection, {'type': 'gm',
+                    'subtype': 'error', 'error': 'notEnoughDollars'})
+                logger.debug('Client %d bid more dollars than it has', c.id)
+                return
+
+            # Valid bid - tell everyone in group
+            g.highBidder = c
+            g.highBid = amount
+            self.publishEvent(g, color, m,
+                    {'type': 'gm', 'subtype': 'bid', 'id': c.id,
+                        'amount': amount},
+                    'bid', buyer=c.id, price=amount, time=msgTime)
+
+        elif t == 'ask':
+            if c.color != color:
+                # c is a buyer, doesn't make sense to ask
+                logger.debug('Ignored ask from buyer %d', c.id)
+                return
+            if amount >= g.lowAsk:
+                self.communicator.send(c.connection, {'type': 'gm',
+                    'subtype': 'error', 'error': 'askTooHigh'})
+                logger.debug('Ask from client %d too high', c.id)
+                return
+            if c.acct[color] < 1:
+                self.communicator.send(c.connection, {'type': 'gm',
+                    'subtype': 'error', 'error': 'notEnoughChips'})
+                logger.debug('Client %d asked with no chips', c.id)
+                return
+
+            # Valid ask - tell everyone in group
+            g.lowSeller = c
+            g.lowAsk = amount
+            self.publishEvent(g, color, m,
+                    {'type': 'gm', 'subtype': 'ask', 'id': c.id,
+                        'amount': amount},
+                    'ask', seller=c.id, price=amount, time=msgTime)
+
+        else:
+            # Invalid message (not a bid or ask) - ignore it
+            logger.debug('Ignored %s from client %d', t, c.id)
+            return
+
+        # If the high bid and low sell have met or crossed, make the
+        # transaction, tell everyone in the group, and reset the market for
+        # the group.
+        if g.highBid >= g.lowAsk:
+            g.highBidder.acct[color] += 1
+            g.highBidder.acct['dollars'] -= amount
+            g.lowSeller.acct[color] -= 1
+            g.lowSeller.acct['dollars'] += amount
+            self.updateRoundScore(g.highBidder)
+            self.updateRoundScore(g.lowSeller)
+            self.publishEvent(g, color, m,
+                    {'type': 'gm', 'subtype': 'transaction',
+                        'buyerID': g.highBidder.id,
+                        'sellerID': g.lowSeller.id, 'amount': amount},
+                    'accept', buyer=g.highBidder.id, seller=g.lowSeller.id,
+                    price=amount, time=msgTime)
+            self.sendAccountUpdate(g.highBidder)
+            self.sendAccountUpdate(g.lowSeller)
+            self.resetMarket(g)
+
+    def handleOrderBookMessage(self, conn, m, color, msgTime):
+        """ Process a bid, ask or cancellation from a client, in a market with
+        an order book: a bid or ask stands until it trades, is replaced by the
+        trader's next one, or is cancelled. """
+        t = m.get('subtype')
+
+        c = self.clients[conn.id]
+        g = c.group
+        # A seller can only ask, and a buyer can only bid
+        side = c.color == color and 'ask' or 'bid'
+        if t != 'cancel' and t != side:
+            return
+
+        if t == 'cancel':
+            for order in g.book.cancel(c, side):
+                message = {'type': 'gm', 'subtype': 'cancel', 'id': c.id,
+                        'side': side}
+                if side == 'bid':
+                    self.publishEvent(g, color, m, message, 'cancel',
+                            buyer=c.id, time=msgTime)
+                else:
+                    self.publishEvent(g, color, m, message, 'cancel',
+                            seller=c.id, time=msgTime)
+            self.sendBook(g)
+            return
+
+        if not self.isValidAmount(m.get('amount')):
+            return
+
+        # Convert amount so that it's a multiple of .10, with the zero
+        amount = m['amount'].quantize(Decimal('.1')) * Decimal('1.0')
+
+        if t == 'bid' and amount > c.acct['dollars']:
+            self.communicator.send(c.connection, {'type': 'gm',
+                'subtype': 'error', 'error': 'notEnoughDollars'})
+            return
+        if t == 'ask' and c.acct[color] < 1:
+            self.communicator.send(c.connection, {'type': 'gm',
+                'subtype': 'error', 'error': 'notEnoughChips'})
+            return
+
+        # Valid - tell everyone in group and append to market history
+        message = {'type': 'gm', 'subtype': t, 'id': c.id, 'amount': amount}
+        if t == 'bid':
+            self.publishEvent(g, color, m, message, 'bid', buyer=c.id,
+                    price=amount, time=msgTime)
+        else:
+            self.publishEvent(g, color, m, message, 'ask', seller=c.id,
+                    price=amount, time=msgTime)
+
+        order, trade = g.book.place(c, t, amount, msgTime)
+        if trade != None:
+            # It crossed the best standing order on the other side, and trades
+            # at that order's price.
+            buyer, seller, price = trade
+            buyer.acct[color] += 1
+            buyer.acct['dollars'] -= price
+            seller.acct[color] -= 1
+            seller.acct['dollars'] += price
+            self.updateRoundScore(buyer)
+            self.updateRoundScore(seller)
+            self.publishEvent(g, color, m,
+                    {'type': 'gm', 'subtype': 'transaction',
+                        'buyerID': buyer.id, 'sellerID': seller.id,
+                        'amount': price},
+                    'accept', buyer=buyer.id, seller=seller.id, price=price,
+                    time=msgTime)
+            self.sendAccountUpdate(buyer)
+            self.sendAccountUpdate(seller)
+        self.sendBook(g)
+
+    def publishEvent(self, group, color, m, message, action, **fields):
+        """ Append a market event to the group's market history, with the
+        timings of the client message m that caused it, and broadcast the
+        message announcing it to the group.  Once every client's copy has been
+        sent, the event's fan out time is filled in.
+        @param fields: the event's buyer, seller, price and time, as for
+        MarketEventStore.append() """
+        timing = (None, None, None)
+        if m.has_key('dequeuedTime'):
+            processing = time.time() - m['dequeuedTime']
+            self.recordTiming('Processing', processing)
+            timing = (m.get('latency'),
+                    m['dequeuedTime'] - m['receivedTime'], processing)
+        i = group.mktHist.append(self.matchNum, self.matchRoundNum, color,
+                action, timing=timing, **fields)
+
+        def onSent(clientConn, delay):
+            self.clients[clientConn.id].deliveryStats.record(delay)
+        def onDone(fanOut):
+            group.mktHist.setFanOut(i, fanOut.elapsed)
+            self.recordTiming('FanOut', fanOut.elapsed)
+        self.communicator.broadcast([c.connection for c in group.clients],
+                message, servernet.FanOut(onDone, onSent))
+
+    def recordTiming(self, name, value):
+        """ Record a market event timing in the session's stats. """
+        self.marketStatsLock.acquire()
+        try:
+            self.marketStats[name].record(value)
+        finally:
+            self.marketStatsLock.release()
+
+    def sendBook(self, group):
+        """ Send the group the best few price levels of its order book. """
+        self.communicator.broadcast([c.connection for c in group.clients],
+                {'type': 'gm', 'subtype': 'book',
+                    'bids': group.book.getDepth('bid', self.orderBookDepth),
+                    'asks': group.book.getDepth('ask', self.orderBookDepth)})
 
     def resetMarket(self, group):
         group.highBidder = None
         group.highBid = Decimal('-Infinity')
         group.lowSeller = None
         group.lowAsk = Decimal('Infinity')
+        group.book = OrderBook.OrderBook()
 
     def updateRoundScore(self, client):
         a = client.acct
-        # Here is a useful page:
-        # http://lybniz2.sourceforge.net/safeeval.html
-        safe_for_eval = {
-                'd': float(a['dollars']),
-                'b': a['blue'],
-                'r': a['red'],
-                'g': a['green'],
-                }
-        safe_for_eval.update(IslandControl.safe_for_eval)
-        a['roundScore'] = int(round(eval(self.scoring_formula,
-                {"__builtins__": None}, safe_for_eval)))
+        a['roundScore'] = int(round(self.scoring_formula(float(a['dollars']),
+            a['blue'], a['red'], a['green'])))
+
+    def updateRoundScores(self, clients):
+        """ Like updateRoundScore, for a list of clients (e.g. a group) at
+        once. """
+        scores = self.scoring_formula.evaluateAll(
+                [(float(c.acct['dollars']), c.acct['blue'], c.acct['red'],
+                    c.acct['green']) for c in clients])
+        for c, score in zip(clients, scores):
+            c.acct['roundScore'] = int(round(score))
 
     def sendAccountUpdate(self, client):
-        print 'sendAccountUpdate to ', client.id
-        self.communicator.send(client.connection,
-                {'type': 'gm', 'subtype': 'acctUpdate', 'acct': client.acct})
+        logger.debug('sendAccountUpdate to %d', client.id)
+        self.sendState(client, 'acctUpdate', 'acct', client.acct)
 
     def getReinitParams(self, client):
         m = self.initParams[client.id]
@@ -620,8 +890,11 @@ class IslandControl(GameControl.GameControl):
         m['round'] = self.matchRoundNum
         m['matchInitMessage'] = client.matchInitMessage
         m['acct'] = client.acct
-        m['events'] = client.events
-        m['mktHist'] = client.group.mktHist
+        m['acctVersion'] = self.getStateVersion(client, 'acctUpdate')
+        # Only the current round is replayed on the client, so the message
+        # stays the same size however long the session has run.  The rest is
+        # available from getHistory().
+        m['events'], m['mktHist'] = self.getRoundHistory(client)
         m['productionChoicesMade'] = self.productionChoicesMade
         m['auctionInProgress'] = self.auctionInProgress
 
@@ -630,6 +903,20 @@ class IslandControl(GameControl.GameControl):
         m['unansweredMessage'] = client.unansweredMessage
 
         return m
+
+    def getRoundHistory(self, client):
+        """ Return the client's events and its group's market history for the
+        current round, or empty ones if the round hasn't started yet. """
+        mktHist = client.group.mktHist.getRound(self.matchNum,
+                self.matchRoundNum)
+        try:
+            return client.events[self.matchNum][self.matchRoundNum], mktHist
+        except IndexError:
+            return {}, mktHist
+
+    def getHistory(self, client):
+        return {'type': 'history', 'events': client.events,
+                'mktHist': client.group.mktHist.getHistory()}
     
     def onUnpause(self):
         if self.auctionInProgress:
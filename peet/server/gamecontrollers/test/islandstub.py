@@ -0,0 +1,42 @@
+# Copyright 2009 University of Alaska Anchorage Experimental Economics
+# Laboratory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# An Island controller to test against, shared by the tests here and the load
+# generator's tests (peet/client/test).
+
+from peet.server.gamecontrollers.IslandControl import IslandControl
+from peet.server.ClientData import ClientData
+from peet.server import servernet
+
+class Controller(IslandControl):
+    """ An IslandControl without a server, in the middle of a blue auction.
+    Client 0 produces blue (so sells it) and client 1 red (so buys it). """
+    def __init__(self):
+        IslandControl.__init__(self, self)
+        self.clients = [ClientData(0), ClientData(1)]
+        self.clients[0].color = 'blue'
+        self.clients[1].color = 'red'
+        self.market = 'SIMPLE'
+        self.color = 'blue'
+        self.auctionInProgress = True
+
+    # Just enough of the server for GameControl.__init__()
+    def getParams(self):
+        return {}
+    def getCommunicator(self):
+        return servernet.Communicator(0, lambda clientConn, message: None)
+    def getOutputDir(self):
+        return None
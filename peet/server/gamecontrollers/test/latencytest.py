@@ -0,0 +1,131 @@
+# Copyright 2009 University of Alaska Anchorage Experimental Economics
+# Laboratory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests for the timing of Island market events.  Run from the top of the
+# source tree:
+#   PYTHONPATH=. python peet/server/gamecontrollers/test/latencytest.py
+
+import time
+import unittest
+from decimal import Decimal
+
+from peet.server.gamecontrollers.test import islandstub
+from peet.server.GroupData import GroupData
+from peet.server.MarketEventStore import MarketEventStore
+from peet.server import servernet
+from peet.shared import network
+
+class Sender(network.SendQueue):
+    """ A send queue that keeps what's queued until take() is called. """
+    def __init__(self):
+        self.initSendQueue()
+        self.framing = network.FRAMING_ASCII
+        self.items = []
+
+    def enqueue(self, data, lane):
+        self.items.append(data)
+
+    def getQueueDepth(self):
+        return len(self.items)
+
+    def take(self):
+        return self.taken(self.items.pop(0))
+
+class Controller(islandstub.Controller):
+    """ The test controller, with its two clients in one group. """
+    def __init__(self):
+        islandstub.Controller.__init__(self)
+        self.group = GroupData(0)
+        self.group.assignClients(self.clients)
+        self.group.mktHist = MarketEventStore()
+        self.resetMarket(self.group)
+        for c in self.clients:
+            c.acct = {'dollars': Decimal('10.00'), 'blue': 5, 'red': 5}
+            c.latencyStats = servernet.LatencyStats()
+            c.deliveryStats = servernet.LatencyStats()
+            c.connection = servernet.ClientConnection(c.id, None, None)
+            c.connection.id = c.id
+            c.connection.senderThread = Sender()
+
+class LatencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.control = Controller()
+        self.communicator = self.control.communicator
+
+    def handle(self, client, message, sentBefore):
+        """ Have the controller handle a message from a client, received 10 ms
+        after the client sent it, as if it had been queued. """
+        now = time.time()
+        message = dict(message, type='gm', ct=now - sentBefore +
+                client.connection.getClockOffset(now - 0.01))
+        conn, m = self.communicator.received((client.connection, message,
+            now - 0.01))
+        self.control.handleAuctionMessage(conn, m, 'blue', 1.0)
+
+    def takeAll(self):
+        for c in self.control.clients:
+            sender = c.connection.senderThread
+            while sender.items:
+                sender.take()
+
+    def test_market_history(self):
+        buyer, seller = self.control.clients[1], self.control.clients[0]
+        self.handle(buyer, {'subtype': 'bid', 'amount': Decimal('2.00')}, 0.05)
+        self.handle(seller, {'subtype': 'ask', 'amount': Decimal('3.00')}, 0.03)
+        rows = list(self.control.group.mktHist.iterRows(0, 0, 'blue', {}))
+        assert [row['Action'] for row in rows] == ['bid', 'ask']
+        # Latency is to within the float32 the store keeps it in
+        assert abs(float(rows[0]['Latency']) - 40) < 0.01, rows[0]
+        assert abs(float(rows[1]['Latency']) - 20) < 0.01, rows[1]
+        assert float(rows[0]['QueueWait']) >= 10
+        assert rows[0]['Processing'] != ''
+        # Not yet sent to every client
+        assert rows[0]['FanOut'] == ''
+
+        self.takeAll()
+        rows = list(self.control.group.mktHist.iterRows(0, 0, 'blue', {}))
+        assert rows[0]['FanOut'] != '' and rows[1]['FanOut'] != ''
+
+    def test_stats(self):
+        buyer = self.control.clients[1]
+        self.handle(buyer, {'subtype': 'bid', 'amount': Decimal('2.00')}, 0.05)
+        self.handle(buyer, {'subtype': 'bid', 'amount': Decimal('1.00')}, 0.05)
+        self.takeAll()
+        stats = dict(self.control.getLatencyStats())
+        # Both bids arrived, but only the first was a market event.
+        assert buyer.latencyStats.count == 2
+        assert stats['Latency'].count == 2
+        assert stats['Processing'].count == 1
+        assert stats['FanOut'].count == 1
+        for c in self.control.clients:
+            assert c.deliveryStats.count == 1
+
+    def test_fan_out(self):
+        done = []
+        fanOut = servernet.FanOut(done.append)
+        conns = [c.connection for c in self.control.clients]
+        self.communicator.broadcast(conns, {'type': 'gm', 'subtype': 'timeup'},
+                fanOut)
+        assert fanOut.remaining == 2
+        conns[0].senderThread.take()
+        assert not done
+        assert conns[1].senderThread.take() == \
+                network.encode({'type': 'gm', 'subtype': 'timeup'})
+        assert done == [fanOut] and fanOut.elapsed >= 0
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+# Copyright 2009 University of Alaska Anchorage Experimental Economics
+# Laboratory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests for the Island reinit message.  Run from the top of the source tree:
+#   PYTHONPATH=. python peet/server/gamecontrollers/test/reinittest.py
+
+import unittest
+from decimal import Decimal
+
+from peet.server.gamecontrollers.IslandControl import IslandControl
+from peet.server.ClientData import ClientData
+from peet.server import GroupData
+from peet.server.MarketEventStore import MarketEventStore
+from peet.shared import network
+
+reinit_size_limit = 8000
+""" Upper bound on the encoded size of a reinit message, in bytes, for a round
+with a busy market """
+
+class Controller(IslandControl):
+    """ An IslandControl without a server; the test sets up its state. """
+    def __init__(self):
+        pass
+
+class ReinitTest(unittest.TestCase):
+
+    def makeController(self, numMatches, roundsPerMatch):
+        """ Return an IslandControl partway through its last round, as if it
+        had played the given number of matches and rounds, with a bid, an ask
+        and a transaction per player in each market in every round. """
+        control = Controller()
+        control.clients = [ClientData(i) for i in range(6)]
+        control.groups = GroupData.groupClients_simple(control.clients,
+                numGroups=1)
+        control.initParams = {}
+        for c in control.clients:
+            c.acct = {'dollars': Decimal('100.00'), 'blue': 0, 'red': 0,
+                    'green': 0, 'roundScore': 0, 'matchScore': 0}
+            c.events = []
+            c.matchInitMessage = {'type': 'gm', 'subtype': 'initmatch'}
+            c.unansweredMessage = None
+            control.initParams[c.id] = {'type': 'init',
+                    'GUIclass': 'IslandGUI'}
+        for g in control.groups:
+            g.mktHist = MarketEventStore()
+
+        for match in range(numMatches):
+            for c in control.clients:
+                c.events.append([])
+            for round in range(roundsPerMatch):
+                for c in control.clients:
+                    c.events[match].append({'productionChoice_blue': 3,
+                        'productionChoice_red': 3,
+                        'productionChoice_green': 4, 'prodShock': 0})
+                for g in control.groups:
+                    g.mktHist.startRound(match, round)
+                    for color in ('blue', 'red'):
+                        for c in g.clients:
+                            amount = Decimal('1.50') + c.id
+                            g.mktHist.append(match, round, color, 'bid',
+                                    buyer=c.id, price=amount)
+                            g.mktHist.append(match, round, color, 'ask',
+                                    seller=c.id, price=amount)
+                            g.mktHist.append(match, round, color, 'accept',
+                                    buyer=c.id, seller=c.id, price=amount)
+
+        control.matchNum = numMatches - 1
+        control.matchRoundNum = roundsPerMatch - 1
+        control.productionChoicesMade = ['blue', 'red']
+        control.auctionInProgress = True
+        return control
+
+    def reinitSize(self, control):
+        client = control.clients[0]
+        return len(network.encode(control.getReinitParams(client)))
+
+    def test_size_bounded(self):
+        size = self.reinitSize(self.makeController(10, 10))
+        assert size < reinit_size_limit, size
+
+    def test_size_independent_of_session_length(self):
+        short = self.reinitSize(self.makeController(1, 1))
+        long = self.reinitSize(self.makeController(10, 10))
+        assert short == long, (short, long)
+
+    def test_current_round(self):
+        control = self.makeController(3, 4)
+        client = control.clients[0]
+        m = control.getReinitParams(client)
+        assert m['events'] is client.events[2][3]
+        assert m['mktHist'] == client.group.mktHist.getRound(2, 3)
+        assert m['mktHist']['red'][-1] == {'Action': 'accept',
+                'Buyer': 5, 'Seller': 5, 'Accept': Decimal('6.50')}
+
+    def test_round_not_started(self):
+        control = self.makeController(1, 1)
+        control.matchNum = 1
+        control.matchRoundNum = 0
+        m = control.getReinitParams(control.clients[0])
+        assert m['events'] == {}
+        assert m['mktHist'] == {'blue': [], 'red': []}
+
+    def test_history(self):
+        control = self.makeController(3, 4)
+        client = control.clients[0]
+        m = control.getHistory(client)
+        assert m['type'] == 'history'
+        assert m['events'] is client.events
+        assert len(m['mktHist']) == 3 and len(m['mktHist'][2]) == 4
+        assert m['mktHist'][1][2] == client.group.mktHist.getRound(1, 2)
+        assert network.messageLane(m) == network.LANE_BULK
+
+
+if __name__ == '__main__': unittest.main()
@@ -0,0 +1,158 @@
+# Copyright 2009 University of Alaska Anchorage Experimental Economics
+# Laboratory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests for GameControl.sendState() and the Island account updates.  Run from
+# the top of the source tree:
+#   PYTHONPATH=. python peet/server/gamecontrollers/test/statesynctest.py
+
+import unittest
+from decimal import Decimal
+
+from peet.server.gamecontrollers import GameControl
+from peet.server.gamecontrollers.IslandControl import IslandControl
+from peet.server.ClientData import ClientData
+from peet.shared import schemas
+
+class Sender:
+    def __init__(self):
+        self.slow = False
+
+class Connection:
+    def __init__(self):
+        self.senderThread = Sender()
+
+class Communicator:
+    """ Keeps the messages sent instead of sending them. """
+    def __init__(self):
+        self.sent = []
+
+    def send(self, clientConn, message):
+        self.sent.append(message)
+
+class Controller(IslandControl):
+    """ An IslandControl without a server. """
+    def __init__(self):
+        self.communicator = Communicator()
+
+class StateSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.control = Controller()
+        self.client = ClientData(0, connection=Connection())
+        self.client.acct = {'dollars': Decimal('10.00'), 'blue': 0, 'red': 0,
+                'green': 0, 'roundScore': 0, 'matchScore': 0}
+
+    def update(self):
+        """ Send an account update, and return what was sent, if anything. """
+        sent = self.control.communicator.sent
+        n = len(sent)
+        self.control.sendAccountUpdate(self.client)
+        assert len(sent) <= n + 1
+        if len(sent) > n:
+            return sent[-1]
+        return None
+
+    def test_first_update_is_full(self):
+        m = self.update()
+        assert m['full'] and m['v'] == 1
+        assert m['acct'] == self.client.acct
+        assert m['acct'] is not self.client.acct
+
+    def test_patch(self):
+        self.update()
+        self.client.acct['dollars'] -= Decimal('1.50')
+        self.client.acct['blue'] += 1
+        m = self.update()
+        assert not m.has_key('full') and m['v'] == 2
+        assert m['acct'] == {'dollars': Decimal('8.50'), 'blue': 1}
+
+    def test_unchanged(self):
+        self.update()
+        assert self.update() == None
+        assert self.control.getStateVersion(self.client, 'acctUpdate') == 1
+
+    def test_snapshot_interval(self):
+        self.update()
+        for i in range(GameControl.state_snapshot_interval - 1):
+            self.client.acct['green'] += 1
+            assert not self.update().has_key('full')
+        self.client.acct['green'] += 1
+        m = self.update()
+        assert m['full'] and m['acct'] == self.client.acct
+
+    def test_slow_client(self):
+        self.update()
+        self.client.connection.senderThread.slow = True
+        self.client.acct['red'] = 3
+        m = self.update()
+        assert m['full']
+        assert self.control.getSupersedeKey(m) == 'acctUpdate'
+        self.client.connection.senderThread.slow = False
+        self.client.acct['red'] = 4
+        m = self.update()
+        assert self.control.getSupersedeKey(m) == None
+
+    def test_disconnected(self):
+        """ An update for a client that has just disconnected isn't sent, and
+        the next one is whole. """
+        self.update()
+        connection = self.client.connection
+        self.client.connection = None
+        self.client.acct['red'] = 3
+        assert self.update() == None
+        self.client.connection = connection
+        self.client.acct['blue'] = 2
+        m = self.update()
+        assert m['full'] and m['v'] == 2
+        assert m['acct'] == self.client.acct
+
+    def test_patches_replay(self):
+        """ Applying the updates in order, skipping patches no newer than the
+        last update applied, gives the account. """
+        acct = {}
+        version = 0
+        self.update()
+        updates = []
+        for i in range(50):
+            self.client.acct['dollars'] += 1
+            if i % 3 == 0:
+                self.client.acct['roundScore'] = i
+            updates.append(self.update())
+        for m in updates:
+            if m['v'] > version or m.get('full'):
+                acct.update(m['acct'])
+                version = m['v']
+        assert acct == self.client.acct, (acct, self.client.acct)
+
+    def test_schemas(self):
+        """ Whole accounts and the usual patches are sent as records. """
+        registry = schemas.SchemaRegistry.fromDeclarations(
+                IslandControl.messageSchemas)
+        full = self.update()
+        self.client.acct['dollars'] -= 2
+        self.client.acct['red'] += 1
+        self.client.acct['roundScore'] = 7
+        trade = self.update()
+        self.client.acct['matchScore'] = 7
+        endOfRound = self.update()
+        for m in (full, trade, endOfRound):
+            record = registry.encode(m)
+            assert record, m
+            assert registry.decode(record) == m
+        assert len(registry.encode(trade)) < len(registry.encode(full))
+
+if __name__ == '__main__':
+    unittest.main()
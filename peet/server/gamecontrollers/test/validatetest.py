@@ -0,0 +1,124 @@
+# Copyright 2009 University of Alaska Anchorage Experimental Economics
+# Laboratory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests for the screening of Island bids and asks as they arrive.  Run from
+# the top of the source tree:
+#   PYTHONPATH=. python peet/server/gamecontrollers/test/validatetest.py
+
+import unittest
+from decimal import Decimal
+
+from peet.server.gamecontrollers.test.islandstub import Controller
+from peet.server import servernet
+from peet.shared import log
+
+# The test drops plenty of messages on purpose.
+log.setLevel(log.ERROR, 'server.net')
+
+class ValidateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.control = Controller()
+        self.communicator = self.control.communicator
+        self.communicator.setValidator(self.control.validateMessage)
+        self.seller = servernet.ClientConnection(0, None, None)
+        self.buyer = servernet.ClientConnection(1, None, None)
+
+    def receive(self, clientConn, message):
+        """ Return True if the message gets through to the controller. """
+        message = dict(message, type='gm')
+        self.communicator.receiveGameMessage(clientConn, message)
+        item = self.communicator.recv_nowait()
+        assert item == None or item == (clientConn, message)
+        return item != None
+
+    def test_valid(self):
+        assert self.receive(self.buyer, {'subtype': 'bid',
+            'amount': Decimal('2.50')})
+        assert self.receive(self.seller, {'subtype': 'ask',
+            'amount': Decimal('3.00')})
+        assert self.receive(self.seller, {'choice': 2})
+        assert self.seller.getDropCount() == 0
+
+    def test_invalid(self):
+        for clientConn, message, reason in [
+                (self.buyer, {'subtype': 'bid', 'amount': 2}, 'invalid amount'),
+                (self.buyer, {'subtype': 'bid'}, 'invalid amount'),
+                (self.buyer, {'subtype': 'bid', 'amount': Decimal('-1')},
+                    'invalid amount'),
+                (self.buyer, {'subtype': 'bid', 'amount': Decimal('NaN')},
+                    'invalid amount'),
+                (self.seller, {'subtype': 'ask',
+                    'amount': Decimal('Infinity')}, 'invalid amount'),
+                (self.seller, {'subtype': 'ask',
+                    'amount': Decimal('30000000.00')}, 'invalid amount'),
+                (self.seller, {'subtype': 'bid', 'amount': Decimal('2')},
+                    'wrong role'),
+                (self.buyer, {'subtype': 'ask', 'amount': Decimal('2')},
+                    'wrong role'),
+                (self.buyer, {'subtype': 'cancel'}, 'no order book'),
+                (self.buyer, {'subtype': 'shout'}, 'unknown subtype'),
+                ]:
+            assert not self.receive(clientConn, message), message
+            assert clientConn.dropped.get(reason), (message, clientConn.dropped)
+        assert self.buyer.getDropCount() == 7
+
+    def test_no_auction(self):
+        self.control.auctionInProgress = False
+        assert not self.receive(self.buyer, {'subtype': 'bid',
+            'amount': Decimal('2.50')})
+        assert self.buyer.dropped == {'no auction': 1}
+
+    def test_not_logged_in(self):
+        clientConn = servernet.ClientConnection(None, None, None)
+        assert not self.receive(clientConn, {'choice': 1})
+        assert clientConn.dropped == {'not logged in': 1}
+
+    def test_rate_limit(self):
+        self.communicator.setRateLimit((1, 5))
+        passed = 0
+        for i in range(20):
+            if self.receive(self.seller, {'subtype': 'ask',
+                    'amount': Decimal('3.00')}):
+                passed += 1
+        assert passed == 5, passed
+        assert self.seller.dropped == {'over rate limit': 15}
+        # The other client has its own limit.
+        assert self.receive(self.buyer, {'subtype': 'bid',
+            'amount': Decimal('2.50')})
+
+    def test_reply_not_rate_limited(self):
+        """ A client that used up its limit bidding still gets its
+        production choice through. """
+        self.communicator.setRateLimit((1, 5))
+        for i in range(10):
+            self.receive(self.buyer, {'subtype': 'bid',
+                'amount': Decimal('2.50')})
+        assert self.buyer.dropped == {'over rate limit': 5}
+        assert self.receive(self.buyer, {'choice': 1})
+
+    def test_rate_limiter(self):
+        limiter = servernet.RateLimiter(10, 2)
+        now = limiter.lastTime
+        assert limiter.allow(now) and limiter.allow(now)
+        assert not limiter.allow(now)
+        assert limiter.allow(now + 0.15)
+        assert not limiter.allow(now + 0.15)
+        assert limiter.allow(now + 10) and limiter.allow(now + 10)
+        assert not limiter.allow(now + 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+# Copyright 2009 University of Alaska Anchorage Experimental Economics
+# Laboratory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Writing of output data files in the background, so that game controllers
+# never wait on the disk (which may be a slow network share).
+
+import os
+import csv
+import thread
+import time
+import Queue
+
+from peet.server import servernet
+from peet.shared import log
+
+logger = log.getLogger('server.output')
+
+batch_size = 500
+""" The most queued requests the writer handles before flushing its files """
+
+class OutputWriter:
+
+    """
+    Writes rows to CSV output files on a thread of its own.  The files are
+    kept open between writes, and rows are written in batches.  Calls only
+    queue requests, so they return immediately; requests are carried out in
+    the order they're made.
+    """
+
+    def __init__(self, onError=None):
+        """
+        @param onError: called on the writer's thread with a description of
+        the first request that fails (e.g. because the disk is full); later
+        failures are only logged and counted
+        """
+        self.queue = Queue.Queue()
+        self.onError = onError
+        self.failures = 0  # How many requests failed
+        self.files = {}  # (file, csv writer) by filename
+        # How long rows waited between being queued and being written
+        self.latencyStats = servernet.LatencyStats()
+        self.lastSyncTime = None  # How long the last sync() took, in seconds
+        self.finished = thread.allocate_lock()
+
+    def Start(self):
+        self.finished.acquire()
+        thread.start_new_thread(self.Run, ())
+
+    def Stop(self):
+        """ Close the files once everything queued so far is written. """
+        self.queue.put(None)
+
+    def open(self, filename, headers=None):
+        """ Create (or truncate) a CSV file.  With headers, it's written with a
+        csv.DictWriter, starting with a row of the headers; otherwise rows are
+        lists, as for a csv.writer. """
+        self.queue.put(('open', filename, headers))
+
+    def writeRow(self, filename, *parts):
+        """ Append a row to a file opened with open().  For a file with
+        headers, the row is made by merging the given dictionaries, later ones
+        taking precedence; otherwise, pass a single list.  They're used later,
+        on the writer's thread, so they mustn't be changed afterwards. """
+        self.queue.put(('row', filename, parts, time.time()))
+
+    def writeRows(self, filename, rows):
+        """ Append rows to a file, as with writeRow() (but each row is a
+        single dict or list).  rows may be any iterable; a generator, for
+        example, is run on the writer's thread. """
+        self.queue.put(('rows', filename, rows, time.time()))
+
+    def sync(self):
+        """ Make sure everything written so far is on the disk (e.g. at the end
+        of a round). """
+        self.queue.put(('sync',))
+
+    def getBacklog(self):
+        """ Return the number of requests waiting to be carried out. """
+        return self.queue.qsize()
+
+    def getLatencyStats(self):
+        """ Return the LatencyStats of how long rows waited to be written. """
+        return self.latencyStats
+
+    def waitUntilStopped(self, timeout=None):
+        """ Wait for the writer to finish after Stop(), for up to timeout
+        seconds if given.  Return True if it has finished. """
+        if timeout == None:
+            self.finished.acquire()
+            self.finished.release()
+            return True
+        end = time.time() + timeout
+        while not self.finished.acquire(False):
+            if time.time() > end:
+                return False
+            time.sleep(0.05)
+        self.finished.release()
+        return True
+
+    def Run(self):
+        try:
+            while True:
+                # Handle everything queued, up to a batch, then flush
+                requests = [self.queue.get()]
+                try:
+                    while len(requests) < batch_size:
+                        requests.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    pass
+
+                for request in requests:
+                    if request == None:
+                        self.close()
+                        return
+                    try:
+                        self.handle(request)
+                    except Exception, e:
+                        logger.exception('Failed to handle %s',
+                                request[:2])
+                        if request[0] == 'sync':
+                            self.failed('Failed to sync output files: %s' % e)
+                        else:
+                            self.failed('Failed to write %s: %s' % (request[1],
+                                e))
+
+                for file, writer in self.files.values():
+                    try:
+                        file.flush()
+                    except (IOError, OSError), e:
+                        logger.exception('Failed to flush %s', file.name)
+                        self.failed('Failed to write %s: %s' % (file.name, e))
+        finally:
+            self.finished.release()
+
+    def handle(self, request):
+        kind = request[0]
+        if kind == 'row':
+            filename, parts, queuedTime = request[1:]
+            file, writer = self.files[filename]
+            if isinstance(writer, csv.DictWriter):
+                row = {}
+                for part in parts:
+                    row.update(part)
+                writer.writerow(row)
+            else:
+                writer.writerow(parts[0])
+            self.latencyStats.record(time.time() - queuedTime)
+
+        elif kind == 'rows':
+            filename, rows, queuedTime = request[1:]
+            file, writer = self.files[filename]
+            for row in rows:
+                writer.writerow(row)
+                self.latencyStats.record(time.time() - queuedTime)
+
+        elif kind == 'open':
+            filename, headers = request[1:]
+            if self.files.has_key(filename):
+                self.files.pop(filename)[0].close()
+            file = open(filename, 'wb')
+            if headers == None:
+                writer = csv.writer(file)
+            else:
+                writer = csv.DictWriter(file, headers)
+                csv.writer(file).writerow(headers)
+            self.files[filename] = (file, writer)
+
+        elif kind == 'sync':
+            start = time.time()
+            for file, writer in self.files.values():
+                file.flush()
+                os.fsync(file.fileno())
+            self.lastSyncTime = time.time() - start
+
+    def close(self):
+        for file, writer in self.files.values():
+            try:
+                file.flush()
+                os.fsync(file.fileno())
+                file.close()
+            except (IOError, OSError), e:
+                logger.exception('Failed to close %s', file.name)
+                self.failed('Failed to close %s: %s' % (file.name, e))
+        self.files = {}
+
+    def failed(self, text):
+        self.failures += 1
+        if self.failures == 1 and self.onError != None:
+            try:
+                self.onError(text)
+            except:
+                logger.exception('Error reporting a failure')
+
+    def __str__(self):
+        stats = self.latencyStats
+        s = '%d requests queued; %d rows written, waiting %.2f ms on ' \
+                'average, %.2f ms at most' % (self.getBacklog(), stats.count,
+                        stats.getMean() * 1000, stats.max * 1000)
+        if self.lastSyncTime != None:
+            s += '; last sync took %.2f ms' % (self.lastSyncTime * 1000)
+        if self.failures:
+            s += '; %d requests failed' % self.failures
+        return s
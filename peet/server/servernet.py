@@ -25,19 +25,31 @@ Every message is a dictionary, assumed to have at least a 'type' key.
 Communicator pickles before sending and unpickles after receiving.  Messages
 are communicated to the server through the postEvent method that the server
 passes in.  If the message['type'] is 'gm' (for Game Message), then the
-message is also put on a queue for retrieval by the game controller using the
-recv() and recv_nowait() methods.
+message is instead put on a queue for retrieval by the game controller using
+the recv() and recv_nowait() methods.  Pings, and any other types the server
+routes (see Router), are handled in the network thread and not posted either,
+so that only the events the server GUI needs go through its event queue.
+
+There are two implementations of the Communicator.  The original one uses a
+ListenerThread and a network.SenderThread for every client.
+EventLoopCommunicator instead runs a single thread that waits for all client
+sockets at once (using epoll where available, or select) and does all reading
+and writing itself.  Both have the same interface.
 
 Inspired by s2cthread by Theodore Turocy
 turocy@econmail.tamu.edu
 """
 
-import sys
+import os
+import binascii
 import socket
+import select
+import errno
 import thread
-
-# Higher-level interface, for Timer; should probably use for everything
-import threading
+import collections
+import heapq
+import bisect
+import itertools
 
 import Queue
 import time
@@ -45,6 +57,44 @@ import time
 
 from peet.shared import cerealizer
 from peet.shared import network
+from peet.shared import schemas
+from peet.shared import log
+
+logger = log.getLogger('server.net')
+
+# What to do when a client's send queue grows past its limit (see
+# network.SendQueue).  SLOW_COLLAPSE sends newer messages in place of queued
+# ones with the same supersede key (see setSupersedeKey()).
+# SLOW_PAUSE leaves the queue alone; the server GUI pauses the session until
+# the client catches up.  Either way, a {'type': 'slow'} event is posted.
+SLOW_COLLAPSE = 'collapse'
+SLOW_PAUSE = 'pause'
+slow_policies = (SLOW_COLLAPSE, SLOW_PAUSE)
+
+sync_burst = 4
+""" Number of sync round trips made back to back with each client as soon as
+it connects, before settling down to one every <sync_interval> seconds """
+
+sync_interval = 5.0
+""" Number of seconds between sync round trips with each client after the
+initial burst """
+
+sync_window = 16
+""" Number of most recent sync samples each ClockSync takes the clock offset
+from """
+
+sync_anchors = 8
+""" Number of blocks of <sync_window> samples each ClockSync estimates the
+clock drift over """
+
+close_timeout = 5.0
+""" Number of seconds a connection closed with closeWhenSent() waits, after the
+last message is out, for the client to close its end before it's closed
+outright """
+
+replay_limit = 2000
+""" Maximum number of unacknowledged messages each Session keeps for resending.
+A client that has missed more than this can't resume its session. """
 
 class Communicator:
 
@@ -63,14 +113,50 @@ class Communicator:
 
         # The inQueue contains all incoming client messages waiting to be
         # processed.  Each element in the queue is a tuple in the form
-        # (clientConnection, messageDict)
+        # (clientConnection, messageDict, time received)
         self.inQueue = Queue.Queue()
 
+        # While shard queues are open (see openShardQueues()), game messages
+        # go to the queue of the sender's shard instead, indexed by shard.
+        self.shardKey = None  # See setShardKey()
+        self.shardQueues = None
+        self.shardLock = thread.allocate_lock()
+
+        # How long game messages waited to be received, by shard (see
+        # getLatencyStats())
+        self.latencyStats = {}
+
         self.paused = False
         self.pauseLock = thread.allocate_lock()
 
         self.timer = None
 
+        # The SchemaRegistry used to pack game messages for clients that
+        # support it (see setMessageSchemas())
+        self.schemas = None
+
+        self.slowClientPolicy = SLOW_COLLAPSE
+        self.supersedeKey = None  # See setSupersedeKey()
+
+        # Screening of incoming game messages (see receiveGameMessage())
+        self.validator = None  # See setValidator()
+        self.rateLimit = None  # See setRateLimit()
+
+        # Runs every timer in the server, including the game timer (see
+        # startTimer()) and the clock sync probes (see startClockSync())
+        self.scheduler = Scheduler()
+
+        # Sessions indexed by token (see startSession())
+        self.sessions = {}
+
+        # Messages that are handled here rather than posted.  Game messages go
+        # to the inQueue (if they pass screening), and pings have already done
+        # their job (keeping the connection alive and carrying
+        # acknowledgements) by the time they are dispatched.
+        self.router = Router()
+        self.router.route('gm', self.receiveGameMessage)
+        self.router.route('ping', lambda clientConn, message: None)
+
     def acceptConnections(self):
         """
         Start accepting client connections, placing each connection message in
@@ -84,11 +170,13 @@ class Communicator:
             # to prevent socket.error: (98, 'Address already in use'):
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             sock.bind(('', self.port))
+            # Lab machines tend to connect all at once.
+            sock.listen(16)
             while True:
-                sock.listen(1)
                 csock, addr = sock.accept()
                 csock.settimeout(network.timeout)
                 clientConn = ClientConnection(None, csock, addr)
+                clientConn.communicator = self
                 self.postEvent(clientConn, {'type': 'connect'})
                     # Need to post 'connect' message before starting the
                     # listenerThread; otherwise we may get the 'login' message
@@ -99,10 +187,15 @@ class Communicator:
                     # --autostart is enabled, the server may try to start the
                     # game before the senderthread has been started -> crash
                 clientConn.senderThread = network.SenderThread(csock)
+                self.watchSendQueue(clientConn)
                 clientConn.senderThread.Start()
+                # Offer the client a better framing than FRAMING_ASCII.  Old
+                # clients just ignore this.
+                clientConn.senderThread.send({'type': 'framing',
+                    'offer': network.framing_modes})
                 clientConn.listenerThread = ListenerThread(self, clientConn)
                 clientConn.listenerThread.Start()
-                clientConn.sync()
+                self.startClockSync(clientConn)
 
         thread.start_new_thread(run, ())
 
@@ -120,7 +213,7 @@ class Communicator:
             self.pauseLock.acquire()
             self.pauseLock.release()
 
-        return self.inQueue.get()
+        return self.received(self.inQueue.get())
 
     def recv_nowait(self):
         """ Return (clientConn, messageDict), or None if no message is
@@ -133,7 +226,218 @@ class Communicator:
         except Queue.Empty:
             return None
         else:
-            return mes
+            return self.received(mes)
+
+    def recvShard(self, shard):
+        """ Like recv(), but return the next game message from a client in the
+        given shard, while shard queues are open (see openShardQueues()).  The
+        timer's timeup message is received by every shard. """
+        if self.paused:
+            self.pauseLock.acquire()
+            self.pauseLock.release()
+
+        return self.received(self.shardQueues[shard].get(), shard)
+
+    def receiveGameMessage(self, clientConn, message):
+        """ Screen a game message received from a client, and queue it (see
+        queueGameMessage()) if it passes.  Messages from a client without an
+        ID (not logged in), over the rate limit (see setRateLimit()) or
+        rejected by the validator (see setValidator()) are dropped, in the
+        thread that received them, so that they cost the game controller
+        nothing.  Each connection counts the messages it dropped, by reason
+        (see ClientConnection.dropped).
+
+        Replies (game messages without a subtype, e.g. answers to
+        GameControl.askAllPlayers()) aren't rate limited: the controller waits
+        for every one, so dropping one would hang the game. """
+        if clientConn.id == None:
+            reason = 'not logged in'
+        elif self.rateLimit != None and message.has_key('subtype') and \
+                not self.allowMessage(clientConn):
+            reason = 'over rate limit'
+        elif self.validator != None:
+            reason = self.validator(clientConn, message)
+        else:
+            reason = None
+        if reason == None:
+            self.queueGameMessage(clientConn, message)
+            return
+
+        # Only one thread at a time receives from a connection, so the counts
+        # need no lock.
+        count = clientConn.dropped.get(reason, 0) + 1
+        clientConn.dropped[reason] = count
+        if count == 1:
+            logger.warning('Dropped game message from client %s (%s): %s',
+                    clientConn.id, reason, message)
+        else:
+            logger.debug('Dropped game message from client %s (%s): %s',
+                    clientConn.id, reason, message)
+
+    def allowMessage(self, clientConn):
+        """ Return True if the client is within the rate limit, counting one
+        more message. """
+        limiter = clientConn.rateLimiter
+        if limiter == None or limiter.limit != self.rateLimit:
+            limiter = clientConn.rateLimiter = RateLimiter(*self.rateLimit)
+        return limiter.allow()
+
+    def setValidator(self, validator):
+        """ Set the function that checks each game message received from a
+        logged-in client before it's queued for the game controller.  It takes
+        the ClientConnection and the message, and returns None to pass the
+        message, or a short string saying why it's dropped.  It's called in
+        the network threads, possibly several at once.
+        @param validator: a function, or None """
+        self.validator = validator
+
+    def setRateLimit(self, rateLimit):
+        """ Limit the game messages received from each client to an average
+        rate, allowing bursts (see RateLimiter); messages over the limit are
+        dropped.  Replies aren't limited (see receiveGameMessage()).
+        @param rateLimit: (messages per second, burst), or None for no
+        limit """
+        if rateLimit != None:
+            rateLimit = tuple(rateLimit)
+        self.rateLimit = rateLimit
+
+    def queueGameMessage(self, clientConn, message):
+        """ Put a game message received from a client on the queue it will be
+        received from. """
+        item = (clientConn, message, time.time())
+        self.shardLock.acquire()
+        try:
+            if self.shardQueues != None:
+                queue = self.shardQueues.get(self.shardKey(clientConn))
+                if queue != None:
+                    queue.put(item)
+                    return
+            self.inQueue.put(item)
+        finally:
+            self.shardLock.release()
+
+    def received(self, item, shard=None):
+        """ Record how long a queued message waited, and return it as
+        (clientConn, messageDict).  The message is given the server times it
+        was received from the network ('receivedTime') and from the queue
+        ('dequeuedTime'), and if the client stamped it with the time it was
+        sent by the client's clock ('ct'), how long it took to arrive
+        ('latency'), by the estimated clock offset (see ClockSync). """
+        clientConn, message, receivedTime = item
+        if clientConn != None:
+            now = time.time()
+            if shard == None and self.shardKey != None:
+                shard = self.shardKey(clientConn)
+            stats = self.latencyStats.get(shard)
+            if stats == None:
+                stats = self.latencyStats[shard] = LatencyStats()
+            stats.record(now - receivedTime)
+            message['receivedTime'] = receivedTime
+            message['dequeuedTime'] = now
+            if type(message.get('ct')) == float:
+                message['latency'] = receivedTime - message['ct'] + \
+                        clientConn.getClockOffset(receivedTime)
+        return clientConn, message
+
+    def setShardKey(self, shardKey):
+        """ Set the function that gives the shard a client belongs to: a part
+        of the game (such as a group) whose messages can be handled
+        independently of the others'.  Latency is measured per shard (see
+        getLatencyStats()), and while shard queues are open, each shard's
+        messages are received separately.  The function takes a
+        ClientConnection and returns a key, or None if it isn't in a shard.
+        @param shardKey: a function, or None """
+        self.shardKey = shardKey
+
+    def openShardQueues(self, shards):
+        """ Put game messages from then on in a separate queue for each of the
+        given shards, to be received with recvShard(), so that a burst of
+        messages in one shard doesn't hold up the others.  Messages from
+        clients in none of them still go to recv().  Requires a shard key
+        function (see setShardKey()).
+        @param shards: a list of shard keys """
+        self.shardLock.acquire()
+        self.shardQueues = dict([(shard, Queue.Queue()) for shard in shards])
+        self.shardLock.release()
+
+    def closeShardQueues(self):
+        """ Go back to putting all game messages in the queue for recv().
+        Replies (game messages without a subtype) left unreceived in the shard
+        queues are put in it first.  Other messages left over were meant for
+        the shards (e.g. bids that arrived after a shard stopped receiving),
+        so they're dropped rather than handed to whatever the controller
+        receives next. """
+        self.shardLock.acquire()
+        try:
+            if self.shardQueues == None:
+                return
+            leftover = []
+            dropped = 0
+            for queue in self.shardQueues.values():
+                while True:
+                    try:
+                        item = queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if item[0] == None:
+                        # (Timeup messages are for the shards only.)
+                        continue
+                    if item[1].has_key('subtype'):
+                        dropped += 1
+                    else:
+                        leftover.append(item)
+            if dropped:
+                logger.info('Dropped %d game messages left in shard queues',
+                        dropped)
+            leftover.sort(key=lambda item: item[2])
+            for item in leftover:
+                self.inQueue.put(item)
+            self.shardQueues = None
+        finally:
+            self.shardLock.release()
+
+    def getLatencyStats(self, shard=None):
+        """ Return the LatencyStats of game messages from clients in the given
+        shard (None for clients in no shard): how long they waited between
+        being received from the network and being received by the game
+        controller. """
+        stats = self.latencyStats.get(shard)
+        if stats == None:
+            stats = self.latencyStats[shard] = LatencyStats()
+        return stats
+
+    def dispatch(self, clientConn, message, reader):
+        """ Deliver a message received from a client: transport-level messages
+        are handled here, those the router has a route for (including game
+        messages, which go on the incoming queue) are handled by the router,
+        and everything else is passed to postEvent.  Called by whichever thread
+        received the message.
+        @param reader: the network.MessageReader the message was read from """
+        if clientConn.closing:
+            # See ClientConnection.closeWhenSent()
+            return
+        if message['type'] == 'sync':
+            # Transport-level: the client's reply to a ClockSync probe
+            if clientConn.clockSync != None:
+                clientConn.clockSync.onReply(message, time.time())
+            return
+        elif message['type'] == 'ack':
+            # Transport-level
+            if clientConn.session != None:
+                clientConn.session.acknowledge(message['seq'])
+            return
+        elif message['type'] == 'ping':
+            if clientConn.session != None and message.has_key('ack'):
+                clientConn.session.acknowledge(message['ack'])
+        elif message['type'] == 'framing':
+            # Transport-level; the server doesn't need to see it.
+            network.negotiateFraming(message, reader, clientConn.senderThread)
+            return
+        if clientConn.session != None and \
+                message['type'] in network.sequenced_types:
+            clientConn.session.onReceived(clientConn)
+        if not self.router.handle(clientConn, message):
+            self.postEvent(clientConn, message)
 
     def send(self, clientConn, message):
         if self.paused and message['type'] == 'gm':
@@ -142,7 +446,142 @@ class Communicator:
             # reconnection process).
             self.pauseLock.acquire()
             self.pauseLock.release()
-        clientConn.senderThread.send(message)
+        self.deliver([clientConn], message)
+
+    def broadcast(self, clientConns, message, fanOut=None):
+        """ Send the same message to each of the given clients.  The message is
+        serialized only once, and the resulting string is shared by all of the
+        clients' send queues.  Pausing works as in send().
+        @param clientConns: a list of ClientConnection objects
+        @param fanOut: a FanOut to follow the message out to the clients, or
+        None """
+        if self.paused and message['type'] == 'gm':
+            self.pauseLock.acquire()
+            self.pauseLock.release()
+        self.deliver(clientConns, message, fanOut)
+
+    def deliver(self, clientConns, message, fanOut=None):
+        """ Encode the message and queue it for each of the given clients,
+        encoding it at most once in each format: as a schema record for clients
+        that have negotiated a framing other than FRAMING_ASCII (which all
+        understand schemas), and with network.encode() for the rest, or if the
+        message doesn't match any schema.  With a FanOut, each client's copy
+        is tracked until it is taken off the client's send queue. """
+        data = {}  # framing -> message encoded with network.encode()
+        record = None
+        registry = self.schemas
+        key = None
+        if self.supersedeKey != None:
+            key = self.supersedeKey(message)
+        lane = network.messageLane(message)
+        sequenced = message['type'] in network.sequenced_types
+        if fanOut != None:
+            fanOut.start(len(clientConns))
+        for clientConn in clientConns:
+            session = None
+            if sequenced and clientConn.session != None:
+                session = clientConn.session
+                session.lock.acquire()
+                # If the client has resumed the session on a new connection,
+                # send it there.
+                clientConn = session.clientConn
+            try:
+                sender = clientConn.senderThread
+                payload = None
+                if registry != None and \
+                        sender.framing != network.FRAMING_ASCII:
+                    if record == None:
+                        record = registry.encode(message) or ''
+                    if record:
+                        if clientConn.schemas is not registry:
+                            # The client has to have the schemas before the
+                            # first record.
+                            clientConn.schemas = registry
+                            sender.send({'type': 'schemas',
+                                'schemas': registry.describe()})
+                        payload = record
+                if payload == None:
+                    framing = sender.framing
+                    if not data.has_key(framing):
+                        data[framing] = network.encode(message, framing)
+                    payload = data[framing]
+                if fanOut != None:
+                    payload = network.Tracked(payload,
+                            lambda clientConn=clientConn:
+                                fanOut.sent(clientConn))
+                item = sender.sendEncoded(payload, key, lane)
+                if session != None and item != None:
+                    session.record(item)
+            finally:
+                if session != None:
+                    session.lock.release()
+
+    def watchSendQueue(self, clientConn):
+        """ Apply the slow client policy to a new client's send queue, and post
+        a {'type': 'slow', 'slow': <bool>, 'depth': <queue depth>} event
+        whenever the client becomes slow or catches up again. """
+        sender = clientConn.senderThread
+        sender.collapse = (self.slowClientPolicy == SLOW_COLLAPSE)
+
+        def onSlowChanged(slow):
+            self.postEvent(clientConn, {'type': 'slow', 'slow': slow,
+                'depth': sender.getQueueDepth()})
+        sender.onSlowChanged = onSlowChanged
+
+    def setSupersedeKey(self, supersedeKey):
+        """ Set the function that gives the supersede key of an outgoing
+        message (see network.SendQueue): while a client is slow, a queued
+        message is dropped when another one with the same key is sent to the
+        same client.  The function takes the message and returns a key, or
+        None for messages that must all be delivered.
+        @param supersedeKey: a function, or None """
+        self.supersedeKey = supersedeKey
+
+    def startSession(self, clientConn):
+        """ Start a new session for a client that has just logged in, and send
+        the client its token.  Any session it had before is forgotten.
+        @return the Session """
+        if clientConn.session != None:
+            self.endSession(clientConn.session)
+        session = Session(clientConn)
+        self.sessions[session.token] = session
+        # The token has to be queued before any message numbered in the
+        # session, so deliver() mustn't see the session until it is.
+        session.lock.acquire()
+        try:
+            self.send(clientConn, {'type': 'session', 'token': session.token})
+            clientConn.session = session
+        finally:
+            session.lock.release()
+        return session
+
+    def endSession(self, session):
+        if self.sessions.get(session.token) is session:
+            del self.sessions[session.token]
+
+    def getSession(self, token):
+        """ Return the Session with the given token, or None. """
+        return self.sessions.get(token)
+
+    def resumeSession(self, clientConn, session, seq):
+        """ Continue a session on a client's new connection, resending
+        everything the client hasn't received.
+        @param seq: the number of the last sequenced message the client
+        received
+        @return False if the messages the client missed are no longer kept """
+        return session.resume(clientConn, seq)
+
+    def setMessageSchemas(self, declarations):
+        """ Pack game messages that match one of the given schemas (see
+        peet.shared.schemas) into compact records for the clients that support
+        it.  Each client is sent the schemas before its first record.
+        @param declarations: a list like GameControl.messageSchemas, or None
+        """
+        if declarations:
+            self.schemas = schemas.SchemaRegistry.fromDeclarations(
+                    declarations)
+        else:
+            self.schemas = None
 
     def pause(self):
         """ Cause all calls to recv(), recv_nowait() to block until unpause() is
@@ -175,22 +614,32 @@ class Communicator:
 
         def timeup():
             self.timer = None
-            self.inQueue.put((None, {'type': 'gm', 'subtype': 'timeup'}))
+            item = (None, {'type': 'gm', 'subtype': 'timeup'}, time.time())
+            self.shardLock.acquire()
+            try:
+                if self.shardQueues != None:
+                    for queue in self.shardQueues.values():
+                        queue.put(item)
+                else:
+                    self.inQueue.put(item)
+            finally:
+                self.shardLock.release()
 
-        self.timer = threading.Timer(interval, timeup)
-        self.timer.start()
         self.timerStartTime = time.time()
+        self.timer = self.scheduler.callLater(interval, timeup)
 
     def cancelTimer(self):
         """ Cancel the timer, and don't send the timeup message.  No effect if
         the timer is not running.  Also sets a variable self.timeLeftAtCancel
         that is the number of seconds remaining on the timer at the moment it
         was canceled. """
-        if self.timer != None:
-            self.timer.cancel()
+        timer = self.timer
+        if timer != None:
+            timer.cancel()
+            self.timer = None
             elapsed = time.time() - self.timerStartTime
             self.timeLeftAtCancel = self.timerInterval - elapsed
-            print 'timeLeftAtCancel =', self.timeLeftAtCancel
+            logger.debug('timeLeftAtCancel = %s', self.timeLeftAtCancel)
 
     def getTimeElapsed(self):
         """ Get the number of seconds since the timer was started. """
@@ -201,6 +650,12 @@ class Communicator:
         #              Total time - elapsed time
         return self.timerInterval - (time.time() - self.timerStartTime)
 
+    def startClockSync(self, clientConn):
+        """ Start keeping the client's clock offset up to date in the
+        background (see ClockSync). """
+        clientConn.clockSync = ClockSync(self.scheduler, clientConn)
+        clientConn.clockSync.start()
+
 
 class ClientConnection:
 
@@ -215,44 +670,573 @@ class ClientConnection:
         self.id = id
         self.sock = sock
         self.address = address
+        self.communicator = None  # The Communicator that accepted it
         self.listenerThread = None
         self.senderThread = None
-        self.syncQueue = Queue.Queue() # Client's sync replies get put here
+        # Set if the connection is run by an EventLoop
+        self.eventLoop = None
+        self.loopConnection = None
+        self.schemas = None  # The SchemaRegistry last sent to the client
+        self.session = None  # See Communicator.startSession()
+        # Estimated client clock minus server clock, and the most it may be
+        # off by, in seconds.  Kept up to date by clockSync (see ClockSync).
         self.clockOffset = 0
+        self.clockUncertainty = None
+        self.clockSync = None
+        self.closing = False  # See closeWhenSent()
+        # Number of game messages dropped by Communicator.receiveGameMessage(),
+        # by reason
+        self.dropped = {}
+        self.rateLimiter = None  # See Communicator.setRateLimit()
+
+    def getDropCount(self):
+        """ Return the number of game messages dropped, for all reasons. """
+        return sum(self.dropped.values())
 
     def close(self):
         """ Shut down the listenerThread, the senderThread, and close the
         socket. """
+        if self.clockSync != None:
+            self.clockSync.stop()
+        if self.eventLoop != None:
+            # The event loop owns the socket, so it has to be the one to close
+            # it.
+            self.eventLoop.closeConnection(self)
+            return
         self.listenerThread.Stop()
         self.senderThread.Stop()
         try:
             self.sock.shutdown(socket.SHUT_RDWR)
         except socket.error:
-            print 'ClientConnection.close(): caught exception on '\
-                    + 'sock.shutdown() (OK)'
+            logger.debug('ClientConnection.close(): caught exception on '
+                    'sock.shutdown() (OK)')
 
         self.sock.close()
 
-    def sync(self):
-        """ Synchronize with the client (that is, learn the difference between
-        the server's clock and the client's clock). """
+    def closeWhenSent(self, message=None):
+        """ Send the given message (if any), and close the connection once it
+        and everything queued before it have been sent.  Returns right away.
+        Once the last message is out, the sending side of the socket is shut
+        down; the client closes its end in response, and the 'disconnect' event
+        follows as usual.  A client that doesn't close its end within
+        close_timeout seconds is disconnected anyway.  Messages received from
+        the client in the meantime are ignored. """
+        self.closing = True
+        if self.clockSync != None:
+            self.clockSync.stop()
+        if message != None:
+            self.senderThread.send(message)
+        if self.eventLoop != None:
+            self.eventLoop.closeConnectionWhenSent(self)
+            return
+        self.senderThread.onStop = self.shutdownSending
+        self.senderThread.Stop()
+
+    def shutdownSending(self):
+        """ Shut down the sending side of the socket, after the last message.
+        Closing the socket outright could reset the connection before the
+        client has read everything.  Not every client closes its end in
+        response, so the connection is closed for good after close_timeout
+        seconds. """
+        try:
+            self.sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        if self.communicator != None:
+            self.communicator.scheduler.callLater(close_timeout, self.close)
+
+    def getClockOffset(self, t=None):
+        """ Return the estimated client clock minus server clock at server time
+        t (default now), corrected for drift. """
+        if self.clockSync == None:
+            return self.clockOffset
+        return self.clockSync.getOffset(t)
+
+
+class Session:
+
+    """
+    What the server keeps of its conversation with one client, so that the
+    client can pick it up again on a new connection after losing one.
+
+    Each sequenced message sent to the client (see network.sequenced_types) is
+    numbered, and kept until the client acknowledges it, up to <replay_limit>
+    messages.  A client that reconnects presents the session's token and the
+    number of the last message it received, and is sent everything after that
+    (see resume()).  How long this takes depends only on how much the client
+    missed.  In return, it's told how many sequenced messages the server
+    received from it, and resends those that were lost.
+
+    Communicator.deliver() holds the lock while it numbers and queues each
+    message, so that resume() sees every message either in the replay buffer or
+    not at all.
+    """
+
+    def __init__(self, clientConn):
+        self.token = binascii.hexlify(os.urandom(16))
+        self.clientConn = clientConn  # The client's current connection
+        self.seq = 0  # Number of the last message sent
+        # Number of sequenced messages received from the client; only the
+        # thread reading the client's current connection changes it
+        self.received = 0
+        self.replay = collections.deque(maxlen=replay_limit)  # (seq, item)
+        self.lock = thread.allocate_lock()
+
+    def record(self, item):
+        """ Number a message that has just been queued for the client.
+        @param item: what was queued (see network.SendQueue.sendEncoded()) """
+        self.seq += 1
+        self.replay.append((self.seq, item))
+
+    def acknowledge(self, seq):
+        """ Forget the messages the client has received, up to number seq. """
+        self.lock.acquire()
+        while self.replay and self.replay[0][0] <= seq:
+            self.replay.popleft()
+        self.lock.release()
+
+    def onReceived(self, clientConn):
+        """ Count a sequenced message received from the client, and
+        acknowledge it if it's time to, so that the client can stop keeping
+        the messages it sent for resending. """
+        self.received += 1
+        if self.received % network.ack_interval == 0:
+            clientConn.senderThread.send({'type': 'ack',
+                'seq': self.received})
+
+    def resume(self, clientConn, seq):
+        """ Continue the session on a new connection (see
+        Communicator.resumeSession()). """
+        self.lock.acquire()
+        try:
+            if self.replay:
+                first = self.replay[0][0]
+            else:
+                first = self.seq + 1
+            if type(seq) not in (int, long) or not first - 1 <= seq <= self.seq:
+                return False
+            self.clientConn = clientConn
+            clientConn.session = self
+            sender = clientConn.senderThread
+            # The client resends what it sent after the messages received.
+            sender.send({'type': 'resumed', 'seq': seq,
+                'received': self.received})
+            for n, item in self.replay:
+                if n > seq:
+                    if isinstance(item, network.Supersedable):
+                        item = item.data
+                    if isinstance(item, network.Tracked):
+                        item = item.data
+                    sender.sendEncoded(item)
+            return True
+        finally:
+            self.lock.release()
+
+
+class ClockSync:
+
+    """
+    Estimates the offset between one client's clock and the server's.
+
+    Each round trip (probe) sends {'type': 'sync', 'seq': n}, to which the
+    client replies right away with {'type': 'sync', 'ct': <client time>,
+    'seq': n}.  (Older clients leave out seq, which is fine, because only one
+    probe is outstanding at a time.)  A probe sent at server time t1 and
+    answered at t2 gives a sample offset of ct + (t2 - t1) / 2 - t2, which is
+    off by at most half the round trip time (RTT).
+
+    Of the last <sync_window> samples, the one with the smallest RTT is the
+    most accurate, so the offset is taken from that one, and corrected for
+    drift: the rate at which the offset changes.  The drift is fitted by least
+    squares to the best (smallest RTT) sample of each of the last
+    <sync_anchors> blocks of <sync_window> samples, which span long enough for
+    the drift to show through the error in the samples.
+
+    Probes are made by the communicator's Scheduler, so all clients are
+    synchronized concurrently and connecting never waits for a clock sync.
+    Replies are handled by whichever thread receives them (see
+    Communicator.dispatch()).
+    """
+
+    def __init__(self, scheduler, clientConn):
+        self.scheduler = scheduler
+        self.clientConn = clientConn
+        self.samples = collections.deque(maxlen=sync_window)
+        self.count = 0  # Number of samples taken so far
+        self.seq = 0
+        self.sentTime = None  # Time the outstanding probe was sent, if any
+        self.nextProbe = None  # The ScheduledCall of the next probe
+        self.best = None  # (time, offset, rtt) with the smallest rtt
+        self.anchors = collections.deque(maxlen=sync_anchors)
+        self.drift = 0.0  # Change in the offset per second
+        self.stopped = False
+
+    def start(self):
+        self.nextProbe = self.scheduler.callLater(0, self.probe)
+
+    def probe(self, now=None):
+        if self.stopped:
+            return
+        if now == None:
+            now = time.time()
+        self.seq += 1
+        self.sentTime = now
+        self.clientConn.senderThread.send({'type': 'sync', 'seq': self.seq})
+
+    def onReply(self, message, now):
+        """ Take a sample from the client's reply to a probe.  Called by the
+        thread that received it.
+        @param now: the time the reply was received """
+        if self.sentTime == None or message.get('seq', self.seq) != self.seq:
+            # Not the reply to the outstanding probe
+            return
+        rtt = now - self.sentTime
+        self.sentTime = None
+        self.samples.append((now, message['ct'] + rtt / 2 - now, rtt))
+        self.count += 1
+        self.estimate(now)
+        if self.nextProbe != None:
+            if self.count < sync_burst:
+                # Go straight on with the next probe of the burst
+                self.nextProbe.reschedule(0)
+            else:
+                self.nextProbe.reschedule(sync_interval)
+        if self.count == sync_burst:
+            clientID = self.clientConn.id+1 \
+                    if self.clientConn.id != None else "(no ID)"
+            logger.info('synchronized with client %s: clockOffset = %s '
+                    '+/- %s', clientID, self.clientConn.clockOffset,
+                    self.clientConn.clockUncertainty)
+
+    def estimate(self, now):
+        best = min(self.samples, key=lambda sample: sample[2])
+        if self.count % sync_window == 0:
+            self.anchors.append(best)
+        points = list(self.anchors)
+        if best not in points:
+            points.append(best)
+        drift = 0.0
+        if len(self.anchors) >= 2:
+            mt = sum([t for t, offset, rtt in points]) / len(points)
+            mo = sum([offset for t, offset, rtt in points]) / len(points)
+            var = sum([(t - mt) ** 2 for t, offset, rtt in points])
+            if var > 0:
+                drift = sum([(t - mt) * (offset - mo)
+                    for t, offset, rtt in points]) / var
+        self.best = best
+        self.drift = drift
+        self.clientConn.clockOffset = self.getOffset(now)
+        self.clientConn.clockUncertainty = best[2] / 2
+
+    def getOffset(self, t=None):
+        """ Return the estimated offset at server time t (default now). """
+        if self.best == None:
+            return 0
+        if t == None:
+            t = time.time()
+        return self.best[1] + self.drift * (t - self.best[0])
+
+    def stop(self):
+        self.stopped = True
+        if self.nextProbe != None:
+            self.nextProbe.cancel()
+
+
+class Router:
+
+    """
+    Handles incoming messages of the types it has routes for in the network
+    thread that received them, instead of letting the Communicator post them to
+    the server GUI.  Each of these is one less event for the GUI thread to
+    dispatch, which adds up with pings from every client; the Router counts
+    them so the server can show how many it saved (see sample()).
+
+    Handlers run in whichever thread received the message (a ListenerThread,
+    or the EventLoop), possibly several at once, so anything they share with
+    the GUI thread has to be safe to use from there.
+    """
+
+    def __init__(self):
+        self.handlers = {}  # message type -> handler
+        self.counts = {}  # message type -> number of messages handled
+        self.total = 0
+        self.lock = thread.allocate_lock()
+        self.lastSample = (time.time(), 0)  # (time, total)
+
+    def route(self, type, handler):
+        """ Handle messages of the given type with the given function.
+        @param handler: called with (clientConn, message); or None to post
+        messages of this type again """
+        if handler == None:
+            self.handlers.pop(type, None)
+        else:
+            self.handlers[type] = handler
+
+    def handle(self, clientConn, message):
+        """ @return True if the message was handled, False if it has no route
+        and should be posted. """
+        handler = self.handlers.get(message['type'])
+        if handler == None:
+            return False
+        try:
+            handler(clientConn, message)
+        except:
+            logger.exception("Router: caught exception handling message: %s",
+                    message)
+        self.lock.acquire()
+        self.counts[message['type']] = self.counts.get(message['type'], 0) + 1
+        self.total += 1
+        self.lock.release()
+        return True
+
+    def sample(self):
+        """ Return the number of messages handled so far, and the number per
+        second since the previous call. """
+        now = time.time()
+        lastTime, lastTotal = self.lastSample
+        total = self.total
+        self.lastSample = (now, total)
+        if now <= lastTime:
+            return total, 0.0
+        return total, (total - lastTotal) / (now - lastTime)
+
+
+class LatencyStats:
+
+    """
+    Keeps track of how long messages waited to be handled.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = collections.deque(maxlen=1000)  # The latest waits
+
+    def record(self, wait):
+        self.count += 1
+        self.total += wait
+        self.max = max(self.max, wait)
+        self.recent.append(wait)
+
+    def getMean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def getPercentile(self, p):
+        """ Return the wait that p percent of the latest 1000 messages waited
+        no longer than. """
+        if not self.recent:
+            return 0.0
+        waits = sorted(self.recent)
+        return waits[min(len(waits) - 1, int(len(waits) * p / 100.0))]
+
+    def getHistogram(self, edges):
+        """ Return the number of the latest 1000 waits in each of the bins
+        starting at the given edges (a sorted list of waits, in seconds).  The
+        first bin also counts anything less than its edge, and the last one
+        anything greater. """
+        counts = [0] * len(edges)
+        for wait in list(self.recent):
+            counts[max(0, bisect.bisect_right(edges, wait) - 1)] += 1
+        return counts
+
+    def __str__(self):
+        return '%d messages, mean %.2f ms, 95th percentile %.2f ms, ' \
+                'max %.2f ms' % (self.count, self.getMean() * 1000,
+                        self.getPercentile(95) * 1000, self.max * 1000)
+
+
+class RateLimiter:
 
-        sync_count = 4
+    """
+    A token bucket: allows <rate> messages per second on average, and bursts of
+    up to <burst> messages.
+    """
+
+    def __init__(self, rate, burst):
+        self.limit = (rate, burst)
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.lastTime = time.time()
+
+    def allow(self, now=None):
+        """ Return True if another message is allowed now, and count it. """
+        if now == None:
+            now = time.time()
+        self.tokens = min(self.burst,
+                self.tokens + (now - self.lastTime) * self.rate)
+        self.lastTime = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class FanOut:
+
+    """
+    Follows a message broadcast to several clients (see
+    Communicator.broadcast()) until every client's copy has been taken off its
+    send queue to be written.  Then onDone(fanOut) is called, with elapsed set
+    to how long that took, in seconds.  If onSent is given, onSent(clientConn,
+    delay) is called as each client's copy is taken.  Both are called by the
+    threads doing the sending, so they should be quick.
+
+    A copy queued for a connection that has died is never taken, so the fan
+    out never completes.
+    """
+
+    def __init__(self, onDone, onSent=None):
+        self.onDone = onDone
+        self.onSent = onSent
+        self.startTime = None
+        self.remaining = 0  # Number of copies not yet taken
+        self.elapsed = None
+        self.lock = thread.allocate_lock()
+
+    def start(self, count):
+        """ Start timing, for a message sent to count clients. """
+        self.startTime = time.time()
+        self.remaining = count
+        if count == 0:
+            self.elapsed = 0.0
+            self.onDone(self)
+
+    def sent(self, clientConn):
+        """ Note that a client's copy has been taken off its queue. """
+        delay = time.time() - self.startTime
+        if self.onSent != None:
+            self.onSent(clientConn, delay)
+        self.lock.acquire()
+        self.remaining -= 1
+        done = (self.remaining == 0)
+        self.lock.release()
+        if done:
+            self.elapsed = delay
+            self.onDone(self)
+
+
+class Scheduler:
+
+    """
+    Runs every timer in the server from a single thread, so that the number of
+    threads stays the same however many clients and timers there are.
 
-        rtt = 999
-        for i in range(sync_count):
-            st1 = time.time()
-            self.senderThread.send({'type': 'sync'})
-            reply = self.syncQueue.get()
-            st2 = time.time()
-            new_rtt = st2 - st1
-            if new_rtt < rtt:
-                rtt = new_rtt
-                self.clockOffset = reply['ct'] + rtt / 2 - st2
+    Calls are kept in a heap ordered by due time.  The thread waits for the
+    earliest one in select() on a Waker, so it wakes up within a fraction of a
+    millisecond of the due time, and right away when an earlier call is
+    scheduled.  (threading.Timer, by contrast, waits by polling in steps of up
+    to 50 ms.)  Canceled and rescheduled calls are left in the heap and skipped
+    when they come up.
+
+    Calls are made one at a time in the scheduler thread, so they should be
+    quick; anything that touches the GUI should go through wx.CallAfter().
+    """
+
+    def __init__(self):
+        self.heap = []  # [due time, sequence number, ScheduledCall or None]
+        self.sequence = itertools.count()
+        self.lock = thread.allocate_lock()
+        self.waker = Waker()
+        self.started = False
+
+    def callLater(self, delay, function, *args):
+        """ Call function(*args) in the scheduler thread <delay> seconds from
+        now.
+        @return: a ScheduledCall, to cancel or reschedule the call """
+        call = ScheduledCall(self, function, args)
+        self.add(call, time.time() + delay)
+        return call
+
+    def add(self, call, due):
+        self.lock.acquire()
+        try:
+            if call.entry != None:
+                call.entry[2] = None
+            call.entry = [due, self.sequence.next(), call]
+            heapq.heappush(self.heap, call.entry)
+            if not self.started:
+                self.started = True
+                thread.start_new_thread(self.Run, ())
+            elif self.heap[0] is call.entry:
+                # The thread is waiting for a later call.
+                self.waker.wake()
+        finally:
+            self.lock.release()
+
+    def remove(self, call):
+        self.lock.acquire()
+        if call.entry != None:
+            call.entry[2] = None
+            call.entry = None
+        self.lock.release()
+
+    def Run(self):
+        while True:
+            due = []
+            self.lock.acquire()
+            try:
+                now = time.time()
+                while self.heap and (self.heap[0][2] == None
+                        or self.heap[0][0] <= now):
+                    entry = heapq.heappop(self.heap)
+                    call = entry[2]
+                    if call != None:
+                        call.entry = None
+                        due.append(call)
+                if self.heap:
+                    wait = self.heap[0][0] - now
+                else:
+                    wait = None
+            finally:
+                self.lock.release()
+
+            if due:
+                for call in due:
+                    try:
+                        call.function(*call.args)
+                    except:
+                        logger.exception(
+                                "Scheduler: caught exception in %s",
+                                call.function)
+                # The calls took some time, and may have scheduled more.
+                continue
+
+            select.select([self.waker.fileno()], [], [], wait)
+            self.waker.clear()
+
+
+class ScheduledCall:
+
+    """ A call waiting to be made by a Scheduler (see Scheduler.callLater()).
+    """
+
+    def __init__(self, scheduler, function, args):
+        self.scheduler = scheduler
+        self.function = function
+        self.args = args
+        self.entry = None  # The call's heap entry while it is scheduled
+
+    def cancel(self):
+        """ Don't make the call.  No effect if it has been made already. """
+        self.scheduler.remove(self)
+
+    def reschedule(self, delay):
+        """ Make the call <delay> seconds from now instead, or again if it has
+        been made already. """
+        self.scheduler.add(self, time.time() + delay)
+
+    def getTimeLeft(self):
+        """ Return the number of seconds until the call is made, or None if
+        it isn't scheduled (it has been made or canceled). """
+        entry = self.entry
+        if entry == None:
+            return None
+        return max(0.0, entry[0] - time.time())
 
-        clientID = self.id+1 if self.id != None else "(no ID)"
-        print 'synchronized with client', clientID, ': clockOffset =',\
-            self.clockOffset
 
 class ListenerThread:
 
@@ -272,7 +1256,7 @@ class ListenerThread:
         @param communicator: the Communicator that created this thread
         """
         self.client = client
-        self.queue = communicator.inQueue
+        self.communicator = communicator
         self.postEvent = communicator.postEvent
         self.keepListening = True
 
@@ -296,32 +1280,444 @@ class ListenerThread:
         member.
         """
 
-        leftovers = ''
+        reader = network.MessageReader(self.client.sock)
         while self.keepListening:
             try:
-                pmessage, leftovers = network.recvmessage(self.client.sock,
-                        leftovers)
+                pmessage = reader.read()
                 if pmessage == None:
-                    print "ListenerThread: connection closed; terminating"
+                    logger.info(
+                            "ListenerThread: connection closed; terminating")
                     # FIXME: change client status to disconnected, notify GUI
                     self.keepListening = False
                     break
             except:
-                print "ListenerThread: caught exception; terminating: "
-                print "    ", sys.exc_info()
+                logger.exception(
+                        "ListenerThread: caught exception; terminating")
                 self.keepListening = False
                 break
 
             else:
-                message = cerealizer.loads(pmessage)
-                if message['type'] == 'gm':
-                    # Only place Game Messages ('gm') on the queue.
-                    self.queue.put((self.client, message))
-                elif message['type'] == 'sync':
-                    # Place sync messages on the client's sync queue (client is
-                    # responding to server's sync message)
-                    self.client.syncQueue.put(message)
-                self.postEvent(self.client, message)
+                message = cerealizer.fast_loads(pmessage)
+                self.communicator.dispatch(self.client, message, reader)
 
         # Thread is terminating.
         self.postEvent(self.client, {'type': 'disconnect'})
+
+
+class EventLoopCommunicator(Communicator):
+
+    """
+    A Communicator that handles every client connection on a single
+    EventLoop thread instead of a ListenerThread and a SenderThread per client.
+    Game controllers use it exactly like a Communicator.
+    """
+
+    def acceptConnections(self):
+        """
+        Start accepting client connections (see
+        Communicator.acceptConnections()).  Non-blocking.
+        """
+        self.eventLoop = EventLoop(self)
+        self.eventLoop.Start()
+
+
+class EventLoop:
+
+    """
+    Owns the listening socket and every client socket of an
+    EventLoopCommunicator, and does all of the reading and writing for them in
+    one thread, waking up only when some socket is ready.  Other threads hand
+    it work through a queue of commands and a Waker.
+    """
+
+    def __init__(self, communicator):
+        self.communicator = communicator
+        self.poller = makePoller()
+        self.waker = Waker()
+        self.conns = {}  # _LoopConnection objects indexed by file descriptor
+
+        # Each command is a function to be called in the event loop thread.
+        # (deque.append() and popleft() are atomic, so no lock is needed.)
+        self.commands = collections.deque()
+
+    def Start(self):
+        thread.start_new_thread(self.Run, ())
+
+    def Run(self):
+        self.listenSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # to prevent socket.error: (98, 'Address already in use'):
+        self.listenSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listenSock.bind(('', self.communicator.port))
+        self.listenSock.listen(16)
+        self.listenSock.setblocking(False)
+        self.poller.register(self.listenSock.fileno())
+        self.poller.register(self.waker.fileno())
+
+        lastTimeoutCheck = time.time()
+        while True:
+            for fd, readable, writable, error in self.poller.poll(1.0):
+                if fd == self.listenSock.fileno():
+                    self.acceptAll()
+                elif fd == self.waker.fileno():
+                    self.waker.clear()
+                else:
+                    conn = self.conns.get(fd)
+                    if conn == None:
+                        continue
+                    if readable or error:
+                        self.handleRead(conn)
+                    if writable and not conn.closed:
+                        self.flush(conn)
+
+            while self.commands:
+                command = self.commands.popleft()
+                try:
+                    command()
+                except:
+                    logger.exception("EventLoop: caught exception in %s",
+                            command)
+
+            # Drop clients that haven't sent anything (not even a ping) for too
+            # long, like the ListenerThread's socket timeout does.
+            now = time.time()
+            if now - lastTimeoutCheck >= 1.0:
+                lastTimeoutCheck = now
+                for conn in self.conns.values():
+                    if now - conn.lastRecvTime > network.timeout:
+                        logger.info("EventLoop: client timed out")
+                        self.drop(conn)
+
+    def acceptAll(self):
+        while True:
+            try:
+                csock, addr = self.listenSock.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return
+                raise
+            csock.setblocking(False)
+            clientConn = ClientConnection(None, csock, addr)
+            clientConn.communicator = self.communicator
+            clientConn.eventLoop = self
+            clientConn.senderThread = LoopSender(self, clientConn)
+            conn = _LoopConnection(clientConn)
+            clientConn.loopConnection = conn
+            clientConn.senderThread.stats = conn.stats
+            self.communicator.watchSendQueue(clientConn)
+            self.conns[csock.fileno()] = conn
+            self.communicator.postEvent(clientConn, {'type': 'connect'})
+            clientConn.senderThread.send({'type': 'framing',
+                'offer': network.framing_modes})
+            self.poller.register(csock.fileno())
+            self.communicator.startClockSync(clientConn)
+
+    def handleRead(self, conn):
+        try:
+            if not conn.reader.fill():
+                logger.info("EventLoop: connection closed")
+                self.drop(conn)
+                return
+        except socket.error, e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINTR):
+                return
+            logger.warning("EventLoop: caught exception; dropping client: %s",
+                    e)
+            self.drop(conn)
+            return
+        conn.lastRecvTime = time.time()
+        try:
+            while not conn.closed:
+                pmessage = conn.reader.next()
+                if pmessage == None:
+                    break
+                message = cerealizer.fast_loads(pmessage)
+                self.communicator.dispatch(conn.clientConn, message,
+                        conn.reader)
+        except:
+            # A bad message costs only its own client the connection.
+            logger.exception("EventLoop: caught exception; dropping client")
+            self.drop(conn)
+
+    def write(self, clientConn, data, lane):
+        """ Queue a message (a string or network.Supersedable) or a
+        network.FramingSwitch to be sent to the client in the given lane (see
+        network.messageLane()).  May be called from any thread. """
+        conn = clientConn.loopConnection
+        conn.outQueues[lane].append(data)
+        self.commands.append(lambda: self.flush(conn))
+        self.waker.wake()
+
+    def flush(self, conn):
+        """ Send as much queued data as the socket will take without blocking,
+        and wait for the socket to become writable if anything is left. """
+        if conn.closed:
+            return
+        sender = conn.clientConn.senderThread
+        while True:
+            # Frame queued messages into the output buffer, up to about
+            # network.coalesce_limit bytes at a time, taking them from the
+            # first lane that has any.
+            count = 0
+            while len(conn.outBuf) < network.coalesce_limit:
+                for lane, queue in enumerate(conn.outQueues):
+                    if queue:
+                        break
+                else:
+                    break
+                data = sender.taken(queue.popleft())
+                if isinstance(data, network.FramingSwitch):
+                    conn.framing = data.framing
+                    continue
+                if network.isChunked(data, lane, conn.framing):
+                    # Frame one chunk, and leave the rest at the head of the
+                    # lane.  Chunks are only framed into a nearly empty
+                    # buffer, so that messages queued in the other lanes
+                    # meanwhile don't wait behind more than one.
+                    if not isinstance(data, network.Chunks):
+                        data = network.Chunks(data)
+                    chunk, flags = data.next()
+                    conn.outBuf += network.frameheader(len(chunk),
+                            conn.framing, flags)
+                    conn.outBuf += chunk
+                    count += 1
+                    if not data.done():
+                        queue.appendleft(data)
+                    else:
+                        sender.bulkSent()
+                    if len(conn.outBuf) >= network.chunk_size:
+                        break
+                    continue
+                conn.outBuf += network.frameheader(len(data), conn.framing)
+                conn.outBuf += data
+                count += 1
+                if lane == network.LANE_BULK:
+                    sender.bulkSent()
+            if count:
+                conn.stats.record(count)
+            if not conn.outBuf:
+                break
+            try:
+                n = conn.sock.send(buffer(conn.outBuf))
+            except socket.error, e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINTR):
+                    break
+                logger.warning(
+                        "EventLoop: caught exception; dropping client: %s", e)
+                self.drop(conn)
+                return
+            del conn.outBuf[:n]
+
+        if conn.closing and not conn.outBuf and not any(conn.outQueues):
+            # Everything has been sent.  The client closes its end when it sees
+            # ours shut down, and handleRead() drops the connection then.
+            conn.closing = False
+            conn.clientConn.shutdownSending()
+
+        wantWrite = bool(conn.outBuf)
+        if wantWrite != conn.wantWrite:
+            conn.wantWrite = wantWrite
+            self.poller.modify(conn.sock.fileno(), wantWrite)
+
+    def closeConnection(self, clientConn):
+        """ Close the connection to the client.  May be called from any
+        thread. """
+        self.commands.append(lambda: self.drop(clientConn.loopConnection))
+        self.waker.wake()
+
+    def closeConnectionWhenSent(self, clientConn):
+        """ Shut down sending to the client once everything queued for it has
+        been sent, and drop the connection when the client closes its end (see
+        ClientConnection.closeWhenSent()).  May be called from any thread. """
+        conn = clientConn.loopConnection
+        def close():
+            conn.closing = True
+            self.flush(conn)
+        self.commands.append(close)
+        self.waker.wake()
+
+    def drop(self, conn):
+        """ Unregister and close the connection, and tell the communicator the
+        client has disconnected.  Does nothing the second time. """
+        if conn.closed:
+            return
+        conn.closed = True
+        fd = conn.sock.fileno()
+        self.poller.unregister(fd)
+        del self.conns[fd]
+        try:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        conn.sock.close()
+        self.communicator.postEvent(conn.clientConn, {'type': 'disconnect'})
+
+
+class _LoopConnection:
+    """ EventLoop's state for one client connection. """
+    def __init__(self, clientConn):
+        self.clientConn = clientConn
+        self.sock = clientConn.sock
+        self.reader = network.MessageReader(self.sock)
+        # Messages waiting to be sent, one deque per lane (see
+        # network.messageLane())
+        self.outQueues = [collections.deque() for lane in
+                (network.LANE_CONTROL, network.LANE_GAME, network.LANE_BULK)]
+        self.outBuf = bytearray()
+        self.stats = network.FlushStats()
+        self.framing = network.FRAMING_ASCII
+        self.wantWrite = False
+        # Set to shut down sending once everything queued has been sent
+        self.closing = False
+        self.closed = False
+        self.lastRecvTime = time.time()
+
+
+class LoopSender(network.SendQueue):
+
+    """
+    Stands in for the network.SenderThread of a ClientConnection that is run by
+    an EventLoop, so that code which sends through clientConn.senderThread
+    works the same with either Communicator.  The send queue is the
+    _LoopConnection's outQueues.
+    """
+
+    def __init__(self, eventLoop, clientConn):
+        self.eventLoop = eventLoop
+        self.clientConn = clientConn
+        self.framing = network.FRAMING_ASCII
+        self.stats = None  # set to the _LoopConnection's FlushStats
+        self.initSendQueue()
+
+    def Start(self):
+        pass
+
+    def Stop(self):
+        pass
+
+    def enqueue(self, data, lane):
+        self.eventLoop.write(self.clientConn, data, lane)
+
+    def getQueueDepth(self):
+        """ Return the number of messages waiting to be sent. """
+        return sum([len(queue) for queue in
+            self.clientConn.loopConnection.outQueues])
+
+    def setFraming(self, framing, message=None):
+        """ See network.SenderThread.setFraming() """
+        if message != None:
+            self.sendEncoded(network.encode(message, self.framing), None,
+                    network.LANE_CONTROL)
+        self.framing = framing
+        self.eventLoop.write(self.clientConn, network.FramingSwitch(framing),
+                network.LANE_CONTROL)
+
+
+class Waker:
+
+    """
+    A pair of connected sockets for waking a thread that is waiting in
+    select() or epoll: the waiting thread includes fileno() in the sockets it
+    waits for, and any other thread calls wake().
+    """
+
+    def __init__(self):
+        if hasattr(socket, 'socketpair'):
+            self.rsock, self.wsock = socket.socketpair()
+        else:
+            # No socketpair() on Windows; connect two sockets through the
+            # loopback interface instead.
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            self.wsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.wsock.connect(listener.getsockname())
+            self.rsock, addr = listener.accept()
+            listener.close()
+        self.rsock.setblocking(False)
+        self.wsock.setblocking(False)
+
+    def fileno(self):
+        return self.rsock.fileno()
+
+    def wake(self):
+        try:
+            self.wsock.send('x')
+        except socket.error:
+            # The socket buffer is full, so the waiting thread has plenty of
+            # wake-ups pending already.
+            pass
+
+    def clear(self):
+        """ Called by the waiting thread after it wakes up. """
+        try:
+            while self.rsock.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+
+def makePoller():
+    """ Return the best available poller: an _EpollPoller on Linux, otherwise
+    a _SelectPoller. """
+    if hasattr(select, 'epoll'):
+        return _EpollPoller()
+    else:
+        return _SelectPoller()
+
+class _EpollPoller:
+    def __init__(self):
+        self.epoll = select.epoll()
+
+    def register(self, fd):
+        self.epoll.register(fd, select.EPOLLIN)
+
+    def modify(self, fd, wantWrite):
+        mask = select.EPOLLIN
+        if wantWrite:
+            mask |= select.EPOLLOUT
+        self.epoll.modify(fd, mask)
+
+    def unregister(self, fd):
+        self.epoll.unregister(fd)
+
+    def poll(self, timeout):
+        """ Return a list of (fd, readable, writable, error) tuples. """
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        return [(fd, bool(ev & select.EPOLLIN), bool(ev & select.EPOLLOUT),
+            bool(ev & (select.EPOLLERR | select.EPOLLHUP)))
+            for fd, ev in events]
+
+class _SelectPoller:
+    def __init__(self):
+        self.readers = set()
+        self.writers = set()
+
+    def register(self, fd):
+        self.readers.add(fd)
+
+    def modify(self, fd, wantWrite):
+        if wantWrite:
+            self.writers.add(fd)
+        else:
+            self.writers.discard(fd)
+
+    def unregister(self, fd):
+        self.readers.discard(fd)
+        self.writers.discard(fd)
+
+    def poll(self, timeout):
+        """ Return a list of (fd, readable, writable, error) tuples. """
+        try:
+            r, w, x = select.select(self.readers, self.writers, self.readers,
+                    timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        ready = set(r) | set(w) | set(x)
+        return [(fd, fd in r, fd in w, fd in x) for fd in ready]
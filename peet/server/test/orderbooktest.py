@@ -0,0 +1,118 @@
+# Copyright 2009 University of Alaska Anchorage Experimental Economics
+# Laboratory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tests for the order book of the Island ORDER_BOOK market.  Run from the top
+# of the source tree:
+#   PYTHONPATH=. python peet/server/test/orderbooktest.py
+
+import unittest
+from decimal import Decimal
+
+from peet.server.OrderBook import OrderBook
+
+class OrderBookTest(unittest.TestCase):
+
+    def setUp(self):
+        self.book = OrderBook()
+
+    def place(self, trader, side, price):
+        return self.book.place(trader, side, Decimal(price))
+
+    def test_no_cross(self):
+        order, trade = self.place('b1', 'bid', '2.00')
+        assert trade == None and order.active
+        order, trade = self.place('s1', 'ask', '2.50')
+        assert trade == None
+        assert self.book.getBest('bid').trader == 'b1'
+        assert self.book.getBest('ask').trader == 's1'
+        assert len(self.book) == 2
+
+    def test_price_time_priority(self):
+        self.place('b1', 'bid', '2.00')
+        self.place('b2', 'bid', '2.50')
+        self.place('b3', 'bid', '2.50')
+        # Best price first, then earliest; at the standing order's price
+        trades = [self.place('s%d' % i, 'ask', '1.00')[1] for i in range(4)]
+        assert trades == [('b2', 's0', Decimal('2.50')),
+                ('b3', 's1', Decimal('2.50')),
+                ('b1', 's2', Decimal('2.00')), None]
+        assert self.book.getOrder('s3', 'ask') != None
+        assert len(self.book) == 1
+
+    def test_ask_side_priority(self):
+        self.place('s1', 'ask', '3.00')
+        self.place('s2', 'ask', '2.00')
+        self.place('s3', 'ask', '2.00')
+        order, trade = self.place('b1', 'bid', '5.00')
+        assert trade == ('b1', 's2', Decimal('2.00'))
+        # The incoming order trades, so it doesn't stand.
+        assert not order.active and self.book.getOrder('b1', 'bid') == None
+
+    def test_replace(self):
+        first = self.place('b1', 'bid', '2.00')[0]
+        self.place('b2', 'bid', '2.00')
+        second = self.place('b1', 'bid', '2.00')[0]
+        # The replacement goes to the back of the queue at its price.
+        assert not first.active
+        assert self.book.getOrder('b1', 'bid') is second
+        assert self.book.getBest('bid').trader == 'b2'
+        assert len(self.book) == 2
+
+    def test_cancel(self):
+        bid = self.place('t1', 'bid', '2.00')[0]
+        ask = self.place('t1', 'ask', '3.00')[0]
+        self.place('t2', 'bid', '1.00')
+        assert self.book.cancel('t1', 'bid') == [bid]
+        assert self.book.cancel('t1', 'bid') == []
+        assert self.book.getBest('bid').trader == 't2'
+        assert self.book.cancel('t1') == [ask]
+        assert self.book.getBest('ask') == None
+        # A cancelled order doesn't trade.
+        assert self.place('t3', 'ask', '1.50')[1] == None
+
+    def test_rebuild(self):
+        orders = [self.place('b%d' % i, 'bid', '%d.00' % (i + 1))[0]
+                for i in range(10)]
+        for order in orders[4:]:
+            self.book.cancel(order.trader, 'bid')
+        # The cancelled orders were cleared out along the way.
+        assert len(self.book.bids) < 10
+        assert len(self.book.bids) - self.book.inactive['bid'] == 4
+        assert len(self.book) == 4
+        assert self.book.getBest('bid') is orders[3]
+        assert self.book.getDepth('bid', 10) == [(Decimal(p), 1)
+                for p in ('4.00', '3.00', '2.00', '1.00')]
+
+    def test_depth(self):
+        for i in range(5):
+            self.place('b%d' % i, 'bid', '3.00')
+        self.place('b5', 'bid', '2.00')
+        self.place('b6', 'bid', '2.00')
+        self.place('b7', 'bid', '1.00')
+        self.place('s0', 'ask', '4.00')
+        self.book.cancel('b6')
+        # More orders at the top level than levels asked for
+        assert self.book.getDepth('bid', 2) == [(Decimal('3.00'), 5),
+                (Decimal('2.00'), 1)]
+        assert self.book.getDepth('bid', 1) == [(Decimal('3.00'), 5)]
+        assert self.book.getDepth('bid', 5) == [(Decimal('3.00'), 5),
+                (Decimal('2.00'), 1), (Decimal('1.00'), 1)]
+        assert self.book.getDepth('ask', 5) == [(Decimal('4.00'), 1)]
+        self.book.cancel('s0')
+        assert self.book.getDepth('ask', 5) == []
+
+if __name__ == '__main__':
+    unittest.main()
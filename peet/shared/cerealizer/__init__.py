@@ -114,9 +114,10 @@ same file, or a raw value (e.g. an integer).
  - an unicode          is saved by e.g. 'u4\\nutf8'  (where 4 is the number of characters)
  - an object reference is saved by e.g. 'r3\\n'      (where 3 means reference to object #3)
  -    None             is saved by      'n'
+ - a  Decimal          is saved by e.g. 'd450E-2\\n'  (only if registered with DecimalHandler)
 """
 
-__alls__ = ["load", "dump", "loads", "dumps", "freeze_configuration", "register"]
+__alls__ = ["load", "dump", "loads", "dumps", "fast_loads", "fast_dumps", "freeze_configuration", "register", "DecimalHandler"]
 VERSION = "0.6"
 
 import logging
@@ -125,6 +126,7 @@ logger = logging.getLogger("cerealizer")
 
 from cStringIO import StringIO
 from new       import instance
+from decimal   import Decimal
 
 class EndOfFile(StandardError): pass
 class NotCerealizerFileError(StandardError): pass
@@ -133,7 +135,17 @@ class NonCerealizableObjectError(StandardError): pass
 def _priority_sorter(a, b): return cmp(a[0], b[0])
 
 class Dumper(object):
-  def __init__(self): self.init()
+  def __init__(self, handlers = None):
+    """Dumper(handlers = None)
+
+HANDLERS is an optional dict mapping classes to the Handler to use for them when dumping,
+instead of their registered Handler (e.g. for writing files readable by an older version)."""
+    if handlers:
+      self.handlers = _HANDLERS_.copy()
+      self.handlers.update(handlers)
+    else:
+      self.handlers = _HANDLERS_
+    self.init()
   def init(self):
     self.objs            = []
     self.objs_id         = set()
@@ -154,10 +166,10 @@ class Dumper(object):
     for obj in self.objs:
       self.id2id[id(obj)] = i
       i += 1
-    for obj in self.objs: _HANDLERS_[obj.__class__].dump_obj (obj, self, s)
-    for obj in self.objs: _HANDLERS_[obj.__class__].dump_data(obj, self, s)
+    for obj in self.objs: self.handlers[obj.__class__].dump_obj (obj, self, s)
+    for obj in self.objs: self.handlers[obj.__class__].dump_data(obj, self, s)
     
-    _HANDLERS_[root_obj.__class__].dump_ref(root_obj, self, s)
+    self.handlers[root_obj.__class__].dump_ref(root_obj, self, s)
     self.init()
     
   def undump(self, s):
@@ -184,7 +196,7 @@ class Dumper(object):
     """Dumper.collect(OBJ) -> bool
 
 Collects OBJ for serialization. Returns false is OBJ is already collected; else returns true."""
-    handler = _HANDLERS_.get(obj.__class__)
+    handler = self.handlers.get(obj.__class__)
     if not handler: raise NonCerealizableObjectError("Object of class/type '%s' cannot be cerealized! Use cerealizer.register to extend Cerealizer support to other classes." % obj.__class__)
     handler.collect(obj, self)
   
@@ -192,7 +204,7 @@ Collects OBJ for serialization. Returns false is OBJ is already collected; else
     """Dumper.dump_ref(OBJ, S)
 
 Writes a reference to OBJ in file S."""
-    _HANDLERS_[obj.__class__].dump_ref(obj, self, s)
+    self.handlers[obj.__class__].dump_ref(obj, self, s)
     
   def undump_ref(self, s):
     """Dumper.undump_ref(S) -> obj
@@ -208,6 +220,7 @@ Reads a reference from file S."""
     elif c == "b": return bool(int(s.read(1)))
     elif c == "l": return long(s.readline())
     elif c == "c": return complex(s.readline())
+    elif c == "d": return Decimal(s.readline()[:-1])
     raise ValueError("Unknown ref code '%s'!" % c)
     
   def immutable_depth(self, t):
@@ -322,7 +335,7 @@ class TupleHandler(Handler):
     
   def dump_obj(self, obj, dumper, s):
     s.write("%s%s\n" % (self.classname, len(obj)))
-    for i in obj: _HANDLERS_[i.__class__].dump_ref(i, dumper, s)
+    for i in obj: dumper.handlers[i.__class__].dump_ref(i, dumper, s)
     
   def undump_obj(self, dumper, s): return tuple([dumper.undump_ref(s) for i in range(int(s.readline()))])
   
@@ -340,7 +353,7 @@ class ListHandler(Handler):
     
   def dump_data(self, obj, dumper, s):
     s.write("%s\n" % len(obj))
-    for i in obj: _HANDLERS_[i.__class__].dump_ref(i, dumper, s)
+    for i in obj: dumper.handlers[i.__class__].dump_ref(i, dumper, s)
       
   def undump_obj(self, dumper, s): return []
   
@@ -364,8 +377,8 @@ class DictHandler(Handler):
   def dump_data(self, obj, dumper, s):
     s.write("%s\n" % len(obj))
     for k, v in obj.iteritems():
-      _HANDLERS_[v.__class__].dump_ref(v, dumper, s) # Value is saved fist
-      _HANDLERS_[k.__class__].dump_ref(k, dumper, s)
+      dumper.handlers[v.__class__].dump_ref(v, dumper, s) # Value is saved fist
+      dumper.handlers[k.__class__].dump_ref(k, dumper, s)
       
   def undump_obj(self, dumper, s): return {}
   
@@ -401,7 +414,7 @@ as well as C-defined types (although it may not save the C-side data)."""
     
   def dump_data(self, obj, dumper, s):
     i = dumper.obj2state[id(obj)]
-    _HANDLERS_[i.__class__].dump_ref(i, dumper, s)
+    dumper.handlers[i.__class__].dump_ref(i, dumper, s)
     
   def undump_obj(self, dumper, s): return self.Class_new(self.Class)
   
@@ -482,11 +495,35 @@ A Cerealizer Handler that can support class instances with __getnewargs__."""
   def dump_obj (self, obj, dumper, s):
     s.write(self.classname)
     newargs = dumper.obj2newargs[id(obj)]
-    _HANDLERS_[newargs.__class__].dump_ref(newargs, dumper, s)
+    dumper.handlers[newargs.__class__].dump_ref(newargs, dumper, s)
     
   def undump_obj(self, dumper, s): return self.Class_new(self.Class, *dumper.undump_ref(s))
   
   
+class DecimalHandler(SlotedObjHandler):
+  """DecimalHandler
+
+A Cerealizer Handler for decimal.Decimal, that saves Decimals inline, like ints and floats,
+as their sign, coefficient and exponent (e.g. 'd-450E-2\\n' for Decimal('-4.50')), or as
+e.g. 'dInfinity\\n' for special values. Decimals are restored exactly.
+
+Decimals saved as objects (by the SlotedObjHandler that register(decimal.Decimal) uses)
+can still be read, under the same classname."""
+  def __init__(self, classname = ""):
+    SlotedObjHandler.__init__(self, Decimal, classname)
+    
+  def collect  (self, obj, dumper)   : pass
+  def dump_obj (self, obj, dumper, s): pass
+  def dump_data(self, obj, dumper, s): pass
+  def dump_ref (self, obj, dumper, s): s.write(_decimal_ref(obj))
+  
+def _decimal_ref(obj):
+  # _sign, _int and _exp are the slots SlotedObjHandler saves for a Decimal
+  if   obj._is_special: return "d%s\n" % obj
+  elif obj._sign      : return "d-%sE%s\n" % (obj._int, obj._exp)
+  else:                 return "d%sE%s\n" % (obj._int, obj._exp)
+  
+  
 _configurable = 1
 _HANDLERS  = {}
 _HANDLERS_ = {}
@@ -576,13 +613,14 @@ register(tuple     , TupleHandler    ())
 register(frozenset , FrozensetHandler())
 
 
-def dump(obj, file, protocol = 0):
-  """dump(obj, file, protocol = 0)
+def dump(obj, file, protocol = 0, handlers = None):
+  """dump(obj, file, protocol = 0, handlers = None)
 
 Serializes object OBJ in FILE.
 FILE should be an opened file in *** binary *** mode.
-PROTOCOL is unused, it exists only for compatibility with Pickle."""
-  Dumper().dump(obj, file)
+PROTOCOL is unused, it exists only for compatibility with Pickle.
+HANDLERS optionally overrides the registered Handlers of some classes (see Dumper)."""
+  Dumper(handlers).dump(obj, file)
   
 def load(file):
   """load(file) -> obj
@@ -591,13 +629,14 @@ De-serializes an object from FILE.
 FILE should be an opened file in *** binary *** mode."""
   return Dumper().undump(file)
 
-def dumps(obj, protocol = 0):
-  """dumps(obj, protocol = 0) -> str
+def dumps(obj, protocol = 0, handlers = None):
+  """dumps(obj, protocol = 0, handlers = None) -> str
 
 Serializes object OBJ and returns the serialized string.
-PROTOCOL is unused, it exists only for compatibility with Pickle."""
+PROTOCOL is unused, it exists only for compatibility with Pickle.
+HANDLERS optionally overrides the registered Handlers of some classes (see Dumper)."""
   s = StringIO()
-  Dumper().dump(obj, s)
+  Dumper(handlers).dump(obj, s)
   return s.getvalue()
 
 def loads(string):
@@ -607,6 +646,207 @@ De-serializes an object from STRING."""
   return Dumper().undump(StringIO(string))
 
 
+
+# Fast path
+#
+# fast_dumps() and fast_loads() produce and read the same cereal1 format as dumps() and loads(),
+# but only for the common case of messages made of dicts, lists and basic types, plus Decimals
+# and instances of registered classes that use the plain ObjHandler or SlotedObjHandler.
+# They avoid the per-object handler method calls and the file-like object of the Dumper, and
+# parse by index instead of calling readline() for every token.
+#
+# Anything else (tuples, sets, frozensets, classes with a specialized Handler, unregistered classes)
+# makes them fall back to dumps() and loads(), so they accept and reject exactly what the Dumper does.
+# Objects are created and restored the same way the registered Handler would do it, i.e. only
+# using the Class.__new__, __getstate__ and __setstate__ references stored at registration.
+
+class _NotFast(Exception): pass
+
+def fast_dumps(obj, protocol = 0, handlers = None):
+  """fast_dumps(obj, protocol = 0, handlers = None) -> str
+
+Same as dumps(OBJ, PROTOCOL, HANDLERS), but faster for dicts, lists, basic types and simple objects."""
+  if handlers:
+    all_handlers = _HANDLERS_.copy()
+    all_handlers.update(handlers)
+  else:
+    all_handlers = _HANDLERS_
+  containers = [] # lists and dicts, in the order they are numbered
+  objs       = [] # (object, handler, state), numbered after the containers
+  ids        = {} # id(container) -> number
+  obj_ids    = {} # id(object) -> position in objs
+  states     = [] # keeps the states computed here alive, so their ids stay unique
+
+  def collect(o):
+    Class = o.__class__
+    if (Class is dict) or (Class is list):
+      i = id(o)
+      if i in ids: return
+      ids[i] = len(containers)
+      containers.append(o)
+      if Class is dict:
+        for k, v in o.iteritems():
+          if not k.__class__ in _FAST_REFS: collect(k)
+          if not v.__class__ in _FAST_REFS: collect(v)
+      else:
+        for v in o:
+          if not v.__class__ in _FAST_REFS: collect(v)
+    elif not Class in _FAST_REFS:
+      handler = all_handlers.get(Class)
+      if handler.__class__ is DecimalHandler: return # Saved inline
+      if not ((handler.__class__ is ObjHandler) or (handler.__class__ is SlotedObjHandler)): raise _NotFast
+      i = id(o)
+      if i in obj_ids: return
+      if   handler.Class_getstate:               state = handler.Class_getstate(o)
+      elif handler.__class__ is SlotedObjHandler: state = dict([(slot, getattr(o, slot, None)) for slot in handler.Class_slots])
+      else:                                       state = o.__dict__
+      states.append(state)
+      obj_ids[i] = len(objs)
+      objs.append((o, handler, state))
+      if not state.__class__ in _FAST_REFS: collect(state)
+
+  try:
+    if not obj.__class__ in _FAST_REFS: collect(obj)
+  except _NotFast:
+    return dumps(obj, protocol, handlers)
+
+  nb_containers = len(containers)
+  def ref(o):
+    Class = o.__class__
+    if   Class is str    : return "s%s\n%s" % (len(o), o)
+    elif Class is int    : return "i%r\n" % o
+    elif Class is dict or Class is list: return "r%s\n" % ids[id(o)]
+    elif Class is bool   : return "b%r" % int(o)
+    elif Class is type(None): return "n"
+    elif Class is unicode:
+      o = o.encode("utf8")
+      return "u%s\n%s" % (len(o), o)
+    elif Class is long   : return "l%r\n" % o
+    elif Class is float  : return "f%r\n" % o
+    i = obj_ids.get(id(o))
+    if i is None: return _decimal_ref(o) # Only the inline Decimals are not numbered
+    return "r%s\n" % (nb_containers + i)
+
+  s = ["cereal1\n%s\n" % (nb_containers + len(objs))]
+  write = s.append
+  for o in containers:
+    if o.__class__ is dict: write("dict\n")
+    else:                   write("list\n")
+  for o, handler, state in objs: write(handler.classname)
+  for o in containers:
+    write("%s\n" % len(o))
+    if o.__class__ is dict:
+      for k, v in o.iteritems():
+        write(ref(v)) # Value is saved fist
+        write(ref(k))
+    else:
+      for v in o: write(ref(v))
+  for o, handler, state in objs: write(ref(state))
+  write(ref(obj))
+  return "".join(s)
+
+_FAST_REFS = set([str, int, bool, type(None), unicode, long, float])
+
+# Handlers whose objects fast_loads() can restore itself (DecimalHandler for Decimals saved as objects)
+_FAST_OBJ_HANDLERS = set([ObjHandler, SlotedObjHandler, DecimalHandler])
+
+def _fast_undump_ref(string, pos, id2obj):
+  """_fast_undump_ref(STRING, POS, ID2OBJ) -> (obj, position after the reference)
+
+Reads the reference at position POS of STRING, like Dumper.undump_ref()."""
+  c = string[pos]
+  if   c == "s":
+    end = string.index("\n", pos)
+    start = end + 1
+    end = start + int(string[pos + 1 : end])
+    return string[start : end], end
+  elif c == "i":
+    end = string.index("\n", pos)
+    return int(string[pos + 1 : end]), end + 1
+  elif c == "r":
+    end = string.index("\n", pos)
+    return id2obj[int(string[pos + 1 : end])], end + 1
+  elif c == "d":
+    end = string.index("\n", pos)
+    return Decimal(string[pos + 1 : end]), end + 1
+  elif c == "b": return bool(int(string[pos + 1])), pos + 2
+  elif c == "n": return None, pos + 1
+  elif c == "u":
+    end = string.index("\n", pos)
+    start = end + 1
+    end = start + int(string[pos + 1 : end])
+    return string[start : end].decode("utf8"), end
+  elif c == "l":
+    end = string.index("\n", pos)
+    return long(string[pos + 1 : end]), end + 1
+  elif c == "f":
+    end = string.index("\n", pos)
+    return float(string[pos + 1 : end]), end + 1
+  elif c == "c":
+    end = string.index("\n", pos)
+    return complex(string[pos + 1 : end]), end + 1
+  raise ValueError("Unknown ref code '%s'!" % c)
+
+def fast_loads(string):
+  """fast_loads(string) -> obj
+
+Same as loads(STRING), but faster for dicts, lists, basic types and simple objects."""
+  if not string.startswith("cereal1\n"): return loads(string)
+  index = string.index
+  ref   = _fast_undump_ref
+
+  end = index("\n", 8)
+  nb = int(string[8 : end])
+  pos = end + 1
+  id2obj   = [None] * nb
+  handlers = None
+  for i in xrange(nb):
+    end = index("\n", pos) + 1
+    classname = string[pos : end]
+    pos = end
+    if   classname == "dict\n": id2obj[i] = {}
+    elif classname == "list\n": id2obj[i] = []
+    else:
+      handler = _HANDLERS.get(classname)
+      if not handler.__class__ in _FAST_OBJ_HANDLERS:
+        return loads(string) # Also raises the errors for unknown classes
+      if handlers is None: handlers = {}
+      handlers[i] = handler
+      id2obj[i] = handler.Class_new(handler.Class)
+
+  for i in xrange(nb):
+    obj = id2obj[i]
+    if handlers and i in handlers:
+      handler = handlers[i]
+      state, pos = ref(string, pos, id2obj)
+      if   handler.Class_setstate: handler.Class_setstate(obj, state)
+      elif isinstance(handler, SlotedObjHandler):
+        for slot in handler.Class_slots: setattr(obj, slot, state[slot])
+      else: obj.__dict__ = state
+      continue
+    end = index("\n", pos)
+    n = int(string[pos : end])
+    pos = end + 1
+    if obj.__class__ is dict:
+      for j in xrange(n):
+        v, pos = ref(string, pos, id2obj) # Value is read fist
+        if string[pos] == "s": # Most keys are strings
+          end = index("\n", pos)
+          start = end + 1
+          pos = start + int(string[pos + 1 : end])
+          obj[string[start : pos]] = v
+        else:
+          k, pos = ref(string, pos, id2obj)
+          obj[k] = v
+    else:
+      append = obj.append
+      for j in xrange(n):
+        v, pos = ref(string, pos, id2obj)
+        append(v)
+
+  return ref(string, pos, id2obj)[0]
+
+
 def dump_class_of_module(*modules):
   """dump_class_of_module(*modules)
 
@@ -10,6 +10,7 @@
 
 import cerealizer
 import unittest
+from decimal import Decimal
 
 
 class TestBasicType(unittest.TestCase):
@@ -242,6 +243,110 @@ class TestBasicType(unittest.TestCase):
     
     
     
+class TestFastPath(unittest.TestCase):
+  def fast_and_compare(self, obj1):
+    # The fast path and the Dumper must be able to read each other's output
+    for dumps in (cerealizer.dumps, cerealizer.fast_dumps):
+      for loads in (cerealizer.loads, cerealizer.fast_loads):
+        obj2 = loads(dumps(obj1))
+        assert obj1 == obj2
+        assert obj1.__class__ is obj2.__class__
+        
+  def test_basic  (self):
+    for obj in [7828, -579, 10000000000L, 4.9, True, False, None, "jiba", u"jib\xe9", [], {}]:
+      self.fast_and_compare(obj)
+      
+  def test_message(self):
+    self.fast_and_compare({ "type" : "gm", "subtype" : "bid", "id" : 3, "ok" : True, "list" : [1, [2.2, "jiba"], { 1 : None }] })
+    
+  def test_fallback(self):
+    self.fast_and_compare({ "tuple" : (1, (2.2, "jiba")), "set" : set([1, 2]), "complex" : 1+2j })
+    
+  def test_obj(self):
+    class Obj13(object):
+      __slots__ = ["x", "name"]
+      def __init__(self):
+        self.x    = 11.1
+        self.name = "jiba"
+      def __eq__(a, b): return (a.__class__ is b.__class__) and (a.x == b.x) and (a.name == b.name)
+    class Obj14:
+      def __init__(self): self.x = [1, 2]
+      def __eq__(a, b): return (a.__class__ is b.__class__) and (a.__dict__ == b.__dict__)
+    cerealizer.register(Obj13)
+    cerealizer.register(Obj14)
+    self.fast_and_compare({ "a" : Obj13(), "b" : [Obj14(), Obj14()] })
+    
+  def test_identity(self):
+    class Obj15(object):
+      __slots__ = ["x"]
+    cerealizer.register(Obj15)
+    o  = {}
+    o2 = Obj15()
+    l1 = [o, o, o2, o2]
+    l2 = cerealizer.fast_loads(cerealizer.fast_dumps(l1))
+    assert l2[0] is l2[1]
+    assert l2[2] is l2[3]
+    
+  def test_cycle(self):
+    obj1 = [1, [2.2, "jiba"]]
+    obj1[1].append(obj1)
+    obj2 = cerealizer.fast_loads(cerealizer.fast_dumps(obj1))
+    assert repr(obj1) == repr(obj2)
+    
+  def test_register(self):
+    class Sec7: pass
+    self.assertRaises(cerealizer.NonCerealizableObjectError, lambda : cerealizer.fast_dumps({ "a" : [Sec7()] }))
+    
+  def test_craked_file(self):
+    craked_file = "cereal1\n2\n__builtin__.dict\nfile\n0\nr0\nr1\n"
+    self.assertRaises(StandardError, lambda : cerealizer.fast_loads(craked_file))
+    self.assertRaises(StandardError, lambda : cerealizer.fast_loads("jiba"))
+    
+
+class TestDecimal(unittest.TestCase):
+  def setUp(self):
+    if not cerealizer._HANDLERS_.has_key(Decimal):
+      cerealizer.register(Decimal, cerealizer.DecimalHandler())
+    self.legacy = { Decimal : cerealizer.SlotedObjHandler(Decimal) }
+    
+  def decimals_and_compare(self, d1):
+    for s in [cerealizer.dumps(d1), cerealizer.fast_dumps(d1),
+              cerealizer.dumps(d1, handlers = self.legacy), cerealizer.fast_dumps(d1, handlers = self.legacy)]:
+      for loads in (cerealizer.loads, cerealizer.fast_loads):
+        d2 = loads(s)
+        assert d2.__class__ is Decimal
+        assert str(d1) == str(d2) # Also checks the exponent, and works for NaN
+        
+  def test_finite  (self):
+    for d in ["4.50", "-4.50", "0", "0.00", "-0.00", "1E+3", "123456789012345678901234567890.123", "1E-30"]:
+      self.decimals_and_compare(Decimal(d))
+      
+  def test_special (self):
+    for d in ["Infinity", "-Infinity", "NaN", "-NaN", "sNaN", "NaN123"]:
+      self.decimals_and_compare(Decimal(d))
+      
+  def test_inline  (self):
+    assert cerealizer.dumps(Decimal("-4.50")) == "cereal1\n0\nd-450E-2\n"
+    assert cerealizer.fast_dumps({ "a" : Decimal("Infinity") }) == "cereal1\n1\ndict\n1\ndInfinity\ns1\nar0\n"
+    
+  def test_legacy  (self):
+    s = cerealizer.dumps({ "a" : Decimal("4.50") }, handlers = self.legacy)
+    assert "decimal.Decimal\n" in s
+    assert s == cerealizer.fast_dumps({ "a" : Decimal("4.50") }, handlers = self.legacy)
+    
+  def test_message (self):
+    d = Decimal("37.60")
+    m1 = { "type" : "gm", "subtype" : "acctUpdate", "acct" : { "dollars" : d, "blue" : 4, "red" : 2, "low" : Decimal("-Infinity") },
+           "list" : [d, d, (d, Decimal("Infinity"))] }
+    for s in [cerealizer.dumps(m1), cerealizer.fast_dumps(m1), cerealizer.fast_dumps(m1, handlers = self.legacy)]:
+      for loads in (cerealizer.loads, cerealizer.fast_loads):
+        assert loads(s) == m1
+        
+  def test_craked  (self):
+    self.assertRaises(StandardError, lambda : cerealizer.loads     ("cereal1\n0\nd__import__('os')\n"))
+    self.assertRaises(StandardError, lambda : cerealizer.fast_loads("cereal1\n0\nd__import__('os')\n"))
+    
+    
 class TestSecurity(unittest.TestCase):
   def test_register1(self):
     class Sec1: pass
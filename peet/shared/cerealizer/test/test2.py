@@ -0,0 +1,51 @@
+# Cerealizer
+#
+# This program is free software.
+# It is available under the Python licence.
+
+# Benchmark of fast_dumps()/fast_loads() against dumps()/loads(), using the
+# shapes of the messages PEET sends during an Island auction.
+
+import cerealizer
+import decimal
+import time
+from decimal import Decimal
+
+cerealizer.register(decimal.Decimal)
+
+messages = [
+  { "type" : "gm", "subtype" : "bid", "id" : 3, "amount" : Decimal("4.50") },
+  { "type" : "gm", "subtype" : "ask", "id" : 5, "amount" : Decimal("5.20") },
+  { "type" : "gm", "subtype" : "transaction", "buyerID" : 3, "sellerID" : 5, "amount" : Decimal("5.20") },
+  { "type" : "gm", "subtype" : "acctUpdate", "acct" : { "dollars" : Decimal("37.60"), "blue" : 4, "red" : 2,
+                                                       "green" : 9, "roundScore" : 212, "matchScore" : 1310 } },
+  { "type" : "gm", "subtype" : "error", "error" : "bidTooLow" },
+  { "type" : "gm", "subtype" : "auction", "color" : "red", "auctionTime" : 60 },
+  { "type" : "gm", "subtype" : "initmatch", "color" : "blue", "chat" : True, "blueIDs" : [0, 2, 4, 6] },
+  { "type" : "ping" },
+  ]
+
+N = 5000
+
+def bench(name, dumps, loads):
+  t = time.time()
+  for i in xrange(N):
+    for m in messages: dumps(m)
+  dump_rate = N * len(messages) / (time.time() - t)
+
+  strings = [dumps(m) for m in messages]
+  t = time.time()
+  for i in xrange(N):
+    for s in strings: loads(s)
+  load_rate = N * len(messages) / (time.time() - t)
+
+  print "%-12s dumps %8.0f messages/s   loads %8.0f messages/s" % (name, dump_rate, load_rate)
+  return dump_rate, load_rate
+
+for m in messages:
+  assert cerealizer.loads(cerealizer.fast_dumps(m)) == m
+  assert cerealizer.fast_loads(cerealizer.dumps(m)) == m
+
+slow = bench("dumps/loads", cerealizer.dumps, cerealizer.loads)
+fast = bench("fast", cerealizer.fast_dumps, cerealizer.fast_loads)
+print "speedup      dumps %8.2fx                 loads %8.2fx" % (fast[0] / slow[0], fast[1] / slow[1])
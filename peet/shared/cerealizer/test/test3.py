@@ -0,0 +1,54 @@
+# Cerealizer
+#
+# This program is free software.
+# It is available under the Python licence.
+
+# Benchmark of DecimalHandler (Decimals saved inline) against Decimals saved as
+# objects by the default SlotedObjHandler, on acctUpdate-heavy PEET traffic:
+# after each Island transaction, the group gets the transaction and the buyer
+# and seller each get an acctUpdate.
+
+import cerealizer
+import time
+from decimal import Decimal
+
+cerealizer.register(Decimal, cerealizer.DecimalHandler())
+objects = { Decimal : cerealizer.SlotedObjHandler(Decimal) }
+
+def acct_update(dollars):
+  return { "type" : "gm", "subtype" : "acctUpdate", "acct" : { "dollars" : Decimal(dollars), "blue" : 4, "red" : 2,
+                                                               "green" : 9, "roundScore" : 212, "matchScore" : 1310 } }
+
+messages = [
+  { "type" : "gm", "subtype" : "transaction", "buyerID" : 3, "sellerID" : 5, "amount" : Decimal("5.20") },
+  acct_update("37.60"),
+  acct_update("12.10"),
+  acct_update("-0.80"),
+  ]
+
+N = 5000
+
+def bench(name, dumps, loads):
+  t = time.time()
+  for i in xrange(N):
+    for m in messages: dumps(m)
+  dump_rate = N * len(messages) / (time.time() - t)
+
+  strings = [dumps(m) for m in messages]
+  t = time.time()
+  for i in xrange(N):
+    for s in strings: loads(s)
+  load_rate = N * len(messages) / (time.time() - t)
+
+  size = sum([len(s) for s in strings]) / len(strings)
+  print "%-22s dumps %8.0f messages/s   loads %8.0f messages/s   %4d bytes" % (name, dump_rate, load_rate, size)
+
+for m in messages:
+  assert cerealizer.loads(cerealizer.dumps(m)) == m
+  assert cerealizer.fast_loads(cerealizer.fast_dumps(m)) == m
+  assert cerealizer.fast_loads(cerealizer.fast_dumps(m, handlers = objects)) == m
+
+bench("objects dumps/loads", lambda m: cerealizer.dumps(m, handlers = objects), cerealizer.loads)
+bench("objects fast",        lambda m: cerealizer.fast_dumps(m, handlers = objects), cerealizer.fast_loads)
+bench("inline dumps/loads",  cerealizer.dumps, cerealizer.loads)
+bench("inline fast",         cerealizer.fast_dumps, cerealizer.fast_loads)
@@ -0,0 +1,193 @@
+# Copyright 2009 University of Alaska Anchorage Experimental Economics
+# Laboratory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Leveled logging for PEET, with a logger per subsystem (e.g.
+getLogger('server.net')).  Logging calls only put the record on a queue; a
+background thread writes records to the console and any log files, so a slow
+console never holds up the thread that logs.  Calls at a disabled level do
+nothing at all. """
+
+import sys
+import atexit
+import thread
+import threading
+import collections
+import logging
+
+from logging import DEBUG, INFO, WARNING, ERROR
+
+stop_timeout = 1.0
+""" How long the process waits at exit for the background thread to stop, in
+seconds, before writing what's left itself """
+
+log_format = '%(asctime)s %(levelname)-7s %(name)s: %(message)s'
+
+# Logged records waiting to be written.  (deque appends and pops are atomic, so
+# logging threads never wait for a lock, except to wake the background thread
+# when it's idle.)
+records = collections.deque()
+
+# Set when there are records to write, or the background thread should stop
+wakeup = threading.Event()
+stopping = False
+stopped = threading.Event()  # Set when the background thread has stopped
+
+# The handlers the background thread writes records with, and the one of them
+# that writes to the console
+targets = []
+console = None
+
+loggers = {}  # Logger by subsystem name
+
+started = False
+
+def noop(*args, **kwargs):
+    pass
+
+class Logger:
+
+    """
+    Logs for one subsystem.  The debug(), info(), warning(), error() and
+    exception() methods are those of a logging.Logger, except that a method
+    whose level is disabled is replaced with one that does nothing.
+    """
+
+    def __init__(self, name):
+        self.logger = logging.getLogger('peet.' + name)
+        self.update()
+
+    def update(self):
+        """ Bind the logging methods for the current level. """
+        for level, method in ((DEBUG, 'debug'), (INFO, 'info'),
+                (WARNING, 'warning'), (ERROR, 'error'),
+                (ERROR, 'exception')):
+            if self.logger.isEnabledFor(level):
+                setattr(self, method, getattr(self.logger, method))
+            else:
+                setattr(self, method, noop)
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level)
+
+class QueueHandler(logging.Handler):
+
+    """ Puts records on the queue for the background thread. """
+
+    def createLock(self):
+        self.lock = None  # No lock needed to append to a deque
+
+    def handle(self, record):
+        if record.exc_info:
+            # Format the traceback now, while it's still available.
+            record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+            record.exc_info = None
+        # Likewise the message, since the arguments may change later.
+        record.msg = record.getMessage()
+        record.args = None
+        records.append(record)
+        if not wakeup.isSet():
+            wakeup.set()
+        return True
+
+def getLogger(name):
+    """ Return the Logger for a subsystem, e.g. 'server.net'. """
+    if not started:
+        start()
+    logger = loggers.get(name)
+    if logger == None:
+        logger = loggers[name] = Logger(name)
+    return logger
+
+def start(level=INFO, stream=sys.stdout):
+    """ Start logging records at the given level and above to the stream
+    (None for none).  getLogger() does this with the defaults if it hasn't
+    been done. """
+    global started, console
+    root = logging.getLogger('peet')
+    if not started:
+        started = True
+        root.propagate = False
+        root.addHandler(QueueHandler())
+        thread.start_new_thread(run, ())
+        atexit.register(stop)
+    if console != None:
+        targets.remove(console)
+        console = None
+    if stream != None:
+        console = logging.StreamHandler(stream)
+        addHandler(console)
+    setLevel(level)
+
+def restart():
+    """ Start the background thread again in a process forked from one that
+    was logging (e.g. a multiprocessing worker), since fork() copies only the
+    thread that calls it.  Such a process may also exit without running the
+    atexit handlers, so it should flush() before it's done. """
+    global wakeup, stopped
+    if started:
+        # The events may have been copied mid-wait.
+        wakeup = threading.Event()
+        stopped = threading.Event()
+        thread.start_new_thread(run, ())
+
+def addFile(filename, level=DEBUG):
+    """ Also write records at the given level and above (if enabled; see
+    setLevel()) to a file. """
+    handler = logging.FileHandler(filename)
+    handler.setLevel(level)
+    addHandler(handler)
+
+def addHandler(handler):
+    handler.setFormatter(logging.Formatter(log_format))
+    targets.append(handler)
+
+def setLevel(level, name=None):
+    """ Set the level of records logged by all subsystems, or by one and those
+    under it (e.g. 'server' includes 'server.net'). """
+    logging.getLogger(name and 'peet.' + name or 'peet').setLevel(level)
+    for logger in loggers.values():
+        logger.update()
+
+def flush():
+    """ Write all queued records. """
+    while records:
+        record = records.popleft()
+        for handler in targets:
+            if record.levelno >= handler.level:
+                try:
+                    handler.handle(record)
+                except:
+                    pass
+    for handler in targets:
+        handler.flush()
+
+def stop():
+    """ Stop the background thread, and write whatever it left.  Called at
+    exit, before the interpreter starts tearing down the modules the thread
+    uses. """
+    global stopping
+    stopping = True
+    wakeup.set()
+    stopped.wait(stop_timeout)
+    flush()
+
+def run():
+    while not stopping:
+        wakeup.wait()
+        wakeup.clear()
+        flush()
+    stopped.set()
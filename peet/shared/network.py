@@ -36,7 +36,18 @@ resulting in lost messages.  It's also possible to receive a partial message,
 which cannot be unpickled without calling recv() again and waiting for the rest.
 
 These functions prefix each message with its length to make sure they get
-through whole and nothing gets discarded.
+through whole and nothing gets discarded.  Every connection starts out with the
+original text length prefix (FRAMING_ASCII) and may then switch to a 4-byte
+binary one (FRAMING_BINARY or FRAMING_CHUNKED) if both ends support it; see
+negotiateFraming().
+
+Messages waiting to be sent are queued in one of three lanes by priority (see
+messageLane()): control messages such as pings and sync replies go out before
+anything else that is waiting, and large bulk messages such as reinit go out
+after the game messages already waiting (but before those sent after them).
+With FRAMING_CHUNKED, bulk messages are also sent in chunks, so that control
+messages can go out between the chunks instead of waiting for the whole
+message.
 
 Also, SenderThread is defined in this file, because there are no differences
 between how client and server do the sending part.  ListenerThread, however, is
@@ -45,18 +56,34 @@ defined separately for server (servernet.py) and client (clientnet.py)
 see servernet.py and clientnet.py
 """
 
-import sys
 import socket
+import struct
 import thread
+import itertools
 import Queue
-import traceback
 #import pickle
 import cerealizer
+import log
+
+logger = log.getLogger('shared.network')
 
 # Register with Cerealizer the classes we need to be able to send over the
 # network
 import decimal
-cerealizer.register(decimal.Decimal)
+cerealizer.register(decimal.Decimal, cerealizer.DecimalHandler())
+
+legacy_handlers = {
+        decimal.Decimal: cerealizer.SlotedObjHandler(decimal.Decimal)}
+""" Cerealizer handlers for peers that may predate DecimalHandler (see
+encode()).  They get Decimals as objects, which is what they register
+Decimal for. """
+
+# memoryview is new in Python 2.7.  Without it, MessageReader falls back to
+# recv() and slice assignment, which costs one extra copy per read.
+try:
+    _memoryview = memoryview
+except NameError:
+    _memoryview = None
 
 timeout = 10
 """ Number of seconds the server waits for a message from the client before
@@ -70,13 +97,133 @@ msglen_width = 10
 """ Number of characters to use in the zero-padded text representation of the
 message length field """
 
-def sendmessage(sock, message):
+FRAMING_ASCII = 'ascii'
+""" Original framing: each message is prefixed by its length as
+<msglen_width> zero-padded decimal digits.  Every connection starts out using
+this framing, so old clients and servers can always talk to each other. """
+
+FRAMING_BINARY = 'binary'
+""" Each message is prefixed by its length as a 4-byte unsigned big-endian
+integer. """
+
+FRAMING_CHUNKED = 'chunked'
+""" Like FRAMING_BINARY, but the two most significant bits of the length are
+flags: CHUNK marks a frame holding part of a larger message, and LAST_CHUNK
+marks its final part.  Frames without CHUNK are whole messages, which may come
+between the chunks of a message.  Only one chunked message is in progress at a
+time in each direction. """
+
+framing_modes = [FRAMING_CHUNKED, FRAMING_BINARY]
+""" Framing modes this end supports besides FRAMING_ASCII, most preferred
+first.  The server offers these to each client when it connects, and the client
+selects the first one it also supports (see negotiateFraming()). """
+
+binary_header = struct.Struct('!I')
+""" Header for FRAMING_BINARY and FRAMING_CHUNKED """
+
+CHUNK = 0x80000000
+LAST_CHUNK = 0x40000000
+chunk_flags = CHUNK | LAST_CHUNK
+""" Flags in a FRAMING_CHUNKED header """
+
+chunk_size = 16384
+""" Size in bytes of the chunks that bulk messages are sent in with
+FRAMING_CHUNKED.  Smaller bulk messages are sent whole. """
+
+LANE_CONTROL = 0
+""" Send lane for transport and session control: pings, sync, framing and
+errors.  Sent before anything else waiting to be sent.  Pause stays in
+LANE_GAME, so that it can't overtake the game messages sent before it, nor the
+message that ends the pause (which is a game message). """
+
+LANE_GAME = 1
+""" Send lane for everything else, in particular game messages """
+
+LANE_BULK = 2
+""" Send lane for large messages, such as init and reinit, which are sent in
+chunks with FRAMING_CHUNKED so that control messages can go out in between.
+Game messages queued after a bulk message go in this lane too, until it's
+empty, so that they can't overtake it (see SendQueue). """
+
+control_types = frozenset(['ping', 'sync', 'framing', 'error'])
+""" Message types sent in LANE_CONTROL """
+
+bulk_types = frozenset(['init', 'reinit', 'history'])
+""" Message types sent in LANE_BULK """
+
+sequenced_types = frozenset(['gm', 'chat', 'round', 'earnings',
+    'endOfExperiment', 'message'])
+""" Types of the messages that make up the game, as opposed to transport and
+login messages.  Once a client has a session (see servernet.Session), the
+server numbers the messages of these types it sends the client, starting at 1,
+and keeps the recent ones for resending if the connection drops; the client
+does the same for the ones it sends the server.  The numbers aren't sent: both
+ends count these messages, which all go in LANE_GAME and so arrive in the order
+they were numbered. """
+
+ack_interval = 32
+""" A client acknowledges every <ack_interval> sequenced messages it receives,
+as well as in every ping; the server acknowledges every <ack_interval> it
+receives """
+
+recv_buffer_size = 65536
+""" Initial size in bytes of each MessageReader's receive buffer.  The buffer
+grows if a single message doesn't fit. """
+
+send_buffer_size = 65536
+""" Size in bytes of each MessageWriter's send buffer.  Larger messages are
+sent directly, without being copied into the buffer. """
+
+send_queue_limit = 200
+""" Number of messages waiting to be sent on one connection above which the
+connection is considered slow (see SendQueue). """
+
+coalesce_limit = send_buffer_size
+""" Maximum number of bytes a SenderThread gathers from its queue into one
+send.  Everything already waiting on the queue is sent together, up to this
+many bytes. """
+
+def frameheader(length, framing=FRAMING_ASCII, flags=0):
+    """ Return the header that precedes a message of the given length.
+    @param flags: CHUNK and LAST_CHUNK, for FRAMING_CHUNKED only """
+    if framing == FRAMING_ASCII:
+        return '%0*u' % (msglen_width, length)
+    else:
+        return binary_header.pack(length | flags)
+
+def messageLane(message):
+    """ Return the send lane of a message (LANE_CONTROL, LANE_GAME or
+    LANE_BULK), going by its type. """
+    t = message.get('type')
+    if t in control_types:
+        return LANE_CONTROL
+    if t in bulk_types:
+        return LANE_BULK
+    return LANE_GAME
+
+def encode(message, framing=FRAMING_ASCII):
+    """ Return message serialized with cerealizer for a peer using the given
+    framing.  A peer that has negotiated anything other than FRAMING_ASCII is
+    known to understand inline Decimals (cerealizer.DecimalHandler); any
+    other may be an older version, so it gets Decimals as objects. """
+    if framing == FRAMING_ASCII:
+        return cerealizer.fast_dumps(message, handlers=legacy_handlers)
+    return cerealizer.fast_dumps(message)
+
+def decode(data, schemas=None):
+    """ Return the message in data, which was received from the other end:
+    either a cerealizer string, or a record packed by the given
+    schemas.SchemaRegistry. """
+    if schemas != None and data[:1] != 'c':
+        return schemas.decode(data)
+    return cerealizer.fast_loads(data)
+
+def sendmessage(sock, message, framing=FRAMING_ASCII):
     """ Send a complete pickled object over socket sock.  message should be
-    pickled before being passed in.  Message sent is prefixed by its length in
-    bytes (msglen_width determines the number of bytes in this field). """
-    msglen_str = '%0*u' % (msglen_width, len(message))
-    data = msglen_str + message
-    sock.sendall(data)
+    pickled before being passed in.  Message sent is prefixed by its length
+    (see frameheader()).  SenderThread uses a MessageWriter instead, which
+    reuses its buffer from one message to the next. """
+    MessageWriter(sock, framing, len(message) + msglen_width).write(message)
 
 def recvmessage(sock, leftovers):
     """ Receive a complete pickled object from socket sock.  Return a tuple
@@ -85,6 +232,9 @@ def recvmessage(sock, leftovers):
     parameter.  (To begin with, pass in an empty string as leftovers.)
     If the connection has been closed, return None in place of the pickled
     message.
+
+    This only understands FRAMING_ASCII.  The ListenerThreads use a
+    MessageReader instead.
     """
 
     # Leftovers will always start with 1 to <msglen_width> bytes of the
@@ -113,25 +263,439 @@ def recvmessage(sock, leftovers):
     return (message, leftovers)
 
 
-class SenderThread:
+class MessageReader:
+
+    """
+    Receives whole messages from one socket into a preallocated buffer.
+
+    Data is received directly into a bytearray with recv_into().  Complete
+    messages are sliced out of it through a memoryview, so each message is
+    copied exactly once, when it is handed to the caller.  When the unread data
+    reaches the end of the buffer, the incomplete message it contains (if any)
+    is moved back to the start, so the buffer is used as a ring without
+    messages ever wrapping around.  The buffer only grows when a single message
+    is larger than the whole buffer.
+
+    The framing attribute may be changed between messages (see
+    negotiateFraming()); data already in the buffer is then read using the new
+    framing.  With FRAMING_CHUNKED, the chunks of a message are put back
+    together, and only the whole message is returned.
+    """
+
+    def __init__(self, sock, framing=FRAMING_ASCII, bufsize=recv_buffer_size):
+        self.sock = sock
+        self.framing = framing
+        self.setBuffer(bytearray(bufsize))
+        self.start = 0  # Index of the first unread byte in buf
+        self.end = 0    # Index just past the last received byte in buf
+        self.chunks = []  # Chunks received so far of a chunked message
+
+    def setBuffer(self, buf):
+        self.buf = buf
+        if _memoryview != None:
+            self.view = _memoryview(buf)
+
+    def fill(self):
+        """ Receive at least one more byte into the buffer, blocking if none are
+        available yet.  Return False if the connection has been closed. """
+        if self.end == len(self.buf):
+            self.reserve(self.end - self.start + 1)
+        if _memoryview != None:
+            n = self.sock.recv_into(self.view[self.end:])
+        else:
+            data = self.sock.recv(len(self.buf) - self.end)
+            n = len(data)
+            self.buf[self.end:self.end + n] = data
+        if n == 0:  # Disconnected.
+            return False
+        self.end += n
+        return True
+
+    def reserve(self, size):
+        """ Make room for at least <size> bytes starting at self.start. """
+        if self.start + size <= len(self.buf):
+            return
+        pending = self.end - self.start
+        if size > len(self.buf):
+            buf = bytearray(max(size, 2 * len(self.buf)))
+            buf[:pending] = self.buf[self.start:self.end]
+            self.setBuffer(buf)
+        else:
+            self.buf[:pending] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def next(self):
+        """ Return the next complete message already in the buffer, or None if
+        there isn't one.  Never blocks. """
+        while True:
+            available = self.end - self.start
+            flags = 0
+            if self.framing == FRAMING_ASCII:
+                hlen = msglen_width
+                if available < hlen:
+                    self.reserve(hlen)
+                    return None
+                msglen = int(str(self.buf[self.start:self.start + hlen]))
+            else:
+                hlen = binary_header.size
+                if available < hlen:
+                    self.reserve(hlen)
+                    return None
+                msglen = binary_header.unpack_from(self.buf, self.start)[0]
+                if self.framing == FRAMING_CHUNKED:
+                    flags = msglen & chunk_flags
+                    msglen &= ~chunk_flags
+
+            if available < hlen + msglen:
+                self.reserve(hlen + msglen)
+                return None
+
+            begin = self.start + hlen
+            self.start = begin + msglen
+            if _memoryview != None:
+                message = self.view[begin:self.start].tobytes()
+            else:
+                message = str(self.buf[begin:self.start])
+            if self.start == self.end:
+                # Buffer is empty; start filling from the beginning again.
+                self.start = self.end = 0
+            if not flags:
+                return message
+
+            self.chunks.append(message)
+            if flags & LAST_CHUNK:
+                message = ''.join(self.chunks)
+                self.chunks = []
+                return message
+
+    def read(self):
+        """ Return the next complete message, blocking until one has been
+        received.  If the connection has been closed, return None. """
+        while True:
+            message = self.next()
+            if message != None:
+                return message
+            if not self.fill():
+                return None
+
+
+class MessageWriter:
+
+    """
+    Sends whole messages over one socket.  Messages are framed into a send
+    buffer that is reused from one send to the next.  Use write() to send one
+    message, or append() several and then flush() to send them all at once.
+    Messages too large for the buffer are sent directly after their header.
+    """
+
+    def __init__(self, sock, framing=FRAMING_ASCII, bufsize=send_buffer_size):
+        self.sock = sock
+        self.framing = framing
+        self.buf = bytearray(bufsize)
+        self.size = 0   # bytes appended since the last flush
+        self.count = 0  # messages appended since the last flush
+        self.stats = FlushStats()
+
+    def append(self, message, flags=0):
+        """ Frame a message (a string) into the send buffer without sending it.
+        @param flags: header flags (see frameheader())
+        @return False, and append nothing, if it doesn't fit in what's left of
+        the buffer. """
+        header = frameheader(len(message), self.framing, flags)
+        start = self.size + len(header)
+        end = start + len(message)
+        if end > len(self.buf):
+            return False
+        self.buf[self.size:start] = header
+        self.buf[start:end] = message
+        self.size = end
+        self.count += 1
+        return True
+
+    def flush(self):
+        """ Send everything appended since the last flush with one sendall().
+        Blocks until it has been sent. """
+        if self.count == 0:
+            return
+        try:
+            self.sock.sendall(buffer(self.buf, 0, self.size))
+        finally:
+            self.stats.record(self.count)
+            self.size = 0
+            self.count = 0
+
+    def write(self, message, flags=0):
+        """ Send one message (a string), along with anything appended before
+        it.  Blocks until it has been sent. """
+        if self.append(message, flags):
+            self.flush()
+            return
+        self.flush()
+        if self.append(message, flags):
+            self.flush()
+        else:
+            self.sock.sendall(frameheader(len(message), self.framing, flags))
+            self.sock.sendall(message)
+            self.stats.record(1)
+
+
+class FlushStats:
+
+    """
+    Counts how many messages were carried by each send (flush) on a connection.
+    """
+
+    def __init__(self):
+        self.flushes = 0
+        self.messages = 0
+        # Number of flushes that carried each number of messages
+        self.histogram = {}
+
+    def record(self, count):
+        self.flushes += 1
+        self.messages += count
+        self.histogram[count] = self.histogram.get(count, 0) + 1
+
+    def getMeanMessagesPerFlush(self):
+        if self.flushes == 0:
+            return 0.0
+        return float(self.messages) / self.flushes
+
+    def __str__(self):
+        return '%d messages in %d flushes (%.2f per flush): %s' % (
+                self.messages, self.flushes, self.getMeanMessagesPerFlush(),
+                ', '.join(['%dx%d' % (count, n) for count, n
+                    in sorted(self.histogram.items())]))
+
+
+def negotiateFraming(message, reader, sender):
+    """ Handle a 'framing' message, which is how the two ends of a connection
+    agree to switch from FRAMING_ASCII to something better.  Both ListenerThreads
+    call this when they receive a message of type 'framing'.
+
+    1. The server sends {'type': 'framing', 'offer': [modes]} when a client
+       connects.  Old clients ignore it and keep using FRAMING_ASCII.
+    2. The client replies {'type': 'framing', 'mode': <mode>} with the first
+       offered mode in its framing_modes, and uses that mode for everything it
+       sends after the reply.
+    3. The server reads everything after the reply using the new mode, and
+       acknowledges with {'type': 'framing', 'mode': <mode>}, which is the last
+       message it sends using FRAMING_ASCII.
+    4. The client reads everything after the acknowledgement using the new mode.
+
+    The switch happens between two messages in each direction, so no message is
+    ever read with the wrong framing.
+    @param reader: the MessageReader of the connection
+    @param sender: the SenderThread of the connection
+    """
+    mode = message.get('mode')
+    if message.has_key('offer'):
+        # Step 2 (client)
+        for m in framing_modes:
+            if m in message['offer']:
+                sender.setFraming(m, {'type': 'framing', 'mode': m})
+                return
+    elif mode in framing_modes:
+        if reader.framing == mode:
+            # Already switched
+            return
+        reader.framing = mode
+        if sender.framing != mode:
+            # Step 3 (server)
+            sender.setFraming(mode, {'type': 'framing', 'mode': mode})
+
+
+class SendQueue:
+
+    """
+    Bookkeeping for the queue of messages waiting to be sent on one connection,
+    shared by SenderThread and servernet.LoopSender.  A subclass provides
+    enqueue(data, lane) and getQueueDepth(), calls initSendQueue() from its
+    constructor, and calls taken() whenever it takes an item off its queue.
+    Items are taken from the lowest-numbered lane that has any (see
+    messageLane()), and in order within each lane.  While anything is waiting
+    in (or part way through being sent from) LANE_BULK, messages for LANE_GAME
+    are put in LANE_BULK after it, so only control messages go ahead of a bulk
+    message.  The subclass calls bulkSent() once each item in LANE_BULK has
+    been sent in full.
+
+    When more than queueLimit messages are waiting, the connection is marked
+    slow, and onSlowChanged(True) is called (if set).  Once the queue drains
+    to half the limit, it is marked not slow again and onSlowChanged(False) is
+    called.  While a connection is slow and collapse is True, a message sent
+    with a supersede key is sent in place of any message with the same key that
+    is still waiting, instead of being queued after everything else.
+    """
+
+    def initSendQueue(self):
+        self.queueLimit = send_queue_limit
+        self.slow = False
+        self.onSlowChanged = None
+        self.collapse = False
+        self.superseded = 0  # Number of messages dropped by collapsing
+        self.waiting = {}  # supersede key -> Supersedable still on the queue
+        self.waitingLock = thread.allocate_lock()
+        self.bulkQueued = 0  # Items in LANE_BULK not yet sent in full
+        self.laneLock = thread.allocate_lock()
+
+    def send(self, message):
+        # Putting messages on the queue, then having the sender take them off
+        # as available and send them, ensures that they get sent in order
+        # (within each lane).
+        self.sendEncoded(encode(message, self.framing), None,
+                messageLane(message))
+
+    def sendEncoded(self, data, key=None, lane=LANE_GAME):
+        """ Send a message that has already been serialized with encode(),
+        so that the same string can be queued for several SenderThreads without
+        serializing it again.
+        @param key: supersede key of the message, or None
+        @param lane: LANE_CONTROL, LANE_GAME or LANE_BULK
+        @return the item queued (data, or the Supersedable holding it), or None
+        if data took the place of a message that was already waiting """
+        if key != None:
+            self.waitingLock.acquire()
+            try:
+                old = self.waiting.get(key)
+                if old != None and self.slow and self.collapse:
+                    old.data = data
+                    self.superseded += 1
+                    return None
+                item = Supersedable(key, data)
+                self.waiting[key] = item
+            finally:
+                self.waitingLock.release()
+            data = item
+        if lane != LANE_CONTROL:
+            self.laneLock.acquire()
+            if lane == LANE_GAME and self.bulkQueued:
+                # Behind the bulk message
+                lane = LANE_BULK
+            if lane == LANE_BULK:
+                self.bulkQueued += 1
+            self.laneLock.release()
+        self.enqueue(data, lane)
+        if not self.slow and self.getQueueDepth() > self.queueLimit:
+            self.setSlow(True)
+        return data
+
+    def bulkSent(self):
+        """ Note that an item in LANE_BULK has been sent in full. """
+        self.laneLock.acquire()
+        self.bulkQueued -= 1
+        self.laneLock.release()
+
+    def taken(self, item):
+        """ Return the data of an item taken off the queue. """
+        if isinstance(item, Supersedable):
+            self.waitingLock.acquire()
+            if self.waiting.get(item.key) is item:
+                del self.waiting[item.key]
+            self.waitingLock.release()
+            item = item.data
+        if isinstance(item, Tracked):
+            try:
+                item.onTaken()
+            except:
+                logger.exception('Caught exception in onTaken')
+            item = item.data
+        if self.slow and self.getQueueDepth() <= self.queueLimit / 2:
+            self.setSlow(False)
+        return item
+
+    def setSlow(self, slow):
+        self.slow = slow
+        if self.onSlowChanged != None:
+            self.onSlowChanged(slow)
+
+
+class Chunks:
+    """ The part of a bulk message that is still to be sent, in chunks of
+    chunk_size bytes (FRAMING_CHUNKED only).  Put back at the head of the bulk
+    lane after each chunk, so that control messages can go out in between. """
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def next(self):
+        """ Return the next chunk and its header flags. """
+        chunk = self.data[self.pos:self.pos + chunk_size]
+        self.pos += len(chunk)
+        if self.pos < len(self.data):
+            return chunk, CHUNK
+        return chunk, CHUNK | LAST_CHUNK
+
+    def done(self):
+        return self.pos >= len(self.data)
+
+def isChunked(data, lane, framing):
+    """ Return True if data, taken off a send queue, has to be sent in
+    chunks. """
+    return lane == LANE_BULK and framing == FRAMING_CHUNKED and \
+            (isinstance(data, Chunks) or len(data) > chunk_size)
+
+
+class Supersedable:
+    """ Placed on a send queue in place of a message sent with a supersede key
+    (see SendQueue).  data is replaced if the message is superseded while it
+    is waiting. """
+    def __init__(self, key, data):
+        self.key = key
+        self.data = data
+
+
+class Tracked:
+    """ Placed on a send queue in place of a message whose sender wants to
+    know when it goes out: onTaken() is called, with no arguments, when it is
+    taken off the queue to be written.  It's called by the thread doing the
+    sending, so it should be quick. """
+    def __init__(self, data, onTaken):
+        self.data = data
+        self.onTaken = onTaken
+
+
+class SenderThread(SendQueue):
 
     """
     SenderThread buffers and sends messages over one socket.
     Use the send() method.
     """
 
-    def __init__(self, sock, send_pings=False):
+    def __init__(self, sock, send_pings=False, bufsize=coalesce_limit):
         """
         Initializes the thread.  No action is taken; use
         C{Start()} to launch the thread.
         @param{send_pings} If True, send a ping message whenever no other
         message has been sent for <network.ping_interval> seconds.  Clients do
         this to let the server know they are still connected.
+        @param{bufsize} Maximum number of bytes of queued messages to send at
+        once
         """
         self.sock = sock
-        self.msgQueue = Queue.Queue()
+        # Items are (lane, sequence number, data), so that they come off in
+        # order within each lane.
+        self.msgQueue = Queue.PriorityQueue()
+        self.sequence = itertools.count()
         self.qtimeout = ping_interval if send_pings else None
+        self.writer = MessageWriter(sock, bufsize=bufsize)
+
+        # How many messages each send carried (see FlushStats)
+        self.stats = self.writer.stats
+
+        # The framing that applies to messages queued from now on.  (The
+        # writer's framing changes only once the queue reaches the switch.)
+        self.framing = FRAMING_ASCII
+
+        # If set, pings acknowledge the sequenced messages received up to this
+        # number (see sequenced_types).
+        self.ack = None
+
+        # If set, called in the thread when it terminates (see Stop())
+        self.onStop = None
 
+        self.initSendQueue()
 
     def Start(self):
         """
@@ -141,8 +705,9 @@ class SenderThread:
         thread.start_new_thread(self.Run, ())
 
     def Stop(self):
-        """ Stop the thread (causes the Run function to terminate). """
-        self.msgQueue.put(None)
+        """ Stop the thread (causes the Run function to terminate) once
+        everything already queued has been sent. """
+        self.msgQueue.put((LANE_BULK + 1, self.sequence.next(), None))
 
     def Run(self):
         """
@@ -157,21 +722,91 @@ class SenderThread:
             # connected.
             try:
                 # Queue.get([block[, timeout]])
-                data = self.msgQueue.get(True, self.qtimeout)
+                lane, seq, data = self.msgQueue.get(True, self.qtimeout)
                 if data == None:
-                    print "SenderThread: Stop() called, terminating"
+                    logger.debug("SenderThread: Stop() called, terminating")
                     break
             except Queue.Empty:
-                data = cerealizer.dumps({'type': 'ping'})
+                lane = LANE_CONTROL
+                ping = {'type': 'ping'}
+                if self.ack != None:
+                    ping['ack'] = self.ack
+                data = cerealizer.fast_dumps(ping)
 
+            # Gather whatever else is already waiting on the queue, and send it
+            # all together.
+            stop = False
             try:
-                sendmessage(self.sock, data)
+                while True:
+                    if data == None:
+                        logger.debug(
+                                "SenderThread: Stop() called, terminating")
+                        stop = True
+                        break
+                    data = self.taken(data)
+                    if isinstance(data, FramingSwitch):
+                        # Each header is framed when its message is appended,
+                        # so the switch doesn't have to interrupt the batch.
+                        self.writer.framing = data.framing
+                    elif isChunked(data, lane, self.writer.framing):
+                        # Send one chunk now, and leave the rest at the head
+                        # of the lane, behind anything queued in the other
+                        # lanes meanwhile.
+                        if not isinstance(data, Chunks):
+                            data = Chunks(data)
+                        chunk, flags = data.next()
+                        if not self.writer.append(chunk, flags):
+                            self.writer.flush()
+                            if not self.writer.append(chunk, flags):
+                                self.writer.write(chunk, flags)
+                        self.writer.flush()
+                        if not data.done():
+                            self.msgQueue.put((lane, seq, data))
+                        else:
+                            self.bulkSent()
+                    else:
+                        if not self.writer.append(data):
+                            # Full; send what we have and start over.  A
+                            # message too large for the buffer is sent by
+                            # itself.
+                            self.writer.flush()
+                            if not self.writer.append(data):
+                                self.writer.write(data)
+                        if lane == LANE_BULK:
+                            self.bulkSent()
+                    try:
+                        lane, seq, data = self.msgQueue.get_nowait()
+                    except Queue.Empty:
+                        break
+                self.writer.flush()
             except:
-                print "SenderThread: caught exception, terminating: "
-                traceback.print_exc(file=sys.stdout)
+                logger.exception("SenderThread: caught exception, terminating")
+                break
+            if stop:
                 break
 
-    def send(self, message):
-        # Putting messages on the queue, then having the SenderThread take them
-        # off as available and send them, ensures that they get sent in order.
-        self.msgQueue.put(cerealizer.dumps(message))
+        if self.onStop != None:
+            self.onStop()
+
+    def enqueue(self, data, lane):
+        self.msgQueue.put((lane, self.sequence.next(), data))
+
+    def getQueueDepth(self):
+        """ Return the number of messages waiting to be sent. """
+        return self.msgQueue.qsize()
+
+    def setFraming(self, framing, message=None):
+        """ Send the given message (if any) using the current framing, and then
+        switch to the given framing for all messages sent after it.  Both go
+        in the control lane, so the switch comes right after the message, ahead
+        of anything still waiting in the other lanes. """
+        if message != None:
+            self.sendEncoded(encode(message, self.framing), None, LANE_CONTROL)
+        self.framing = framing
+        self.enqueue(FramingSwitch(framing), LANE_CONTROL)
+
+class FramingSwitch:
+    """ Placed on a SenderThread's queue to change the framing of the messages
+    after it. """
+    def __init__(self, framing):
+        self.framing = framing
@@ -0,0 +1,249 @@
+# Copyright 2009 University of Alaska Anchorage Experimental Economics
+# Laboratory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compact binary encoding for game messages with a fixed shape.
+
+A game controller declares the shapes of its most frequent messages in
+GameControl.messageSchemas, e.g.
+
+    messageSchemas = [
+        ('bid', [('id', 'int'), ('amount', 'decimal')]),
+        ('acctUpdate', [('acct', [('dollars', 'decimal'), ('blue', 'int')])]),
+    ]
+
+Each entry is a 'gm' subtype and a list of (key, kind) fields, where kind is
+one of 'int', 'bool', 'str', 'decimal', or a list of fields for a nested dict.
+A subtype may be declared more than once with different fields, including
+different fields of a nested dict.  A message matches a schema if it has
+exactly the declared keys (plus 'type' and 'subtype') and the values are of the
+declared kinds; it is packed with the first schema it matches.
+
+A SchemaRegistry packs a matching message into a record: a one-byte tag
+identifying the schema, followed by the field values in declared order, without
+any keys.  Ints are 4-byte signed integers, bools one byte, strs a one-byte
+length followed by the characters, and Decimals an 8-byte signed coefficient
+and a 1-byte exponent, so that they are restored exactly, trailing zeros and
+all.  Messages that don't match any schema (including non-finite Decimals and
+values out of range) are left for cerealizer.  Tags are never ord('c'), so a
+record can always be told apart from a cerealizer string, which starts with
+"cereal1".
+
+The server sends the client the schemas in a {'type': 'schemas'} message
+before the first record (see servernet.Communicator), and the client rebuilds
+the same SchemaRegistry from it with SchemaRegistry.fromDescription().
+"""
+
+import struct
+from decimal import Decimal
+
+INT = struct.Struct('!i')
+BOOL = struct.Struct('!B')
+STRLEN = struct.Struct('!B')
+DECIMAL = struct.Struct('!qb')
+
+kinds = ('int', 'bool', 'str', 'decimal')
+""" Field kinds other than nested dicts """
+
+maxTag = 255
+
+class SchemaError(StandardError):
+    pass
+
+class MessageSchema:
+
+    """ The shape of one kind of message (see module docstring). """
+
+    def __init__(self, tag, subtype, fields):
+        if tag < 1 or tag > maxTag or tag == ord('c'):
+            raise SchemaError('invalid schema tag %r' % tag)
+        self.tag = tag
+        self.tagByte = chr(tag)
+        self.subtype = subtype
+        self.fields = checkFields(fields)
+        self.keys = frozenset(['type', 'subtype'] +
+                [name for name, kind in self.fields])
+
+    def pack(self, message):
+        """ Return the record for message, or None if it doesn't fit this
+        schema. """
+        parts = [self.tagByte]
+        if packFields(self.fields, message, parts):
+            return ''.join(parts)
+        return None
+
+    def unpack(self, data):
+        """ Return the message packed in the given record. """
+        message, pos = unpackFields(self.fields, data, 1)
+        if pos != len(data):
+            raise SchemaError('%d bytes left over after %s record' %
+                    (len(data) - pos, self.subtype))
+        message['type'] = 'gm'
+        message['subtype'] = self.subtype
+        return message
+
+    def describe(self):
+        return {'tag': self.tag, 'subtype': self.subtype,
+                'fields': describeFields(self.fields)}
+
+
+class SchemaRegistry:
+
+    """ All the message schemas in use on a connection. """
+
+    def __init__(self):
+        self.byTag = {}
+        self.bySubtype = {}  # subtype -> list of MessageSchemas
+
+    def add(self, schema):
+        if self.byTag.has_key(schema.tag):
+            raise SchemaError('schema tag %d is already in use' % schema.tag)
+        self.byTag[schema.tag] = schema
+        self.bySubtype.setdefault(schema.subtype, []).append(schema)
+
+    def encode(self, message):
+        """ Return message packed as a record, or None if it doesn't match any
+        schema. """
+        if message.get('type') != 'gm':
+            return None
+        candidates = self.bySubtype.get(message.get('subtype'))
+        if candidates == None:
+            return None
+        keys = frozenset(message)
+        for schema in candidates:
+            if schema.keys == keys:
+                record = schema.pack(message)
+                if record != None:
+                    return record
+        return None
+
+    def decode(self, data):
+        """ Return the message packed in the given record. """
+        schema = self.byTag.get(ord(data[0]))
+        if schema == None:
+            raise SchemaError('unknown schema tag %d' % ord(data[0]))
+        return schema.unpack(data)
+
+    def describe(self):
+        """ Return the schemas as a list of dicts of builtin types, suitable for
+        sending in a message. """
+        return [self.byTag[tag].describe() for tag in sorted(self.byTag)]
+
+    def fromDeclarations(cls, declarations):
+        """ Create a registry from a GameControl.messageSchemas list, numbering
+        the schemas in order. """
+        registry = cls()
+        tag = 1
+        for subtype, fields in declarations:
+            if tag == ord('c'):
+                tag += 1
+            registry.add(MessageSchema(tag, subtype, fields))
+            tag += 1
+        return registry
+    fromDeclarations = classmethod(fromDeclarations)
+
+    def fromDescription(cls, description):
+        """ Create a registry from the result of describe(). """
+        registry = cls()
+        for d in description:
+            registry.add(MessageSchema(d['tag'], d['subtype'], d['fields']))
+        return registry
+    fromDescription = classmethod(fromDescription)
+
+
+def checkFields(fields):
+    """ Return fields as a list of (name, kind) tuples, raising SchemaError if
+    any kind is unknown.  Nested field lists are checked too. """
+    checked = []
+    for name, kind in fields:
+        if isinstance(kind, (list, tuple)):
+            kind = checkFields(kind)
+        elif kind not in kinds:
+            raise SchemaError('unknown field kind %r' % (kind,))
+        checked.append((name, kind))
+    return checked
+
+def describeFields(fields):
+    return [[name, isinstance(kind, list) and describeFields(kind) or kind]
+            for name, kind in fields]
+
+def packFields(fields, d, parts):
+    """ Append the packed values of the given fields of dict d to parts.
+    Return False if a value isn't of the field's kind or out of range. """
+    for name, kind in fields:
+        value = d[name]
+        cls = value.__class__
+        if kind == 'int':
+            if cls is not int or not -0x80000000 <= value <= 0x7fffffff:
+                return False
+            parts.append(INT.pack(value))
+        elif kind == 'decimal':
+            if cls is not Decimal or not value.is_finite():
+                return False
+            sign, digits, exp = value.as_tuple()
+            coefficient = 0
+            for digit in digits:
+                coefficient = coefficient * 10 + digit
+            if sign:
+                if coefficient == 0:
+                    return False  # -0 can't be told apart from 0
+                coefficient = -coefficient
+            if not (-0x8000000000000000 <= coefficient <= 0x7fffffffffffffff
+                    and -128 <= exp <= 127):
+                return False
+            parts.append(DECIMAL.pack(coefficient, exp))
+        elif kind == 'str':
+            if cls is not str or len(value) > 255:
+                return False
+            parts.append(STRLEN.pack(len(value)))
+            parts.append(value)
+        elif kind == 'bool':
+            if cls is not bool:
+                return False
+            parts.append(BOOL.pack(value))
+        else:
+            if cls is not dict or frozenset(value) != \
+                    frozenset([n for n, k in kind]):
+                return False
+            if not packFields(kind, value, parts):
+                return False
+    return True
+
+def unpackFields(fields, data, pos):
+    """ Return (dict, position after the fields) for the fields packed at
+    position pos of data. """
+    d = {}
+    for name, kind in fields:
+        if kind == 'int':
+            d[name] = INT.unpack_from(data, pos)[0]
+            pos += INT.size
+        elif kind == 'decimal':
+            coefficient, exp = DECIMAL.unpack_from(data, pos)
+            d[name] = Decimal('%dE%d' % (coefficient, exp))
+            pos += DECIMAL.size
+        elif kind == 'str':
+            n = STRLEN.unpack_from(data, pos)[0]
+            pos += STRLEN.size
+            if pos + n > len(data):
+                raise SchemaError('truncated record')
+            d[name] = data[pos:pos + n]
+            pos += n
+        elif kind == 'bool':
+            d[name] = bool(BOOL.unpack_from(data, pos)[0])
+            pos += BOOL.size
+        else:
+            d[name], pos = unpackFields(kind, data, pos)
+    return d, pos